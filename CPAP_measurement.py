@@ -1,10 +1,12 @@
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from scipy.signal import find_peaks
 from scipy import integrate
 import json
 import math
+import base64
+import zlib
 
 # Make sure it changed to bpm not bps
 
@@ -15,6 +17,18 @@ OUTER_AREA = np.pi * (OUTER_DIAMETER/2)**2
 INNER_AREA = np.pi * (INNER_DIAMETER/2)**2
 
 FILENAME = "patient_08"
+PLOT_FILENAME = "flow_rate_vs_time_plot.png"
+
+# Streaming analysis keeps this many of the newest flow samples between
+# batches. Peaks closer than STREAM_HOLDBACK samples to the end of the window
+# are not counted yet, since later samples may still change them.
+STREAM_WINDOW = 1000
+STREAM_HOLDBACK = 200
+
+# Finest resolution of the stored flow-rate waveform pyramid, in min/max
+# buckets, and the number of buckets compressed together in one chunk.
+WAVEFORM_MAX_BUCKETS = 2 ** 18
+WAVEFORM_CHUNK = 1024
 
 
 def adc_to_pressure(adc):
@@ -258,18 +272,369 @@ def examine_leakage(time, flow_rate, metrics):
         return None
 
 
-def process_cpap_data(file):
+def parse_sample(sample):
+    '''Validates a raw CPAP sample received as a list.
+
+    Streaming clients send the 7 values of a datafile line as a list instead
+    of a comma-delimited string. The same conversion as parse_line() is
+    applied: one float followed by 6 ints. Any bad or incorrectly sized
+    sample returns None.
+
+    Args:
+        sample (list): time (s) and the 6 ADC readings
+
+    Returns:
+        data (list): converted sample, or None
+    '''
+    if type(sample) is not list or len(sample) != 7:
+        return None
+    try:
+        data = [float(sample[0])]
+        for x in sample[1:]:
+            if type(x) is not int and not (type(x) is float and
+                                           x.is_integer()):
+                return None
+            data.append(int(x))
+    except (TypeError, ValueError):
+        return None
+    return data
+
+
+def new_stream_state():
+    '''Creates the state of an incremental CPAP analysis.
+
+    The state is a dict that can be stored as is, holding the running
+    metrics and a bounded window of the newest time and flow-rate values:
+
+    - start_time, end_time: first and last sample times (sec)
+    - samples: number of samples analyzed
+    - breaths: number of breaths counted so far
+    - last_breath_time: time of the last counted breath (sec)
+    - apnea_count: number of apnea events counted so far
+    - leakage: running integral of the flow rate (L)
+    - breath_rate_bpm: average breathing rate in breaths/min
+    - window_time, window_flow: newest samples kept for peak finding
+
+    Returns:
+        state (dict): empty analysis state
+    '''
+    return {"start_time": None,
+            "end_time": None,
+            "samples": 0,
+            "breaths": 0,
+            "last_breath_time": None,
+            "apnea_count": 0,
+            "leakage": 0.0,
+            "breath_rate_bpm": 0.0,
+            "window_time": [],
+            "window_flow": [],
+            }
+
+
+def update_stream_metrics(state, samples):
+    '''Adds a batch of raw samples to an incremental CPAP analysis.
+
+    Each valid sample is converted to a flow rate as in process_cpap_data()
+    and appended to the state window. Peaks are found in the window with the
+    same find_peaks() parameters as the batch analysis, and peaks newer than
+    the last counted breath are counted once they are at least
+    STREAM_HOLDBACK samples from the end of the window. Gaps of 10 sec or
+    more between counted breaths are counted as apnea events and the leakage
+    integral is extended with the trapezoid rule, matching
+    calculate_metrics() and examine_leakage(). The window is then trimmed to
+    STREAM_WINDOW samples, so the state stays bounded however long the
+    recording runs. Samples must arrive in time order.
+
+    Args:
+        state (dict): analysis state from new_stream_state()
+        samples (list): raw samples, each a list of 7 values
+
+    Returns:
+        skipped (int): number of invalid samples that were ignored
+    '''
+    skipped = 0
+    time, Q = state["window_time"], state["window_flow"]
+    for sample in samples:
+        data = parse_sample(sample)
+        if data is None:
+            skipped += 1
+            continue
+        p = [adc_to_pressure(x) for x in data[1:4]]
+        flow = volumetric_flow(p[0], p[1], p[2])
+        if flow is None or math.isnan(flow):
+            skipped += 1
+            continue
+        flow = float(flow)
+        if time:
+            state["leakage"] += (data[0] - time[-1]) * (flow + Q[-1]) / 2
+        elif state["start_time"] is None:
+            state["start_time"] = data[0]
+        time.append(data[0])
+        Q.append(flow)
+        state["samples"] += 1
+    if not time:
+        return skipped
+    state["end_time"] = time[-1]
+    peaks, _ = find_peaks(Q, distance=80, prominence=0.1, height=0.1,
+                          width=20)
+    for i in peaks:
+        if i >= len(time) - STREAM_HOLDBACK:
+            break
+        last = state["last_breath_time"]
+        if last is not None and time[i] <= last:
+            continue
+        if last is not None and time[i] - last >= 10.0:
+            state["apnea_count"] += 1
+        state["breaths"] += 1
+        state["last_breath_time"] = time[i]
+    duration = state["end_time"] - state["start_time"]
+    if duration > 0:
+        state["breath_rate_bpm"] = round(
+            60 * float(state["breaths"] / duration), 3)
+    del time[:-STREAM_WINDOW]
+    del Q[:-STREAM_WINDOW]
+    return skipped
+
+
+def pack_ints(values):
+    '''Compresses a sequence of integers into a base-64 string.
+
+    The values are delta-encoded, so slowly changing signals become runs of
+    small numbers, then stored as little-endian 32-bit integers, compressed
+    with zlib and base-64 encoded for transport in JSON.
+
+    Args:
+        values (numpy.ndarray): integer values
+
+    Returns:
+        packed (str): base-64 encoded compressed deltas
+    '''
+    deltas = np.diff(np.asarray(values, dtype=np.int64), prepend=0)
+    raw = deltas.astype("<i4").tobytes()
+    return str(base64.b64encode(zlib.compress(raw, 9)), encoding="utf-8")
+
+
+def unpack_ints(packed):
+    '''Restores the integers compressed by pack_ints().
+
+    Args:
+        packed (str): base-64 encoded compressed deltas
+
+    Returns:
+        values (numpy.ndarray): integer values
+    '''
+    raw = zlib.decompress(base64.b64decode(packed))
+    return np.cumsum(np.frombuffer(raw, dtype="<i4").astype(np.int64))
+
+
+def unpack_range(chunks, i0, i1):
+    '''Restores a range of integers packed in chunks.
+
+    Only the chunks overlapping [i0, i1) are decompressed.
+
+    Args:
+        chunks (list): chunks packed by pack_ints(), each WAVEFORM_CHUNK long
+            except possibly the last
+        i0 (int): index of the first value
+        i1 (int): index after the last value
+
+    Returns:
+        values (numpy.ndarray): integer values
+    '''
+    first, last = chunk_window(i0, i1)
+    values = np.concatenate([unpack_ints(chunk)
+                             for chunk in chunks[first:last + 1]])
+    offset = first * WAVEFORM_CHUNK
+    return values[i0 - offset:i1 - offset]
+
+
+def encode_waveform(time, flow, max_buckets=WAVEFORM_MAX_BUCKETS):
+    '''Encodes a flow-rate waveform as a multi-resolution min/max pyramid.
+
+    The recording is split into a power of two of equal time buckets, about
+    two samples per bucket up to max_buckets, and the minimum and maximum
+    flow rate of each bucket are kept so peaks survive the decimation.
+    Buckets without samples repeat the previous bucket. Each further level
+    merges pairs of buckets of the level below, down to a single bucket, so
+    any time range can be drawn from a level holding about as many buckets
+    as there are pixels. Values are quantized to 16-bit steps of the largest
+    absolute flow rate and every level is packed with pack_ints() in chunks
+    of WAVEFORM_CHUNK buckets, so a query only decompresses the chunks it
+    reads.
+
+    The encoded waveform is a dict with the following keys:
+
+    - t0, t1: times of the first and last samples (sec)
+    - buckets: number of buckets of the finest level
+    - scale: flow rate of one quantization step (L/sec)
+    - levels: list, finest level first, of dicts with the "min" and "max"
+      lists of packed chunks of each level
+
+    Args:
+        time (list): time values determined from datafile
+        flow (list): flow-rate values determined from datafile
+        max_buckets (int): maximum number of buckets of the finest level,
+            a power of two
+
+    Returns:
+        waveform (dict): encoded waveform, or None if there is no valid data
+    '''
+    t = np.asarray(time, dtype=float)
+    q = np.asarray(flow, dtype=float)
+    valid = ~np.isnan(q)
+    t, q = t[valid], q[valid]
+    if len(t) == 0:
+        return None
+    t0, t1 = float(t[0]), float(t[-1])
+    n = 1
+    while t1 > t0 and n < max_buckets and 4 * n <= len(t):
+        n *= 2
+    if t1 > t0:
+        index = np.minimum(((t - t0) / (t1 - t0) * n).astype(int), n - 1)
+    else:
+        index = np.zeros(len(t), dtype=int)
+    mins = np.full(n, np.inf)
+    maxs = np.full(n, -np.inf)
+    np.minimum.at(mins, index, q)
+    np.maximum.at(maxs, index, q)
+    filled = np.where(np.isinf(mins), 0, np.arange(n))
+    filled = np.maximum.accumulate(filled)
+    empty = np.isinf(mins[filled])
+    mins, maxs = mins[filled], maxs[filled]
+    mins[empty] = 0.0
+    maxs[empty] = 0.0
+    scale = float(max(np.abs(mins).max(), np.abs(maxs).max())) / 32767
+    scale = scale or 1.0
+    mins = np.round(mins / scale).astype(np.int64)
+    maxs = np.round(maxs / scale).astype(np.int64)
+    levels = []
+    while True:
+        levels.append({
+            "min": [pack_ints(mins[i:i + WAVEFORM_CHUNK])
+                    for i in range(0, len(mins), WAVEFORM_CHUNK)],
+            "max": [pack_ints(maxs[i:i + WAVEFORM_CHUNK])
+                    for i in range(0, len(maxs), WAVEFORM_CHUNK)]})
+        if len(mins) == 1:
+            break
+        mins = mins.reshape(-1, 2).min(1)
+        maxs = maxs.reshape(-1, 2).max(1)
+    return {"t0": t0,
+            "t1": t1,
+            "buckets": n,
+            "scale": scale,
+            "levels": levels}
+
+
+def waveform_window(waveform, t0=None, t1=None, points=800):
+    '''Selects the buckets of a stored waveform drawn for a time range.
+
+    The finest pyramid level with at most `points` buckets overlapping
+    [t0, t1] is selected. Only the "t0", "t1" and "buckets" keys of the
+    waveform are read, so the level can be chosen before its chunks are
+    fetched; the chunks read are those of chunk_window().
+
+    Args:
+        waveform (dict): waveform from encode_waveform(), possibly without
+            its "levels"
+        t0 (float): start of the range (sec), the recording start if None
+        t1 (float): end of the range (sec), the recording end if None
+        points (int): maximum number of buckets returned
+
+    Returns:
+        level (int): index of the level, 0 for the finest
+        i0 (int): index of the first bucket in the level
+        i1 (int): index after the last bucket in the level
+    '''
+    start, end = waveform["t0"], waveform["t1"]
+    t0 = start if t0 is None else max(t0, start)
+    t1 = end if t1 is None else min(t1, end)
+    points = max(int(points), 1)
+    n = waveform["buckets"]
+    width = (end - start) / n if end > start else 1.0
+    level = 0
+    while True:
+        i0 = min(max(int((t0 - start) // width), 0), n - 1)
+        i1 = max(min(int(math.ceil((t1 - start) / width)), n), i0 + 1)
+        if i1 - i0 <= points or n == 1:
+            return level, i0, i1
+        level += 1
+        n //= 2
+        width *= 2
+
+
+def chunk_window(i0, i1):
+    '''Returns the chunks of a level holding the buckets [i0, i1).
+
+    Args:
+        i0 (int): index of the first bucket
+        i1 (int): index after the last bucket
+
+    Returns:
+        first (int): index of the first chunk
+        last (int): index of the last chunk
+    '''
+    return i0 // WAVEFORM_CHUNK, (i1 - 1) // WAVEFORM_CHUNK
+
+
+def query_waveform(waveform, t0=None, t1=None, points=800):
+    '''Returns the min/max envelope of a stored waveform over a time range.
+
+    The finest pyramid level with at most `points` buckets overlapping
+    [t0, t1] is selected by waveform_window() and only those buckets are
+    decoded, so the work grows with the number of points rather than the
+    length of the recording. The other levels, and the chunks of the level
+    before chunk_window(), are not read and may be None; later chunks may
+    be missing. Each returned
+    bucket holds the minimum and maximum flow rate of the samples it covers,
+    which is what a plot needs to draw one pixel column.
+
+    Args:
+        waveform (dict): waveform from encode_waveform()
+        t0 (float): start of the range (sec), the recording start if None
+        t1 (float): end of the range (sec), the recording end if None
+        points (int): maximum number of buckets returned
+
+    Returns:
+        envelope (dict): "t0" and "t1" of the returned buckets and their
+        "min" and "max" flow rates (L/sec)
+    '''
+    level, i0, i1 = waveform_window(waveform, t0, t1, points)
+    start, end = waveform["t0"], waveform["t1"]
+    n = waveform["buckets"]
+    width = ((end - start) / n if end > start else 1.0) * 2 ** level
+    scale = waveform["scale"]
+    mins = unpack_range(waveform["levels"][level]["min"], i0, i1) * scale
+    maxs = unpack_range(waveform["levels"][level]["max"], i0, i1) * scale
+    return {"t0": start + i0 * width,
+            "t1": start + i1 * width,
+            "min": [round(float(x), 3) for x in mins],
+            "max": [round(float(x), 3) for x in maxs]}
+
+
+def process_cpap_data(file, plot_filename=PLOT_FILENAME, progress=None):
     """
     Process the CPAP data from the given file path.
 
+    The flow rate versus time plot is drawn on a standalone matplotlib Figure
+    rather than through pyplot, so the analysis can run on a worker thread or
+    in a worker process.
+
     Args:
-        file (str): The path to the CPAP data file.
+        file (file): The opened CPAP data file.
+        plot_filename (str): Path the flow rate plot is saved to.
+        progress (callable): Optional function called every 1000 lines with
+            the number of characters parsed so far.
 
     Returns:
-        dict: A dictionary containing breath rate and apnea count.
+        tuple: The plot filename and a dictionary containing breath rate,
+        apnea count and the flow-rate waveform from encode_waveform().
     """
     Q, time = [], []
-    for line in file:
+    parsed = 0
+    for i, line in enumerate(file):
+        parsed += len(line)
+        if progress is not None and i % 1000 == 0:
+            progress(parsed)
         data = parse_line(line)
         if data is None:
             logging.error("Incorrect/missing data, skipping entry.")
@@ -286,17 +651,18 @@ def process_cpap_data(file):
         logging.warning("Leakage is negative.")
     result = {
         "breath_rate_bpm": metrics["breath_rate_bpm"],
-        "apnea_count": metrics["apnea_count"]
+        "apnea_count": metrics["apnea_count"],
+        "flow_waveform": encode_waveform(time, Q)
     }
 
     # Generate and save plot
-    plt.figure()
-    plt.plot(time, Q)
-    plt.xlabel('Time (s)')
-    plt.ylabel('Flow Rate (L/sec)')
-    plt.title('Flow Rate vs Time')
-    plot_filename = "flow_rate_vs_time_plot.png"
-    plt.savefig(plot_filename)
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.plot(time, Q)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Flow Rate (L/sec)')
+    ax.set_title('Flow Rate vs Time')
+    fig.savefig(plot_filename)
 
     return plot_filename, result
 
@@ -1,75 +1,388 @@
-from pymodm import connect, MongoModel, fields
+from pymodm import connect, MongoModel, EmbeddedMongoModel, fields
+from pymodm.manager import Manager
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timezone
+import argparse
+import logging
+import os
 import ssl
+import threading
+
+# Connection string of the database, which must name the database to use.
+# The default is the production cluster.
+DEFAULT_MONGODB_URI = "mongodb+srv://LucasR23:FinalProject" + \
+    "@bme547cluster.oppvfea.mongodb.net/" + \
+    "SleepLabRooms?retryWrites=true&w=majority" + \
+    "&tlsAllowInvalidCertificates=true"
+MONGODB_URI = os.environ.get("MONGODB_URI", DEFAULT_MONGODB_URI)
+
+connection_lock = threading.Lock()
+connected = False
 
 
 def init_mongo_db():
-    connect(
-        "mongodb+srv://LucasR23:FinalProject" +
-        "@bme547cluster.oppvfea.mongodb.net/" +
-        "SleepLabRooms?retryWrites=true&w=majority",
-        tlsAllowInvalidCertificates=True
-    )
+    # Registers the database connection, once. Creating the client resolves
+    # the cluster address over the network, so it is left to the first query
+    # rather than done when this module is imported.
+    global connected
+    if connected:
+        return
+    with connection_lock:
+        if not connected:
+            connect(MONGODB_URI)
+            connected = True
+
+
+def get_collection(model):
+    # Returns the pymongo collection of a model, connecting first if needed.
+    init_mongo_db()
+    return model._mongometa.collection
+
+
+class LazyManager(Manager):
+    # Default manager of the models, connecting to the database on first use.
+    def get_queryset(self):
+        init_mongo_db()
+        return super().get_queryset()
+
+
+class CpapCalculation(EmbeddedMongoModel):
+    # One analysis of a night of CPAP data. The timestamp is kept as the
+    # string it was uploaded with, since the clients use it as a key, and is
+    # also stored parsed in recorded_at for range queries.
+    timestamp = fields.CharField()
+    recorded_at = fields.DateTimeField(blank=True)
+    breath_rate_bpm = fields.FloatField(blank=True)
+    apnea_count = fields.IntegerField(blank=True)
+    image = fields.CharField(blank=True)
+
+    class Meta:
+        final = True
 
 
 class SleepLabRooms(MongoModel):
+    objects = LazyManager()
     room_number = fields.IntegerField(primary_key=True)
     patient_name = fields.CharField()
     patient_mrn = fields.IntegerField()
     cpap_pressure = fields.IntegerField()
-    cpap_calculations = cpap_calculations = fields.ListField(
-        field=fields.ListField())
+    cpap_calculations = fields.EmbeddedDocumentListField(CpapCalculation,
+                                                         blank=True)
+    # Summary of the newest calculation, kept up to date on upload so the
+    # ward dashboard does not need to read the calculation history.
+    latest_calculation = fields.DictField(blank=True)
+    # Running metrics of the samples streamed in during the current session.
+    live_metrics = fields.DictField(blank=True)
 
+    class Meta:
+        # Calculations are selected by room and time. The unique MRN index
+        # is built by create_mrn_index, since pymodm would retry a failing
+        # index on every use of the collection.
+        indexes = [IndexModel([("_id", ASCENDING),
+                               ("cpap_calculations.recorded_at",
+                                ASCENDING)])]
 
-def add_new_room(room_number_arg, patient_name_arg, patient_mrn_arg,
-                 cpap_pressure_arg, cpap_calculations_arg):
-    room = SleepLabRooms(room_number=room_number_arg,
+
+class ArchivedCalculations(MongoModel):
+    # Full copy, image included, of a calculation compacted out of a room
+    # document by the retention policy.
+    objects = LazyManager()
+    room_number = fields.IntegerField()
+    timestamp = fields.CharField()
+    calculation = fields.EmbeddedDocumentField(CpapCalculation)
+
+    class Meta:
+        # Archives are written with raw upserts, so no _cls field is stored.
+        final = True
+        indexes = [IndexModel([("room_number", ASCENDING),
+                               ("timestamp", ASCENDING)], unique=True)]
+
+
+class DailySummaries(MongoModel):
+    # Totals of the compacted calculations of a room recorded on one day.
+    # Means are the sums divided by the counts of calculations that had a
+    # value. The timestamps of the rolled up calculations make adding a
+    # calculation twice a no-op.
+    objects = LazyManager()
+    room_number = fields.IntegerField()
+    day = fields.DateTimeField()
+    count = fields.IntegerField()
+    breath_rate_sum = fields.FloatField()
+    breath_rate_count = fields.IntegerField()
+    breath_rate_max = fields.FloatField(blank=True)
+    apnea_count_sum = fields.IntegerField()
+    apnea_count_count = fields.IntegerField()
+    apnea_count_max = fields.IntegerField(blank=True)
+    timestamps = fields.ListField(field=fields.CharField())
+
+    class Meta:
+        # Summaries are written with raw upserts, so no _cls field is stored.
+        final = True
+        indexes = [IndexModel([("room_number", ASCENDING),
+                               ("day", ASCENDING)], unique=True)]
+
+
+class TaskLeases(MongoModel):
+    # Lease of a background task that only one server process may run at a
+    # time, such as the history compaction. The key is the name of the task.
+    objects = LazyManager()
+    name = fields.CharField(primary_key=True)
+    holder = fields.CharField()
+    expires_at = fields.DateTimeField()
+
+    class Meta:
+        # Leases are written with raw upserts, so no _cls field is stored.
+        final = True
+
+
+def parse_timestamp(timestamp):
+    # Parses an ISO 8601 timestamp into a naive datetime. A timestamp with a
+    # UTC offset is converted to UTC, so every stored and queried time can be
+    # compared with every other. ValueError is raised if the timestamp
+    # cannot be parsed.
+    time = datetime.fromisoformat(timestamp)
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def make_calculation(cpap_calculation):
+    # Converts a [timestamp, breath rate, apnea count, image] list, the form
+    # in which clients upload calculations, into a CpapCalculation. None is
+    # returned if the list is not in that form.
+    if type(cpap_calculation) is not list or len(cpap_calculation) != 4:
+        return None
+    timestamp, breath_rate, apnea_count, image = cpap_calculation
+    if type(timestamp) is not str \
+            or type(breath_rate) not in (int, float, type(None)) \
+            or type(apnea_count) not in (int, type(None)) \
+            or type(image) not in (str, type(None)):
+        return None
+    try:
+        recorded_at = parse_timestamp(timestamp)
+    except ValueError:
+        recorded_at = None
+    return CpapCalculation(timestamp=timestamp, recorded_at=recorded_at,
+                           breath_rate_bpm=breath_rate,
+                           apnea_count=apnea_count, image=image)
+
+
+def calculation_to_list(calculation):
+    # Converts a CpapCalculation back into the list form sent to clients.
+    # Entries of rooms that have not been migrated yet are still lists.
+    if not isinstance(calculation, CpapCalculation):
+        return list(calculation)
+    return [calculation.timestamp, calculation.breath_rate_bpm,
+            calculation.apnea_count, calculation.image]
+
+
+class SampleBuckets(MongoModel):
+    # Raw 7-column CPAP samples streamed from a bedside device, grouped into
+    # one document per room, recording session and minute of recording time.
+    objects = LazyManager()
+    room_number = fields.IntegerField()
+    session_id = fields.CharField()
+    minute = fields.IntegerField()
+    count = fields.IntegerField()
+    samples = fields.ListField(field=fields.ListField())
+
+    class Meta:
+        # Buckets are written with raw upserts, so no _cls field is stored.
+        final = True
+        indexes = [IndexModel([("room_number", ASCENDING),
+                               ("session_id", ASCENDING),
+                               ("minute", ASCENDING)], unique=True)]
+
+
+class Waveforms(MongoModel):
+    # Compact flow-rate waveform of a CPAP calculation, stored apart from the
+    # room document so fetching a patient does not carry it. The waveform is
+    # the dict built by CPAP_measurement.encode_waveform.
+    objects = LazyManager()
+    room_number = fields.IntegerField()
+    timestamp = fields.CharField()
+    waveform = fields.DictField()
+
+    class Meta:
+        # Waveforms are written with raw upserts, so no _cls field is stored.
+        final = True
+        indexes = [IndexModel([("room_number", ASCENDING),
+                               ("timestamp", ASCENDING)], unique=True)]
+
+
+class CalculationImages(MongoModel):
+    # Flow-rate plot of a CPAP calculation, uploaded as raw bytes by
+    # PUT /patient/image instead of base64 inside the calculation.
+    objects = LazyManager()
+    room_number = fields.IntegerField()
+    timestamp = fields.CharField()
+    content_type = fields.CharField()
+    data = fields.BinaryField()
+
+    class Meta:
+        # Images are written with raw upserts, so no _cls field is stored.
+        final = True
+        indexes = [IndexModel([("room_number", ASCENDING),
+                               ("timestamp", ASCENDING)], unique=True)]
+
+
+class CalculationThumbnails(MongoModel):
+    # Scaled-down copy of a CalculationImages plot, generated on the first
+    # request for its size and dropped when the plot is replaced.
+    objects = LazyManager()
+    room_number = fields.IntegerField()
+    timestamp = fields.CharField()
+    size = fields.IntegerField()
+    data = fields.BinaryField()
+
+    class Meta:
+        final = True
+        indexes = [IndexModel([("room_number", ASCENDING),
+                               ("timestamp", ASCENDING),
+                               ("size", ASCENDING)], unique=True)]
+
+
+# Demo patients loaded by `python DB_init.py seed`.
+SEED_ROOMS = [
+    (1, "John Doe", 100, 15,
+     [["2023-11-29T10:00:00", 18, 2, "image1.png"],
+      ["2023-11-29T12:00:00", 17, 3, "image2.png"]]),
+    (2, "Jane Smith", 101, 10,
+     [["2023-11-29T11:00:00", 16, 1, "image3.png"],
+      ["2023-11-29T13:00:00", 15, 2, "image4.png"]]),
+    (3, "Alice Johnson", 102, 12,
+     [["2023-11-29T09:30:00", 19, 2, "image5.png"],
+      ["2023-11-29T11:30:00", 18, 4, "image6.png"]]),
+    (4, "Bob Brown", 103, 14,
+     [["2023-11-29T08:45:00", 20, 1, "image7.png"],
+      ["2023-11-29T10:45:00", 17, 3, "image8.png"]]),
+]
+
+
+def make_room(room_number_arg, patient_name_arg, patient_mrn_arg,
+              cpap_pressure_arg, cpap_calculations_arg):
+    return SleepLabRooms(room_number=room_number_arg,
                          patient_name=patient_name_arg,
                          patient_mrn=patient_mrn_arg,
                          cpap_pressure=cpap_pressure_arg,
-                         cpap_calculations=cpap_calculations_arg)
-    room.save()
+                         cpap_calculations=[make_calculation(calculation)
+                                            for calculation
+                                            in cpap_calculations_arg])
+
+
+def add_new_room(room_number_arg, patient_name_arg, patient_mrn_arg,
+                 cpap_pressure_arg, cpap_calculations_arg):
+    init_mongo_db()
+    make_room(room_number_arg, patient_name_arg, patient_mrn_arg,
+              cpap_pressure_arg, cpap_calculations_arg).save()
     print("Saved to database")
 
 
-def get_users():
-    for room in SleepLabRooms.objects.raw({}):
-        print(SleepLabRooms.room_number)
-        print(SleepLabRooms.patient_name)
-    return
+def seed_db():
+    # Replaces every room with the demo patients in two round trips. The
+    # production cluster is never seeded: MONGODB_URI must be set.
+    if MONGODB_URI == DEFAULT_MONGODB_URI:
+        raise RuntimeError("Set MONGODB_URI to the database to seed.")
+    collection = get_collection(SleepLabRooms)
+    collection.delete_many({})
+    collection.insert_many([make_room(*room).to_son().to_dict()
+                            for room in SEED_ROOMS])
+    return len(SEED_ROOMS)
+
+
+# Collections holding data of a room besides its SleepLabRooms document.
+ROOM_DATA_MODELS = (SampleBuckets, Waveforms, CalculationImages,
+                    CalculationThumbnails, ArchivedCalculations,
+                    DailySummaries)
+
+
+def delete_room_data(*room_numbers):
+    # Removes everything stored for the rooms besides their room documents,
+    # so that nothing of a previous patient is shown to the next one.
+    if not room_numbers:
+        return
+    for model in ROOM_DATA_MODELS:
+        get_collection(model).delete_many(
+            {"room_number": {"$in": list(room_numbers)}})
+
+
+def create_indexes():
+    # pymodm creates the indexes of a model the first time its collection is
+    # used. Touching every collection at startup moves that work out of the
+    # first requests. Existing indexes are left untouched.
+    for model in (SleepLabRooms,) + ROOM_DATA_MODELS:
+        get_collection(model)
+    create_mrn_index()
+
 
+def duplicate_mrns():
+    # Returns the MRNs found in more than one room, each with its rooms.
+    collection = get_collection(SleepLabRooms)
+    return {group["_id"]: group["rooms"] for group in collection.aggregate([
+        {"$group": {"_id": "$patient_mrn", "rooms": {"$push": "$_id"},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}])}
 
-def populate_db():
-    all = SleepLabRooms.objects.raw({})
-    for x in all:
-        x.delete()
-    # Room 1
-    all = SleepLabRooms.objects.raw({})
-    for x in all:
-        x.delete()
 
-    add_new_room(1, "John Doe", 100, 15,
-                 [["2023-11-29T10:00:00", 18, 2, "image1.png"],
-                  ["2023-11-29T12:00:00", 17, 3, "image2.png"]])
+def create_mrn_index():
+    # Rooms are looked up by MRN on upload and reset, and a patient is in
+    # one room only. Databases written before the unique index existed may
+    # hold an MRN in several rooms, which would make building the index
+    # fail. Such databases get a plain lookup index instead, and an error
+    # is logged until `python DB_init.py dedupe-mrns` is run. Returns
+    # whether the unique index exists.
+    collection = get_collection(SleepLabRooms)
+    try:
+        collection.create_index([("patient_mrn", ASCENDING)], unique=True,
+                                name="patient_mrn_1")
+    except DuplicateKeyError:
+        logging.error("MRNs in several rooms, run `python DB_init.py "
+                      "dedupe-mrns`: %s", duplicate_mrns())
+        collection.create_index([("patient_mrn", ASCENDING)],
+                                name="patient_mrn_lookup")
+        return False
+    if "patient_mrn_lookup" in collection.index_information():
+        collection.drop_index("patient_mrn_lookup")
+    return True
 
-    # Room 2
-    add_new_room(2, "Jane Smith", 101, 10,
-                 [["2023-11-29T11:00:00", 16, 1, "image3.png"],
-                  ["2023-11-29T13:00:00", 15, 2, "image4.png"]])
 
-    # Room 3
-    add_new_room(3, "Alice Johnson", 102, 12,
-                 [["2023-11-29T09:30:00", 19, 2, "image5.png"],
-                  ["2023-11-29T11:30:00", 18, 4, "image6.png"]])
+def dedupe_mrns():
+    # Keeps each duplicated MRN in the room with the newest calculation,
+    # the one its uploads went to last, and deletes the other rooms along
+    # with their data. Returns the deleted room numbers.
+    collection = get_collection(SleepLabRooms)
+    deleted = []
+    for patient_mrn in duplicate_mrns():
+        rooms = [room["_id"] for room in collection.find(
+            {"patient_mrn": patient_mrn}, {"_id": 1}).sort(
+            [("latest_calculation.timestamp", DESCENDING),
+             ("_id", ASCENDING)])]
+        for room_number in rooms[1:]:
+            collection.delete_one({"_id": room_number,
+                                   "patient_mrn": patient_mrn})
+            delete_room_data(room_number)
+            deleted.append(room_number)
+    create_mrn_index()
+    return deleted
 
-    # Room 4
-    add_new_room(4, "Bob Brown", 103, 14,
-                 [["2023-11-29T08:45:00", 20, 1, "image7.png"],
-                  ["2023-11-29T10:45:00", 17, 3, "image8.png"]])
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="Manage the CPAP sleep lab database.")
+    parser.add_argument("command",
+                        choices=["seed", "create-indexes", "dedupe-mrns"],
+                        help="seed: replace all rooms with demo patients; "
+                             "create-indexes: create missing indexes; "
+                             "dedupe-mrns: keep each MRN in its newest "
+                             "room only")
+    args = parser.parse_args()
+    create_indexes()
+    if args.command == "seed":
+        print("Seeded {} rooms".format(seed_db()))
+    elif args.command == "dedupe-mrns":
+        print("Deleted rooms {}".format(dedupe_mrns()))
 
-init_mongo_db()
-populate_db()
-get_users()
 
 if __name__ == "__main__":
-    patient = SleepLabRooms.objects.raw({"_id": 4}).first()
+    main()
@@ -0,0 +1,197 @@
+import base64
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import shutil
+import threading
+import uuid
+from CPAP_measurement import process_cpap_data
+
+
+def run_analysis(data_path, work_dir, job_id, progress_table):
+    """Analyzes a CPAP data file inside a worker process.
+
+    The file is processed with `process_cpap_data`, the flow rate plot is
+    written to the job's working directory and returned as a base-64 string.
+    The fraction of the file parsed so far is published in the shared
+    progress table under the job ID.
+
+    Parameters
+    ----------
+    data_path : str
+        path of the uploaded CPAP data file
+    work_dir : str
+        working directory of the job
+    job_id : str
+        ID of the job
+    progress_table : dict proxy
+        table shared with the server process
+
+    Returns
+    -------
+    dict
+        breathing rate, apnea count, compact flow rate waveform and base-64
+        encoded flow rate plot
+    """
+    size = max(os.path.getsize(data_path), 1)
+
+    def progress(parsed):
+        progress_table[job_id] = min(parsed / size, 1.0)
+
+    with open(data_path, "r") as file:
+        plot_filename, results = process_cpap_data(
+            file, os.path.join(work_dir, "flow_rate_vs_time_plot.png"),
+            progress)
+    progress_table[job_id] = 1.0
+    with open(plot_filename, "rb") as image_file:
+        image = str(base64.b64encode(image_file.read()), encoding="utf-8")
+    return {"breath_rate_bpm": results["breath_rate_bpm"],
+            "apnea_count": results["apnea_count"],
+            "flow_waveform": results["flow_waveform"],
+            "image": image}
+
+
+class AnalysisJobs:
+    """Bounded pool of server-side CPAP analysis jobs.
+
+    Jobs run `run_analysis` in a pool of worker processes, which are started
+    with the spawn method on first use so they never inherit the server's
+    database connections or threads. At most `max_pending` jobs may be queued
+    or running at once; further submissions are refused so a burst of uploads
+    cannot grow the queue without limit. The state of the last `history` jobs
+    is kept for the status route.
+
+    Parameters
+    ----------
+    max_workers : int
+        number of worker processes
+    max_pending : int
+        maximum number of queued and running jobs
+    history : int
+        number of jobs whose state is kept
+    """
+
+    def __init__(self, max_workers, max_pending, history=500):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.history = history
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._manager = None
+        self._progress = None
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        self._manager = context.Manager()
+        self._progress = self._manager.dict()
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            self.max_workers, mp_context=context)
+
+    def pending(self):
+        """Returns the number of queued and running jobs.
+
+        Returns
+        -------
+        int
+            number of unfinished jobs
+        """
+        with self._lock:
+            return self._unfinished()
+
+    def _unfinished(self):
+        return sum(1 for job in self._jobs.values()
+                   if job["status"] in ("queued", "running"))
+
+    def submit(self, data_path, work_dir, room_number, on_complete):
+        """Queues a CPAP data file for analysis.
+
+        `on_complete(result)` is called from a pool thread with the result of
+        `run_analysis` once the job succeeds, and the working directory is
+        removed once the job has finished either way.
+
+        Parameters
+        ----------
+        data_path : str
+            path of the uploaded CPAP data file
+        work_dir : str
+            working directory of the job, owned by the job from now on
+        room_number : int
+            room number of the patient
+        on_complete : callable
+            function storing the result
+
+        Returns
+        -------
+        str or None
+            ID of the new job, or None if the queue is full
+        """
+        with self._lock:
+            if self._unfinished() >= self.max_pending:
+                return None
+            if self._executor is None:
+                self._start()
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {"job_id": job_id,
+                                  "status": "queued",
+                                  "room_number": room_number,
+                                  "result": None,
+                                  "error": None}
+            self._progress[job_id] = 0.0
+            while len(self._jobs) > self.history:
+                old_id, _old = self._jobs.popitem(last=False)
+                self._progress.pop(old_id, None)
+        future = self._executor.submit(run_analysis, data_path, work_dir,
+                                       job_id, self._progress)
+        future.add_done_callback(
+            lambda future: self._finish(job_id, future, work_dir,
+                                        on_complete))
+        return job_id
+
+    def _finish(self, job_id, future, work_dir, on_complete):
+        error = future.exception()
+        result = None
+        if error is None:
+            result = future.result()
+            try:
+                on_complete(result)
+            except Exception as store_error:
+                error = store_error
+        shutil.rmtree(work_dir, ignore_errors=True)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if error is None:
+                job["status"] = "done"
+                job["result"] = result
+            else:
+                job["status"] = "failed"
+                job["error"] = "{}: {}".format(type(error).__name__, error)
+
+    def status(self, job_id):
+        """Returns the state of a job.
+
+        Parameters
+        ----------
+        job_id : str
+            ID of the job
+
+        Returns
+        -------
+        dict or None
+            status ("queued", "running", "done" or "failed"), progress as a
+            fraction of the file parsed, result and error message, or None
+            if the job is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+        progress = self._progress.get(job_id, 1.0)
+        if job["status"] == "queued" and progress > 0.0:
+            job["status"] = "running"
+        job["progress"] = 1.0 if job["status"] == "done" else progress
+        return job
@@ -0,0 +1,246 @@
+import argparse
+import math
+import os
+import threading
+import time
+import requests
+
+
+def percentile(values, fraction):
+    """Returns a percentile of a list of numbers.
+
+    The nearest-rank method is used, so the result is always one of the
+    input values.
+
+    Parameters
+    ----------
+    values : list of float
+        measured values
+    fraction : float
+        percentile as a fraction between 0 and 1
+
+    Returns
+    -------
+    float or None
+        the percentile, or None if no values were given
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+def poll_client(server, route, rooms, conditional, stop_at, results,
+                headers=None):
+    """Polls a route for a set of rooms as fast as possible.
+
+    Each request cycles to the next room. When `conditional` is True, the
+    ETag of the last response for a room is sent back in `If-None-Match`, as
+    the GUI clients do. Latencies of successful requests (200 or 304), the
+    number of body bytes received on the wire and the number of failed
+    requests are added to `results`.
+
+    Parameters
+    ----------
+    server : str
+        base URL of the server
+    route : str
+        route prefix, the room number is appended to it
+    rooms : list of int
+        room numbers to poll
+    conditional : bool
+        send `If-None-Match` headers
+    stop_at : float
+        `time.perf_counter()` value at which polling stops
+    results : dict
+        "latencies" list, "bytes" and "errors" counts shared by all clients
+    headers : dict or None
+        headers sent with every request, such as `Accept` and
+        `Accept-Encoding`
+
+    Returns
+    -------
+    None
+    """
+    session = requests.Session()
+    etags = {}
+    latencies = []
+    received = 0
+    errors = 0
+    i = 0
+    while time.perf_counter() < stop_at:
+        room = rooms[i % len(rooms)]
+        i += 1
+        request_headers = dict(headers or {})
+        if conditional and room in etags:
+            request_headers["If-None-Match"] = etags[room]
+        start = time.perf_counter()
+        try:
+            r = session.get(server + route + str(room),
+                            headers=request_headers, stream=True)
+            body = r.raw.read()
+        except requests.exceptions.RequestException:
+            errors += 1
+            continue
+        if r.status_code not in (200, 304):
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        received += len(body)
+        if r.headers.get("ETag"):
+            etags[room] = r.headers["ETag"]
+    with results["lock"]:
+        results["latencies"].extend(latencies)
+        results["bytes"] += received
+        results["errors"] += errors
+
+
+def run_benchmark(server, route, rooms, clients, duration, conditional,
+                  headers=None):
+    """Runs concurrent polling clients against a server.
+
+    Parameters
+    ----------
+    server : str
+        base URL of the server
+    route : str
+        route prefix, the room number is appended to it
+    rooms : list of int
+        room numbers to poll
+    clients : int
+        number of concurrent clients
+    duration : float
+        length of the run in seconds
+    conditional : bool
+        send `If-None-Match` headers
+    headers : dict or None
+        headers sent with every request
+
+    Returns
+    -------
+    dict
+        requests per second, p50 and p99 latency in ms, mean body size in
+        bytes as received and error count
+    """
+    results = {"latencies": [], "bytes": 0, "errors": 0,
+               "lock": threading.Lock()}
+    stop_at = time.perf_counter() + duration
+    threads = [threading.Thread(target=poll_client,
+                                args=(server, route, rooms, conditional,
+                                      stop_at, results, headers))
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = results["latencies"]
+    return {"requests_per_second": round(len(latencies) / duration, 1),
+            "p50_ms": round(1000 * (percentile(latencies, 0.5) or 0), 2),
+            "p99_ms": round(1000 * (percentile(latencies, 0.99) or 0), 2),
+            "mean_bytes": round(results["bytes"] / max(len(latencies), 1)),
+            "errors": results["errors"]}
+
+
+def start_local_server(storage, db_delay=0.0):
+    """Starts the app in a background thread of this process.
+
+    The app is served by the threaded Werkzeug server on a free local port,
+    with the room storage selected by `storage` as for CPAP_STORAGE. With
+    "mongo" and MONGODB_URI unset, the storage runs on the in-memory MongoDB
+    stand-in of `mongo_standin`, which waits `db_delay` seconds in every
+    query to model the round trip to the cluster. Otherwise MONGODB_URI
+    should point to a local MongoDB rather than the production cluster.
+
+    Parameters
+    ----------
+    storage : str
+        storage specification, such as "mongo" or "sqlite:/tmp/load.db"
+    db_delay : float
+        seconds added to every query of the MongoDB stand-in
+
+    Returns
+    -------
+    str
+        base URL of the server
+    """
+    os.environ["CPAP_STORAGE"] = storage
+    if storage == "mongo" and "MONGODB_URI" not in os.environ:
+        from mongo_standin import use_mongo_standin, STANDIN_MONGODB_URI
+        use_mongo_standin(db_delay)
+        os.environ["MONGODB_URI"] = STANDIN_MONGODB_URI
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server.prepare_store()
+    httpd = make_server("127.0.0.1", 0, server.app, threaded=True,
+                        request_handler=QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(httpd.server_port)
+
+
+def seed_local_server():
+    """Stores the demo patients of `DB_init.SEED_ROOMS` in the app started
+    by `start_local_server`.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    from DB_init import SEED_ROOMS
+    import server
+    for room_number, name, mrn, pressure, calculations in SEED_ROOMS:
+        for calculation in calculations:
+            server.store.save_upload(room_number, mrn, name, pressure,
+                                     calculation)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure polling throughput of the CPAP server.")
+    parser.add_argument("--server",
+                        help="base URL of a running server; the app is "
+                             "started in this process with the demo "
+                             "patients if missing")
+    parser.add_argument("--storage", default="mongo",
+                        help="CPAP_STORAGE of the in-process server")
+    parser.add_argument("--db-delay", type=float, default=0.0,
+                        help="seconds added to every query of the "
+                             "in-process MongoDB stand-in")
+    parser.add_argument("--route", default="/patient/fetch_pressure/")
+    parser.add_argument("--rooms", default="1,2,3,4")
+    parser.add_argument("--clients", type=int, nargs="+",
+                        default=[1, 8, 32, 64])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--conditional", action="store_true")
+    parser.add_argument("--accept", default="application/json",
+                        help="Accept header, e.g. application/msgpack")
+    parser.add_argument("--accept-encoding", default="identity",
+                        help="Accept-Encoding header, e.g. br or gzip")
+    args = parser.parse_args()
+    server = args.server
+    if server is None:
+        server = start_local_server(args.storage, args.db_delay)
+        seed_local_server()
+    rooms = [int(room) for room in args.rooms.split(",")]
+    headers = {"Accept": args.accept,
+               "Accept-Encoding": args.accept_encoding}
+    print("clients  req/s  p50_ms  p99_ms  bytes  errors")
+    for clients in args.clients:
+        result = run_benchmark(server, args.route, rooms, clients,
+                               args.duration, args.conditional, headers)
+        print("{:>7}  {:>5}  {:>6}  {:>6}  {:>5}  {:>6}".format(
+            clients, result["requests_per_second"], result["p50_ms"],
+            result["p99_ms"], result["mean_bytes"], result["errors"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import os
+import pytest
+
+# Tests marked `mongo` run against the database named by
+# CPAP_TEST_MONGODB_URI, which they empty and seed with the demo patients.
+# They are skipped when it is not set. The other tests must not reach a
+# database, so MONGODB_URI is pointed at the test database, or at a local
+# address that fails fast, and never at the production cluster.
+TEST_MONGODB_URI = os.environ.get("CPAP_TEST_MONGODB_URI")
+os.environ["MONGODB_URI"] = TEST_MONGODB_URI or \
+    "mongodb://127.0.0.1:9/cpap_test?serverSelectionTimeoutMS=100"
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "mongo: needs the MongoDB database of "
+                   "CPAP_TEST_MONGODB_URI")
+
+
+def pytest_collection_modifyitems(config, items):
+    if TEST_MONGODB_URI:
+        return
+    skip = pytest.mark.skip(reason="CPAP_TEST_MONGODB_URI is not set")
+    for item in items:
+        if "mongo" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="module")
+def seeded_db():
+    from DB_init import seed_db
+    seed_db()
+
+
+@pytest.fixture(autouse=True)
+def mongo_db(request):
+    # Seeds the test database once per module for the tests marked `mongo`.
+    if request.node.get_closest_marker("mongo") is not None:
+        request.getfixturevalue("seeded_db")
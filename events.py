@@ -0,0 +1,229 @@
+import collections
+import json
+import threading
+import uuid
+
+
+class EventChannel:
+    """In-process publish/subscribe channel backing the server event streams.
+
+    Published events are kept in a bounded buffer together with a sequence
+    number. Subscribers block on the channel until an event newer than the
+    last one they saw is available, which lets a reconnecting client resume
+    from its last event ID as long as that event is still buffered. Event IDs
+    carry a boot token so IDs issued by an earlier server process are never
+    mistaken for resumable positions.
+
+    Parameters
+    ----------
+    maxlen : int
+        number of events kept for resuming clients
+    """
+
+    def __init__(self, maxlen=1000):
+        self.boot_token = uuid.uuid4().hex[:8]
+        self._events = collections.deque(maxlen=maxlen)
+        self._seq = 0
+        self._condition = threading.Condition()
+
+    def publish(self, event, data):
+        """Appends an event to the channel and wakes all subscribers.
+
+        Parameters
+        ----------
+        event : str
+            event type, sent as the SSE `event` field
+        data : dict
+            JSON serializable event payload
+
+        Returns
+        -------
+        int
+            sequence number of the new event
+        """
+        with self._condition:
+            self._seq += 1
+            self._events.append((self._seq, event, data))
+            self._condition.notify_all()
+            return self._seq
+
+    def latest_seq(self):
+        """Returns the sequence number of the newest published event.
+
+        Returns
+        -------
+        int
+            sequence number, 0 if nothing has been published
+        """
+        with self._condition:
+            return self._seq
+
+    def format_id(self, seq):
+        """Builds the SSE event ID for a sequence number.
+
+        Parameters
+        ----------
+        seq : int
+            sequence number
+
+        Returns
+        -------
+        str
+            event ID of the form `<boot token>-<sequence number>`
+        """
+        return "{}-{}".format(self.boot_token, seq)
+
+    def resume_point(self, event_id):
+        """Converts a client's last event ID into a resumable position.
+
+        None is returned if the ID is missing, malformed, was issued by
+        another server process or refers to an event that has already left
+        the buffer. In those cases the caller should send the client a fresh
+        snapshot instead of replaying events.
+
+        Parameters
+        ----------
+        event_id : str or None
+            value of the `Last-Event-ID` header
+
+        Returns
+        -------
+        int or None
+            sequence number to resume after, or None
+        """
+        if not event_id:
+            return None
+        boot_token, _, seq = event_id.partition("-")
+        if boot_token != self.boot_token:
+            return None
+        try:
+            seq = int(seq)
+        except ValueError:
+            return None
+        with self._condition:
+            if seq > self._seq:
+                return None
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            if seq < oldest - 1:
+                return None
+        return seq
+
+    def wait(self, seq, timeout):
+        """Returns the events published after a sequence number.
+
+        Blocks for up to `timeout` seconds if no such event is available yet.
+        An empty list is returned on timeout.
+
+        Parameters
+        ----------
+        seq : int
+            sequence number of the last event seen by the caller
+        timeout : float
+            maximum number of seconds to wait
+
+        Returns
+        -------
+        list of tuple
+            (sequence number, event type, data) for each new event
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._seq > seq, timeout)
+            return [entry for entry in self._events if entry[0] > seq]
+
+
+def format_sse(event_id, event, data):
+    """Formats an event as a Server-Sent Events message.
+
+    Parameters
+    ----------
+    event_id : str
+        event ID, sent so clients can resume with `Last-Event-ID`
+    event : str
+        event type
+    data : dict
+        JSON serializable event payload
+
+    Returns
+    -------
+    str
+        SSE message terminated by a blank line
+    """
+    message = "id: {}\nevent: {}\ndata: {}\n\n"
+    return message.format(event_id, event, json.dumps(data))
+
+
+def parse_sse_lines(lines):
+    """Parses Server-Sent Events messages from an iterable of text lines.
+
+    This is the client side of `format_sse`, shared by the GUIs. Lines are
+    accumulated until a blank line ends the message. Comment lines, such as
+    the heartbeats sent by the server, are skipped. Multiple `data` lines of
+    a message are joined with newlines.
+
+    Parameters
+    ----------
+    lines : iterable of str
+        lines of the event stream without their line endings
+
+    Yields
+    ------
+    dict
+        the message with "id", "event" and "data" keys, "id" being None if
+        the message did not carry one
+    """
+    message = {"id": None, "event": "message", "data": []}
+    for line in lines:
+        if not line:
+            if message["data"]:
+                message["data"] = "\n".join(message["data"])
+                yield message
+            message = {"id": None, "event": "message", "data": []}
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "data":
+            message["data"].append(value)
+        elif field in ("id", "event"):
+            message[field] = value
+
+
+def stream_events(channel, seq, accept, initial=(), heartbeat=15.0):
+    """Generates the body of an SSE response.
+
+    Any initial events are sent first, followed by every event published to
+    the channel after `seq` for which `accept(event, data)` is True. A comment
+    line is sent as a heartbeat whenever nothing was published for
+    `heartbeat` seconds, which keeps proxies from closing the connection and
+    lets clients detect a dead server.
+
+    Parameters
+    ----------
+    channel : EventChannel
+        channel to read events from
+    seq : int
+        sequence number to stream after
+    accept : callable
+        filter receiving the event type and data
+    initial : iterable of tuple
+        (sequence number, event type, data) entries to send first
+    heartbeat : float
+        seconds between heartbeats on an idle stream
+
+    Yields
+    ------
+    str
+        SSE messages and heartbeat comments
+    """
+    for entry_seq, event, data in initial:
+        yield format_sse(channel.format_id(entry_seq), event, data)
+    while True:
+        entries = channel.wait(seq, heartbeat)
+        if not entries:
+            yield ": heartbeat\n\n"
+            continue
+        for entry_seq, event, data in entries:
+            seq = entry_seq
+            if accept(event, data):
+                yield format_sse(channel.format_id(entry_seq), event, data)
@@ -0,0 +1,54 @@
+# Production configuration for the CPAP server. Start it with
+#
+#     gunicorn -c gunicorn.conf.py server:app
+#
+# Gunicorn pre-forks the worker processes and each worker imports the app on
+# its own (preload_app is off), so every worker opens its own database
+# connection after the fork instead of sharing one created by the master.
+#
+# Requests spend most of their time waiting on blocking pymodm calls, which
+# release the GIL, so each worker serves many clients at once from a pool of
+# threads. Every open event stream holds one of those threads, so the pool
+# must be larger than the number of bedside devices and lab stations that
+# stream from the worker.
+#
+# The ETag version table, the response cache, the coalesced reads, the event
+# channels and the write-behind journal live in the memory of the process.
+# A write handled by one worker would not be seen by another, which would
+# then keep serving stale patient data, so the server runs a single worker
+# and nworkers_changed refuses any other count.
+import os
+
+bind = os.environ.get("CPAP_BIND", "0.0.0.0:5001")
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("CPAP_THREADS", 128))
+preload_app = False
+# Idle keep-alive connections of polling clients are closed after this many
+# seconds; event streams are kept open by their heartbeats.
+keepalive = 30
+# Workers that stop reporting to the master for this long are restarted.
+timeout = 60
+graceful_timeout = 20
+accesslog = os.environ.get("CPAP_ACCESS_LOG")
+
+
+def nworkers_changed(server, new_value, old_value):
+    # Called when the worker count is set from this file or the -w option,
+    # and when it is raised by a TTIN signal.
+    if new_value is None or new_value <= 1:
+        return
+    if old_value is None:
+        raise RuntimeError("The CPAP server keeps its caches and event "
+                           "channels in memory and must run one worker, "
+                           "not {}.".format(new_value))
+    server._num_workers = old_value
+    server.log.warning("Ignoring the request for %d workers; the CPAP "
+                       "server runs a single worker.", new_value)
+
+
+def post_worker_init(worker):
+    # Ready the room storage in each worker once the app is loaded; see
+    # server.prepare_store.
+    import server
+    server.prepare_store()
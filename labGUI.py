@@ -4,12 +4,30 @@ from tkinter import ttk
 from tkinter.ttk import Label as tkl
 import requests
 import base64
+import io
+import itertools
+import json
+import queue
+import threading
+import urllib.parse
 from PIL import Image, ImageTk
+from wire import accept_header, decode_body
+from events import parse_sse_lines
 
 
 server = "http://vcm-35079.vm.duke.edu:5001"
 global patient
 patient = {"accessed": False}
+etags = {}
+# Thumbnails of the flow rate plots shown so far, as (ETag, PNG bytes) keyed
+# by URL, revalidated with If-None-Match when shown again.
+THUMBNAIL_SIZE = 150
+thumbnail_cache = {}
+
+# Events received from the ward event stream, handled by the Tk main loop.
+ward_events = queue.Queue()
+STREAM_READ_TIMEOUT = 45
+STREAM_RETRY_SECONDS = 5
 
 
 def input_verification(in_data, expected_keys, expected_types):
@@ -81,6 +99,86 @@ def b64_string_to_file(b64_string, filename):
     return None
 
 
+def subscribe_ward(updates, stop_event):
+    """Receives the events of all rooms on a background thread.
+
+    This function subscribes to the `/lab/event_stream` route of the server
+    and puts every received event on the `updates` queue as an
+    (event type, data) tuple, to be handled by the Tk main loop. When the
+    connection drops or no heartbeat arrives in time, it reconnects with the
+    ID of the last received event so missed events are replayed. The
+    function returns once `stop_event` is set.
+
+    Parameters
+    ----------
+    updates : queue.Queue
+        queue receiving the events
+    stop_event : threading.Event
+        event set to end the subscription
+
+    Returns
+    -------
+    None
+    """
+    last_event_id = None
+    while not stop_event.is_set():
+        headers = {}
+        if last_event_id is not None:
+            headers["Last-Event-ID"] = last_event_id
+        try:
+            r = requests.get(server + "/lab/event_stream", headers=headers,
+                             stream=True, timeout=(5, STREAM_READ_TIMEOUT))
+            if r.status_code == 200:
+                lines = itertools.takewhile(
+                    lambda line: not stop_event.is_set(),
+                    r.iter_lines(decode_unicode=True))
+                for message in parse_sse_lines(lines):
+                    if message["id"] is not None:
+                        last_event_id = message["id"]
+                    updates.put((message["event"],
+                                 json.loads(message["data"])))
+            r.close()
+        except requests.exceptions.RequestException:
+            print("Ward event stream interrupted, reconnecting")
+        stop_event.wait(STREAM_RETRY_SECONDS)
+
+
+def envelope_pixels(envelope, width, height):
+    """Maps a waveform envelope onto the pixels of a plot.
+
+    The envelope returned by `/lab/waveform` holds the minimum and maximum
+    flow rate of consecutive time buckets. Each bucket is given an x
+    coordinate spread evenly over the plot width, and its minimum and
+    maximum are scaled to y coordinates so the largest absolute flow rate
+    reaches the top or bottom edge, with zero flow in the middle.
+
+    Parameters
+    ----------
+    envelope : dict
+        waveform envelope with "min" and "max" lists
+    width : int
+        plot width in pixels
+    height : int
+        plot height in pixels
+
+    Returns
+    -------
+    list of tuple
+        (x, y of the maximum, y of the minimum) for each bucket
+    """
+    mins, maxs = envelope["min"], envelope["max"]
+    if not mins:
+        return []
+    limit = max(max(abs(x) for x in mins), max(abs(x) for x in maxs)) or 1.0
+    middle = height / 2
+    scale = (height / 2 - 2) / limit
+    step = width / len(mins)
+    return [(round(i * step + step / 2, 1),
+             round(middle - high * scale, 1),
+             round(middle - low * scale, 1))
+            for i, (low, high) in enumerate(zip(mins, maxs))]
+
+
 def tk_img_from_filename(filename):
     pil_img = Image.open(filename)
     size = pil_img.size
@@ -89,6 +187,56 @@ def tk_img_from_filename(filename):
     return tk_image
 
 
+def tk_img_from_bytes(data):
+    """Builds a 150x150 Tk image from the bytes of an image file.
+
+    Parameters
+    ----------
+    data : bytes
+        PNG or JPEG file, as returned by `/lab/image`
+
+    Returns
+    -------
+    ImageTk.PhotoImage
+        image ready for a label
+    """
+    pil_img = Image.open(io.BytesIO(data)).resize((150, 150))
+    return ImageTk.PhotoImage(pil_img)
+
+
+def fetch_thumbnail(room_number, timestamp):
+    """Fetches the thumbnail of the flow rate plot of a calculation.
+
+    The server scales the plot down to THUMBNAIL_SIZE pixels, so only the
+    pixels shown are downloaded. Thumbnails already received are sent back
+    to the server as an ETag and reused if it answers 304.
+
+    Parameters
+    ----------
+    room_number : int or str
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+
+    Returns
+    -------
+    bytes or None
+        image file, or None if the calculation has no image
+    """
+    url = server + "/lab/image/{}/{}/{}".format(
+        room_number, urllib.parse.quote(timestamp), THUMBNAIL_SIZE)
+    cached = thumbnail_cache.get(url)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    r = requests.get(url, headers=headers)
+    if r.status_code == 304 and cached:
+        return cached[1]
+    if r.status_code != 200:
+        return None
+    if r.headers.get("ETag"):
+        thumbnail_cache[url] = (r.headers["ETag"], r.content)
+    return r.content
+
+
 def format_patient(in_data):
     expected_keys = ["room_number", "patient_name", "patient_mrn",
                      "cpap_pressure", "cpap_calculations"]
@@ -124,15 +272,30 @@ def main_window():
             if int(calcs[2]) >= 2:
                 apnea.configure(foreground="red")
             tkl(root, text=calcs[2]).grid(row=17, column=1)
-            # b64_string_to_file(calcs[3], "img.png")
-            tk_img = tk_img_from_filename("test_data/test_image.jpg")
-            image_label = ttk.Label(root, image=tk_img)
+            image = fetch_thumbnail(patient["room_number"], timestamp.get())
+            if image is not None:
+                tk_img = tk_img_from_bytes(image)
+                image_label = ttk.Label(root, image=tk_img)
+                image_label.image = tk_img
+            else:
+                image_label = ttk.Label(root, text="No image stored")
             image_label.grid(column=0, row=18)
+            waveform_view.update(room=patient["room_number"],
+                                 timestamp=timestamp.get(), start=None,
+                                 end=None)
+            show_waveform()
 
         if selected.get != 0:
-            r = requests.get(server + "/lab/fetch_patient/" +
-                             str(selected.get()))
-            in_data = r.json()
+            room = selected.get()
+            headers = {"Accept": accept_header()}
+            if etags.get(room) and patient.get("room_number") == str(room):
+                headers["If-None-Match"] = etags[room]
+            r = requests.get(server + "/lab/fetch_patient/" + str(room),
+                             headers=headers)
+            if r.status_code == 304:
+                return
+            etags[room] = r.headers.get("ETag")
+            in_data = decode_body(r.content, r.headers["Content-Type"])
             format_patient(in_data)
             tkl(root, text=patient["room_number"]).grid(row=11, column=1,
                                                         sticky="w")
@@ -151,7 +314,124 @@ def main_window():
                 ttk.Button(root,
                            text="Select",
                            command=fill_calculations).grid(column=2, row=15)
-            root.after(25000, fetch_data)
+
+    def refresh_dashboard():
+        """Shows the summary of every room in the ward table.
+
+        The whole ward is read with a single request to `/lab/dashboard`.
+        Apnea counts of two or more are shown in red, as for the selected
+        patient.
+        """
+        r = requests.get(server + "/lab/dashboard",
+                         headers={"Accept": accept_header()})
+        if r.status_code != 200:
+            return
+        ward_table.delete(*ward_table.get_children())
+        for room in decode_body(r.content, r.headers["Content-Type"]):
+            values = [room[key] if room[key] is not None else ""
+                      for key in ward_columns]
+            tags = ()
+            if room["apnea_count"] is not None and room["apnea_count"] >= 2:
+                tags = ("apnea",)
+            ward_table.insert("", "end", values=values, tags=tags)
+
+    def show_waveform(t0=None, t1=None):
+        """Plots the flow rate waveform of the selected calculation.
+
+        Only as many min/max buckets as the canvas has pixel columns are
+        requested from `/lab/waveform`, for the whole recording or for the
+        [t0, t1] range in seconds, and drawn as one vertical line per bucket.
+        """
+        url = server + "/lab/waveform/{}/{}".format(
+            waveform_view["room"],
+            urllib.parse.quote(waveform_view["timestamp"]))
+        params = {"points": waveform_canvas.winfo_reqwidth()}
+        if t0 is not None:
+            params["t0"] = t0
+            params["t1"] = t1
+        r = requests.get(url, params=params)
+        waveform_canvas.delete("all")
+        if r.status_code != 200:
+            waveform_canvas.create_text(200, 75, text="No waveform stored")
+            return
+        envelope = decode_body(r.content, r.headers["Content-Type"])
+        if waveform_view["start"] is None:
+            waveform_view["start"] = envelope["t0"]
+            waveform_view["end"] = envelope["t1"]
+        waveform_view["t0"] = envelope["t0"]
+        waveform_view["t1"] = envelope["t1"]
+        width = waveform_canvas.winfo_reqwidth()
+        height = waveform_canvas.winfo_reqheight()
+        for x, y_max, y_min in envelope_pixels(envelope, width, height):
+            waveform_canvas.create_line(x, y_max, x, y_min + 1)
+        waveform_canvas.create_text(
+            4, 4, anchor="nw", text="{:.1f} - {:.1f} s".format(
+                envelope["t0"], envelope["t1"]))
+
+    def move_waveform(zoom, shift):
+        """Zooms and pans the waveform plot.
+
+        The displayed range is scaled by `zoom` around its center and moved
+        by `shift` times its length, staying within the recording.
+        """
+        if waveform_view["t0"] is None:
+            return
+        start, end = waveform_view["start"], waveform_view["end"]
+        length = min((waveform_view["t1"] - waveform_view["t0"]) * zoom,
+                     end - start)
+        center = (waveform_view["t0"] + waveform_view["t1"]) / 2
+        center += shift * length
+        t0 = min(max(center - length / 2, start), end - length)
+        show_waveform(t0, t0 + length)
+
+    def update_room_options(rooms):
+        options[:] = sorted(rooms)
+        room_menu.set_menu(selected.get(), *options)
+
+    def handle_ward_events():
+        """Applies events from the ward event stream to the GUI.
+
+        Tk widgets may only be changed from the main loop, so the
+        subscription thread hands events over through a queue that this
+        function drains every half second. The room list is kept up to date,
+        apnea alerts of any room are shown at the top of the window, live
+        metrics of the selected room are shown as they stream in, and the
+        displayed patient is fetched again when an event concerns it.
+        """
+        refresh = False
+        refresh_ward = False
+        while True:
+            try:
+                event, data = ward_events.get_nowait()
+            except queue.Empty:
+                break
+            if event == "rooms":
+                update_room_options(data["rooms"])
+                continue
+            room = data["room_number"]
+            if event == "live_metrics":
+                if room == selected.get():
+                    live_label.configure(
+                        text="{} breaths/min, {} apnea events, {} s".format(
+                            data["breath_rate_bpm"], data["apnea_count"],
+                            round(data["end_time"] - data["start_time"])))
+                continue
+            refresh_ward = True
+            if event == "upload" and room not in options:
+                update_room_options(options + [room])
+            elif event == "reset" and room in options:
+                update_room_options([x for x in options if x != room])
+            elif event == "apnea_alert":
+                alert_label.configure(
+                    text="Room {}: {} apnea events at {}".format(
+                        room, data["apnea_count"], data["timestamp"]))
+            if room == selected.get() and event != "reset":
+                refresh = True
+        if refresh:
+            fetch_data()
+        if refresh_ward:
+            refresh_dashboard()
+        root.after(500, handle_ward_events)
 
     root = tk.Tk()
     root.title("Lab Monitoring Station")
@@ -168,7 +448,13 @@ def main_window():
     options = r.json()
     ttk.OptionMenu(root, selected, *options).grid(row=0, column=1)
     ttk.Button(root, text="Select", command=fetch_data).grid(row=0, column=2)
-    ttk.OptionMenu(root, selected, *options).grid(row=0, column=1)
+    room_menu = ttk.OptionMenu(root, selected, *options)
+    room_menu.grid(row=0, column=1)
+    alert_label = tkl(root, text="", foreground="red")
+    alert_label.grid(row=2, column=0, columnspan=3, sticky="w")
+    tkl(root, text="Live Data:").grid(row=3, column=0, sticky="w")
+    live_label = tkl(root, text="")
+    live_label.grid(row=3, column=1, columnspan=2, sticky="w")
     tkl(root, text="Patient Room Number:").grid(row=11, column=0, sticky="w")
 
     tkl(root, text="Patient Name:").grid(row=12, column=0, sticky="w")
@@ -186,7 +472,39 @@ def main_window():
     tkl(root, text="Flow Rate:").grid(row=18, column=0,
                                       sticky="w")
 
-    root.after(3000, fetch_data)
+    waveform_view = {"room": None, "timestamp": None, "start": None,
+                     "end": None, "t0": None, "t1": None}
+    waveform_frame = ttk.Frame(root)
+    waveform_frame.grid(row=18, column=1, columnspan=2, sticky="w")
+    waveform_canvas = tk.Canvas(waveform_frame, width=400, height=150,
+                                background="white")
+    waveform_canvas.grid(row=0, column=0, columnspan=4)
+    ttk.Button(waveform_frame, text="Zoom In",
+               command=lambda: move_waveform(0.5, 0)).grid(row=1, column=0)
+    ttk.Button(waveform_frame, text="Zoom Out",
+               command=lambda: move_waveform(2, 0)).grid(row=1, column=1)
+    ttk.Button(waveform_frame, text="<",
+               command=lambda: move_waveform(1, -0.5)).grid(row=1, column=2)
+    ttk.Button(waveform_frame, text=">",
+               command=lambda: move_waveform(1, 0.5)).grid(row=1, column=3)
+
+    ward_columns = ("room_number", "patient_name", "patient_mrn",
+                    "cpap_pressure", "breath_rate_bpm", "apnea_count")
+    ward_headings = ("Room", "Name", "MRN", "Pressure", "Breathing Rate",
+                     "Apnea Events")
+    ward_table = ttk.Treeview(root, columns=ward_columns, show="headings",
+                              height=8)
+    for column, heading in zip(ward_columns, ward_headings):
+        ward_table.heading(column, text=heading)
+        ward_table.column(column, width=100)
+    ward_table.tag_configure("apnea", foreground="red")
+    ward_table.grid(row=19, column=0, columnspan=3, sticky="ew")
+    refresh_dashboard()
+
+    threading.Thread(target=subscribe_ward,
+                     args=(ward_events, threading.Event()),
+                     daemon=True).start()
+    root.after(500, handle_ward_events)
     root.mainloop()
 
 
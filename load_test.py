@@ -0,0 +1,327 @@
+import argparse
+import os
+import random
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+import requests
+from bench_polling import percentile, start_local_server
+
+OPERATIONS = ("fetch_pressure", "upload_patient", "upload_image",
+              "list_rooms", "fetch_patient")
+PLOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "flow_rate_vs_time_plot.png")
+
+
+class Recorder:
+    """Latencies and errors of the requests made during a run.
+
+    Parameters
+    ----------
+    None
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {operation: [] for operation in OPERATIONS}
+        self._errors = {operation: 0 for operation in OPERATIONS}
+
+    def request(self, operation, method, url, **kwargs):
+        """Sends a request and records its outcome.
+
+        Requests answered with 200 or 304 count as successful, anything else
+        or a connection failure as an error.
+
+        Parameters
+        ----------
+        operation : str
+            name of the operation, one of OPERATIONS
+        method : str
+            HTTP method
+        url : str
+            URL of the request
+        **kwargs
+            further arguments of `requests.request`
+
+        Returns
+        -------
+        requests.Response or None
+            response, or None if the request failed
+        """
+        start = time.perf_counter()
+        try:
+            r = requests.request(method, url, timeout=30, **kwargs)
+        except requests.exceptions.RequestException:
+            r = None
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if r is None or r.status_code not in (200, 304):
+                self._errors[operation] += 1
+                return None
+            self._latencies[operation].append(elapsed)
+        return r
+
+    def summary(self, duration):
+        """Summarizes the recorded requests of each operation.
+
+        Parameters
+        ----------
+        duration : float
+            length of the run in seconds
+
+        Returns
+        -------
+        dict
+            requests per second, p50 and p99 latency in ms and error rate
+            of each operation, keyed by operation
+        """
+        results = {}
+        with self._lock:
+            for operation in OPERATIONS:
+                latencies = self._latencies[operation]
+                total = len(latencies) + self._errors[operation]
+                results[operation] = {
+                    "requests": total,
+                    "requests_per_second": round(total / duration, 2),
+                    "p50_ms": round(
+                        1000 * (percentile(latencies, 0.5) or 0), 1),
+                    "p99_ms": round(
+                        1000 * (percentile(latencies, 0.99) or 0), 1),
+                    "error_rate": round(self._errors[operation] / total, 4)
+                    if total else 0.0}
+        return results
+
+
+def bedside_device(server, room_number, plot, recorder, intervals,
+                   stop_event, start_time):
+    """Simulates the patient GUI of one room.
+
+    The device is switched on at a random time within the first polling
+    interval. It first uploads a calculation to occupy the room, then polls
+    `/patient/fetch_pressure` with `If-None-Match`, as the GUI does when the
+    pressure stream is not used, and uploads a new calculation and its plot
+    at the upload interval. Calculation timestamps advance one upload
+    interval at a time from `start_time`, so they never collide.
+
+    Parameters
+    ----------
+    server : str
+        base URL of the server
+    room_number : int
+        room of the device
+    plot : bytes
+        PNG file uploaded with every calculation
+    recorder : Recorder
+        recorder of the requests
+    intervals : dict
+        "pressure" and "upload" intervals in seconds
+    stop_event : threading.Event
+        set when the run ends
+    start_time : datetime.datetime
+        timestamp of the first calculation
+
+    Returns
+    -------
+    None
+    """
+    uploads = 0
+    etag = None
+    next_upload = time.monotonic() + random.uniform(0, intervals["pressure"])
+    next_poll = next_upload
+    while not stop_event.is_set():
+        now = time.monotonic()
+        if now >= next_upload:
+            timestamp = (start_time + uploads * timedelta(
+                seconds=intervals["upload"])).strftime("%Y-%m-%d %H:%M:%S")
+            uploads += 1
+            upload_calculation(server, room_number, timestamp, plot,
+                               recorder)
+            next_upload = now + intervals["upload"]
+        if now >= next_poll:
+            headers = {"If-None-Match": etag} if etag else {}
+            r = recorder.request("fetch_pressure", "GET",
+                                 "{}/patient/fetch_pressure/{}".format(
+                                     server, room_number), headers=headers)
+            if r is not None and r.headers.get("ETag"):
+                etag = r.headers["ETag"]
+            next_poll = now + intervals["pressure"]
+        stop_event.wait(max(min(next_upload, next_poll) - time.monotonic(),
+                            0))
+
+
+def upload_calculation(server, room_number, timestamp, plot, recorder):
+    """Uploads one calculation and its plot, as the patient GUI does.
+
+    Parameters
+    ----------
+    server : str
+        base URL of the server
+    room_number : int
+        room of the patient
+    timestamp : str
+        timestamp of the calculation
+    plot : bytes
+        PNG file of the plot
+    recorder : Recorder
+        recorder of the requests
+
+    Returns
+    -------
+    None
+    """
+    r = recorder.request("upload_patient", "POST",
+                         server + "/patient/upload_patient", json={
+                             "room_number": room_number,
+                             "patient_name": "Load Test {}".format(
+                                 room_number),
+                             "patient_mrn": 900000 + room_number,
+                             "cpap_pressure": random.randint(4, 25),
+                             "cpap_calculations": [
+                                 timestamp, round(random.uniform(10, 20), 2),
+                                 random.randint(0, 4), None]})
+    if r is None:
+        return
+    recorder.request("upload_image", "PUT",
+                     "{}/patient/image/{}/{}".format(
+                         server, room_number, urllib.parse.quote(timestamp)),
+                     data=plot, headers={"Content-Type": "image/png"})
+
+
+def lab_station(server, recorder, interval, headers, stop_event):
+    """Simulates one lab GUI.
+
+    At every interval the station lists the rooms and then polls
+    `/lab/fetch_patient` for a randomly selected room, sending the ETag of
+    the last response of that room back in `If-None-Match`.
+
+    Parameters
+    ----------
+    server : str
+        base URL of the server
+    recorder : Recorder
+        recorder of the requests
+    interval : float
+        time between polls in seconds
+    headers : dict
+        headers sent with `fetch_patient`, such as `Accept`
+    stop_event : threading.Event
+        set when the run ends
+
+    Returns
+    -------
+    None
+    """
+    etags = {}
+    stop_event.wait(random.uniform(0, interval))
+    while not stop_event.is_set():
+        started = time.monotonic()
+        r = recorder.request("list_rooms", "GET", server + "/lab/list_rooms")
+        rooms = r.json() if r is not None else []
+        if rooms:
+            room = random.choice(rooms)
+            request_headers = dict(headers)
+            if room in etags:
+                request_headers["If-None-Match"] = etags[room]
+            r = recorder.request("fetch_patient", "GET",
+                                 "{}/lab/fetch_patient/{}".format(server,
+                                                                  room),
+                                 headers=request_headers)
+            if r is not None and r.headers.get("ETag"):
+                etags[room] = r.headers["ETag"]
+        stop_event.wait(max(interval - (time.monotonic() - started), 0))
+
+
+def run_ward(server, rooms, stations, duration, intervals, plot, headers):
+    """Runs a ward of simulated bedside devices and lab stations.
+
+    Parameters
+    ----------
+    server : str
+        base URL of the server
+    rooms : int
+        number of rooms, each with one bedside device
+    stations : int
+        number of lab stations
+    duration : float
+        length of the run in seconds
+    intervals : dict
+        "pressure", "upload" and "lab" intervals in seconds
+    plot : bytes
+        PNG file uploaded with every calculation
+    headers : dict
+        headers sent by the lab stations with `fetch_patient`
+
+    Returns
+    -------
+    dict
+        summary of each operation, as returned by `Recorder.summary`
+    """
+    recorder = Recorder()
+    stop_event = threading.Event()
+    start_time = datetime.now().replace(microsecond=0)
+    threads = [threading.Thread(target=bedside_device,
+                                args=(server, room_number, plot, recorder,
+                                      intervals, stop_event, start_time))
+               for room_number in range(1, rooms + 1)]
+    threads += [threading.Thread(target=lab_station,
+                                 args=(server, recorder, intervals["lab"],
+                                       headers, stop_event))
+                for _ in range(stations)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    stop_event.wait(duration)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    return recorder.summary(time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate a ward of bedside devices and lab stations "
+                    "against the CPAP server.")
+    parser.add_argument("--server",
+                        help="base URL of a running server; the app is "
+                             "started in this process if missing")
+    parser.add_argument("--storage", default="mongo",
+                        help="CPAP_STORAGE of the in-process server")
+    parser.add_argument("--db-delay", type=float, default=0.0,
+                        help="seconds added to every query of the "
+                             "in-process MongoDB stand-in")
+    parser.add_argument("--rooms", type=int, nargs="+",
+                        default=[10, 40, 160])
+    parser.add_argument("--lab-stations", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--pressure-interval", type=float, default=25.0)
+    parser.add_argument("--upload-interval", type=float, default=300.0)
+    parser.add_argument("--lab-interval", type=float, default=5.0)
+    parser.add_argument("--accept", default="application/json",
+                        help="Accept header of the lab stations")
+    args = parser.parse_args()
+    server = args.server or start_local_server(args.storage,
+                                               args.db_delay)
+    try:
+        with open(PLOT_FILE, "rb") as plot_file:
+            plot = plot_file.read()
+    except OSError:
+        plot = b"\x89PNG\r\n\x1a\n" + bytes(50000)
+    intervals = {"pressure": args.pressure_interval,
+                 "upload": args.upload_interval,
+                 "lab": args.lab_interval}
+    headers = {"Accept": args.accept}
+    print("rooms  operation        requests  req/s  p50_ms  p99_ms  errors")
+    for rooms in args.rooms:
+        summary = run_ward(server, rooms, args.lab_stations, args.duration,
+                           intervals, plot, headers)
+        for operation, result in summary.items():
+            print("{:>5}  {:<15}  {:>8}  {:>5}  {:>6}  {:>6}  {:>6}".format(
+                rooms, operation, result["requests"],
+                result["requests_per_second"], result["p50_ms"],
+                result["p99_ms"], "{:.2%}".format(result["error_rate"])))
+
+
+if __name__ == "__main__":
+    main()
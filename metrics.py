@@ -0,0 +1,262 @@
+import bisect
+import threading
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Prometheus histogram with a fixed set of label names.
+
+    Observations are counted in the first bucket whose upper bound they do
+    not exceed; the buckets are only made cumulative when rendered, so an
+    observation costs one binary search and three additions.
+
+    Parameters
+    ----------
+    name : str
+        metric name
+    help_text : str
+        description of the metric
+    labels : tuple of str
+        label names
+    buckets : tuple of float
+        upper bounds of the buckets in ascending order, without +Inf
+    """
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, label_values, value):
+        """Adds an observation. The caller must hold the registry lock.
+
+        Parameters
+        ----------
+        label_values : tuple of str
+            values of the labels, in the order of their names
+        value : float
+            observed value
+
+        Returns
+        -------
+        None
+        """
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [
+                [0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        """Formats the histogram in the Prometheus text format.
+
+        Returns
+        -------
+        list of str
+            lines of the histogram
+        """
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} histogram".format(self.name)]
+        for label_values, (counts, total, count) in sorted(
+                self._series.items()):
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{{{}le=\"{}\"}} {}".format(
+                    self.name, labels + "," if labels else "",
+                    format_value(bound), cumulative))
+            lines.append("{}_sum{} {}".format(
+                self.name, wrap_labels(labels), format_value(total)))
+            lines.append("{}_count{} {}".format(
+                self.name, wrap_labels(labels), count))
+        return lines
+
+
+class RequestMetrics(monitoring.CommandListener):
+    """Request and database metrics of the server process.
+
+    Flask hooks call `start_request` and `finish_request` around every
+    request. The instance is also registered as a pymongo command listener,
+    so every MongoDB command is timed, both overall and towards the request
+    running in the same thread. pymongo publishes command events in the
+    thread that sent the command, so a thread-local tally is enough to tell
+    requests apart. Only MongoDB commands are seen; the other storage
+    backends report no database calls.
+
+    All counters live in process memory and start from zero with each
+    worker, which Prometheus handles as a counter reset.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        route_labels = ("route", "method")
+        self.request_seconds = Histogram(
+            "cpap_http_request_duration_seconds",
+            "Time from the start of a request until its response is ready.",
+            route_labels + ("status",), LATENCY_BUCKETS)
+        self.request_bytes = Histogram(
+            "cpap_http_request_size_bytes", "Size of request bodies.",
+            route_labels, SIZE_BUCKETS)
+        self.response_bytes = Histogram(
+            "cpap_http_response_size_bytes",
+            "Size of response bodies as sent, streamed bodies excluded.",
+            route_labels, SIZE_BUCKETS)
+        self.request_db_commands = Histogram(
+            "cpap_http_request_db_commands",
+            "Number of MongoDB commands sent while handling a request.",
+            route_labels, COUNT_BUCKETS)
+        self.request_db_seconds = Histogram(
+            "cpap_http_request_db_seconds",
+            "Time spent in MongoDB commands while handling a request.",
+            route_labels, LATENCY_BUCKETS)
+        self.db_seconds = Histogram(
+            "cpap_db_command_duration_seconds",
+            "Duration of MongoDB commands, including those sent by "
+            "background tasks.",
+            ("command", "outcome"), LATENCY_BUCKETS)
+
+    def start_request(self):
+        """Starts the database tally of the request in this thread.
+
+        Returns
+        -------
+        None
+        """
+        self._local.db_commands = 0
+        self._local.db_seconds = 0.0
+
+    def finish_request(self, route, method, status, seconds, request_bytes,
+                       response_bytes):
+        """Records a finished request.
+
+        Parameters
+        ----------
+        route : str
+            URL rule of the request, such as
+            "/lab/fetch_patient/<room_number>", so each route has a bounded
+            set of series
+        method : str
+            HTTP method
+        status : int
+            status code of the response
+        seconds : float
+            time taken to build the response
+        request_bytes : int
+            size of the request body
+        response_bytes : int or None
+            size of the response body, None if it is streamed
+
+        Returns
+        -------
+        None
+        """
+        db_commands = getattr(self._local, "db_commands", 0)
+        db_seconds = getattr(self._local, "db_seconds", 0.0)
+        self._local.db_commands = None
+        labels = (route, method)
+        with self._lock:
+            self.request_seconds.observe(labels + (str(status),), seconds)
+            self.request_bytes.observe(labels, request_bytes)
+            if response_bytes is not None:
+                self.response_bytes.observe(labels, response_bytes)
+            self.request_db_commands.observe(labels, db_commands or 0)
+            self.request_db_seconds.observe(labels, db_seconds)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._command_done(event, "success")
+
+    def failed(self, event):
+        self._command_done(event, "failure")
+
+    def _command_done(self, event, outcome):
+        seconds = event.duration_micros / 1e6
+        if getattr(self._local, "db_commands", None) is not None:
+            self._local.db_commands += 1
+            self._local.db_seconds += seconds
+        with self._lock:
+            self.db_seconds.observe((event.command_name, outcome), seconds)
+
+    def render(self, samples=()):
+        """Formats every metric in the Prometheus text format.
+
+        Parameters
+        ----------
+        samples : iterable of tuple
+            further (name, type, help, value) samples to expose, such as
+            counters kept by other parts of the server
+
+        Returns
+        -------
+        str
+            exposition text
+        """
+        lines = []
+        with self._lock:
+            for histogram in (self.request_seconds, self.request_bytes,
+                              self.response_bytes, self.request_db_commands,
+                              self.request_db_seconds, self.db_seconds):
+                lines.extend(histogram.render())
+        for name, metric_type, help_text, value in samples:
+            lines.extend(["# HELP {} {}".format(name, help_text),
+                          "# TYPE {} {}".format(name, metric_type),
+                          "{} {}".format(name, format_value(value))])
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(names, values):
+    """Formats label pairs, escaping the values.
+
+    Parameters
+    ----------
+    names : tuple of str
+        label names
+    values : tuple of str
+        label values
+
+    Returns
+    -------
+    str
+        comma-separated `name="value"` pairs
+    """
+    return ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n")) for name, value in zip(names, values))
+
+
+def wrap_labels(labels):
+    return "{{{}}}".format(labels) if labels else ""
+
+
+def format_value(value):
+    """Formats a sample value or bucket bound.
+
+    Parameters
+    ----------
+    value : float, int, str or None
+        value, "+Inf", or None for an unknown value
+
+    Returns
+    -------
+    str
+        value as written in the exposition text
+    """
+    if value is None:
+        return "NaN"
+    if isinstance(value, str):
+        return value
+    return repr(value)
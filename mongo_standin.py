@@ -0,0 +1,65 @@
+import functools
+import threading
+import time
+import mongomock
+import pymodm.connection
+
+# Connection string of the stand-in database. It names the database only;
+# nothing is contacted over the network.
+STANDIN_MONGODB_URI = "mongodb://localhost/SleepLabRooms"
+
+# Collection methods that make one round trip to a MongoDB server. Methods
+# that mongomock implements on top of others only count once.
+ROUND_TRIPS = ("aggregate", "bulk_write", "count_documents", "create_index",
+               "create_indexes", "delete_many", "delete_one",
+               "distinct", "drop_index", "find", "find_one",
+               "find_one_and_delete", "find_one_and_replace",
+               "find_one_and_update", "index_information", "insert_many",
+               "insert_one", "list_indexes", "replace_one", "update_many",
+               "update_one")
+
+_calls = threading.local()
+
+
+def _with_round_trip(method, delay):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_calls, "depth", 0)
+        if depth == 0:
+            time.sleep(delay)
+        _calls.depth = depth + 1
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _calls.depth = depth
+    return wrapper
+
+
+def use_mongo_standin(delay=0.0):
+    """Backs the MongoDB connections of this process with mongomock.
+
+    Every client later opened by `pymodm.connect` is an in-memory mongomock
+    client, so the MongoDB storage and its queries run unchanged without a
+    database server. The stand-in is shared by every connection of the
+    process and lost when it exits. `delay` is slept once per collection
+    call, outside of any lock, to model the round trip to a remote cluster:
+    concurrent requests wait for it side by side, as they would for the
+    network. This is meant for benchmarks and load tests; call it before
+    the first query and set MONGODB_URI to STANDIN_MONGODB_URI.
+
+    Parameters
+    ----------
+    delay : float
+        seconds added to every collection call, 0 for none
+
+    Returns
+    -------
+    None
+    """
+    client = mongomock.MongoClient()
+    pymodm.connection.MongoClient = lambda uri, **kwargs: client
+    if delay > 0:
+        for name in ROUND_TRIPS:
+            method = getattr(mongomock.collection.Collection, name)
+            setattr(mongomock.collection.Collection, name,
+                    _with_round_trip(method, delay))
@@ -1,10 +1,23 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import requests
-from CPAP_measurement import *
+try:
+    from CPAP_measurement import *
+except ImportError:
+    # Bedside devices without scipy and matplotlib send CPAP data files to
+    # the server for analysis instead.
+    process_cpap_data = None
 from PIL import Image, ImageTk
 from datetime import datetime, timedelta
 import base64
+import itertools
+import json
+import os
+import queue
+import threading
+import urllib.parse
+from wire import accept_header, decode_body
+from events import parse_sse_lines
 
 server = "http://vcm-35079.vm.duke.edu:5001"
 # server = "http://127.0.0.1:8000"
@@ -13,6 +26,25 @@ breath_rate_bpm = None
 apnea_count = None
 gui_pressure = None
 room_number_upload = None
+pressure_etag = None
+flow_waveform = None
+
+# Pressure values received by the subscription thread, applied to the GUI by
+# the Tk main loop.
+pressure_updates = queue.Queue()
+pressure_subscription = None
+STREAM_READ_TIMEOUT = 45
+STREAM_RETRY_SECONDS = 5
+
+# Progress and results of the local analysis thread, applied to the GUI by
+# the Tk main loop. The event is set to cancel the running analysis.
+analysis_updates = queue.Queue()
+analysis_cancel = None
+ANALYSIS_POLL_MS = 100
+
+
+class AnalysisCancelled(Exception):
+    """Raised inside the analysis thread to stop parsing a cancelled file."""
 
 
 def safe_int_conversion(text):
@@ -68,6 +100,34 @@ def file_to_b64_string(filename):
     return b64_string
 
 
+def b64_string_to_file(b64_string, filename):
+    # Tested in test_server.py
+    """Converts a base-64 string to a file
+
+    This function is used to save the flow rate plot returned by a
+    server-side analysis job. A string assumed to contain a base-64 encoding
+    of data is decoded. The data is decoded and the resulting bytes are then
+    written to the given filename.
+
+    Adapted from David Ward, Duke University
+
+    Parameters
+    ----------
+    b64_string : string
+        base-64 encoded data
+    filename : string
+        name of file to be written
+
+    Returns
+    -------
+    None
+    """
+    image_bytes = base64.b64decode(b64_string)
+    with open(filename, "wb") as out_file:
+        out_file.write(image_bytes)
+    return None
+
+
 def load_and_display_image(image_path, label_widget):
     """
     Loads an image from a path and displays it in a label widget.
@@ -96,6 +156,171 @@ def load_and_display_image(image_path, label_widget):
     label_widget.image = img_tk  # Keep a reference
 
 
+def fetch_pressure_conditional(room_num):
+    """
+    Polls the server once for the CPAP pressure of a room.
+
+    The ETag of the last successful response is sent back in the
+    `If-None-Match` header. A 304 response means the pressure has not
+    changed. This is used when the server does not offer the pressure
+    stream.
+
+    Parameters
+    ----------
+    room_num : int
+        Room number of the patient.
+
+    Returns
+    -------
+    str or None
+        The new pressure, or None if it did not change or the request failed.
+    """
+    global pressure_etag
+    headers = {}
+    if pressure_etag is not None:
+        headers["If-None-Match"] = pressure_etag
+    r = requests.get(server + '/patient/fetch_pressure/' + str(room_num),
+                     headers=headers)
+    if r.status_code != 200:
+        return None
+    pressure_etag = r.headers.get("ETag")
+    return r.text
+
+
+def upload_plot(room_num, timestamp, filename):
+    """
+    Uploads the flow rate plot of a calculation as a binary PNG file.
+
+    The file is streamed to `/patient/image/<room>/<timestamp>` as the body
+    of a PUT request, so it is neither base-64 encoded nor parsed as JSON by
+    the server.
+
+    Parameters
+    ----------
+    room_num : int
+        Room number of the patient.
+    timestamp : str
+        Timestamp of the uploaded calculation.
+    filename : str
+        Path of the PNG file.
+
+    Returns
+    -------
+    requests.Response
+        The server response.
+    """
+    url = server + "/patient/image/{}/{}".format(
+        room_num, urllib.parse.quote(timestamp))
+    with open(filename, "rb") as image_file:
+        return requests.put(url, data=image_file,
+                            headers={"Content-Type": "image/png"})
+
+
+def subscribe_pressure(room_num, updates, stop_event):
+    """
+    Receives CPAP pressure changes for a room on a background thread.
+
+    This function subscribes to the `/patient/pressure_stream/<room_number>`
+    route of the server and puts every received pressure on the `updates`
+    queue, to be applied to the GUI by the Tk main loop. When the connection
+    drops or no heartbeat arrives in time, it reconnects with the ID of the
+    last received event so missed changes are replayed. If the server does
+    not offer the stream, the pressure is polled every 25 seconds instead.
+    The function returns once `stop_event` is set.
+
+    Parameters
+    ----------
+    room_num : int
+        Room number of the patient.
+    updates : queue.Queue
+        Queue receiving new pressure values.
+    stop_event : threading.Event
+        Event set to end the subscription.
+
+    Returns
+    -------
+    None
+    """
+    url = server + '/patient/pressure_stream/' + str(room_num)
+    last_event_id = None
+    while not stop_event.is_set():
+        headers = {}
+        if last_event_id is not None:
+            headers["Last-Event-ID"] = last_event_id
+        try:
+            r = requests.get(url, headers=headers, stream=True,
+                             timeout=(5, STREAM_READ_TIMEOUT))
+            if r.status_code == 404:
+                pressure = fetch_pressure_conditional(room_num)
+                if pressure is not None:
+                    updates.put(pressure)
+                stop_event.wait(25)
+                continue
+            if r.status_code == 200:
+                lines = itertools.takewhile(
+                    lambda line: not stop_event.is_set(),
+                    r.iter_lines(decode_unicode=True))
+                for message in parse_sse_lines(lines):
+                    if message["id"] is not None:
+                        last_event_id = message["id"]
+                    if message["event"] == "pressure":
+                        data = json.loads(message["data"])
+                        updates.put(str(data["cpap_pressure"]))
+            else:
+                print(r.text)
+            r.close()
+        except requests.exceptions.RequestException:
+            print("Pressure stream interrupted, reconnecting")
+        stop_event.wait(STREAM_RETRY_SECONDS)
+
+
+def analyze_file(file, updates, cancel_event):
+    """Analyzes a CPAP data file, meant to run on a background thread.
+
+    The file is processed by `process_cpap_data`, and the share of the file
+    parsed so far is put in `updates` as ("progress", fraction). Parsing
+    stops at the next progress report once `cancel_event` is set; the peak
+    detection and plot that follow cannot be interrupted, so a cancellation
+    arriving then only discards the results. The thread always ends by
+    putting one of ("done", (plot filename, results)), ("failed", message)
+    or ("cancelled", None), and closes the file.
+
+    Parameters
+    ----------
+    file : file
+        CPAP data file opened in text mode
+    updates : queue.Queue
+        queue receiving the progress and the outcome
+    cancel_event : threading.Event
+        set to cancel the analysis
+
+    Returns
+    -------
+    None
+    """
+    size = os.fstat(file.fileno()).st_size
+
+    def progress(parsed):
+        if cancel_event.is_set():
+            raise AnalysisCancelled
+        if size:
+            updates.put(("progress", min(parsed / size, 1.0)))
+
+    try:
+        with file:
+            outcome = process_cpap_data(file, progress=progress)
+    except AnalysisCancelled:
+        updates.put(("cancelled", None))
+        return
+    except Exception as error:
+        updates.put(("failed", str(error)))
+        return
+    if cancel_event.is_set():
+        updates.put(("cancelled", None))
+    else:
+        updates.put(("done", outcome))
+
+
 def apnea_count_color(count):
     """
     Help with testing of update_apnea_count_label.
@@ -215,39 +440,175 @@ def main_window():
 
     def select_file():
         """
-        Selects a file for processing and updates GUI with CPAP data results.
+        Selects a file and starts its analysis on a background thread.
 
         This function opens a file dialog for the user to select a file.
-        If a file
-        is selected, it processes the CPAP data using the plot and outputs
-        necessary information. It updates global variables for breath rate and
-        apnea count, and also updates corresponding GUI labels and image.
+        If a file is selected, `analyze_file` processes the CPAP data on a
+        background thread, so the GUI stays responsive while a large file is
+        parsed, analyzed and plotted. The file selection is disabled and the
+        cancel button enabled until the thread ends, and its progress and
+        results are applied by `apply_analysis_updates`.
+
+        If CPAP_measurement could not be imported, the file is sent to the
+        server for analysis with `analyze_on_server` instead.
 
         Returns
         -------
-        tuple
-            A tuple containing the plot filename and a dictionary of results,
-            or None if no file is selected.
+        None
         """
         file = filedialog.askopenfile()
-        if file == "":
+        if file is None:
             return
-        global plot_filename
-        # processes the cpap data using the plot and
-        # outputs necessary information
-        try:
-            plot_filename, results = process_cpap_data(file)
-        except TypeError:
-            plot_filename = results = "No CPAP data uploaded."
+        if process_cpap_data is None:
+            analyze_on_server(file)
+            return
+        global analysis_cancel
+        analysis_cancel = threading.Event()
+        threading.Thread(target=analyze_file,
+                         args=(file, analysis_updates, analysis_cancel),
+                         daemon=True).start()
+        select_button.config(state=tk.DISABLED)
+        cancel_button.config(state=tk.NORMAL)
+        breathing_rate_label.config(text="Analyzing... 0%")
+        root.after(ANALYSIS_POLL_MS, apply_analysis_updates)
+
+    def cancel_analysis():
+        """
+        Cancels the running local analysis.
+
+        The analysis thread stops at its next progress report, or discards
+        its results if it is already past parsing. The file selection is
+        enabled again once the thread has ended.
+
+        Returns
+        -------
+        None
+        """
+        if analysis_cancel is not None:
+            analysis_cancel.set()
+            cancel_button.config(state=tk.DISABLED)
+            breathing_rate_label.config(text="Cancelling...")
+
+    def apply_analysis_updates():
+        """
+        Applies the progress and results of the analysis thread to the GUI.
+
+        Tk widgets may only be changed from the main loop, so the analysis
+        thread hands its progress and outcome over through a queue that this
+        function drains every ANALYSIS_POLL_MS milliseconds while the thread
+        runs. Once the analysis is done, the global breath rate, apnea count
+        and waveform are updated for the next upload, and the labels and
+        flow rate plot are displayed.
+
+        Returns
+        -------
+        None
+        """
+        global analysis_cancel, plot_filename, breath_rate_bpm, \
+            apnea_count, flow_waveform
+        while True:
+            try:
+                kind, value = analysis_updates.get_nowait()
+            except queue.Empty:
+                root.after(ANALYSIS_POLL_MS, apply_analysis_updates)
+                return
+            if kind != "progress":
+                break
+            if not analysis_cancel.is_set():
+                breathing_rate_label.config(
+                    text="Analyzing... {:.0%}".format(value))
+        analysis_cancel = None
+        select_button.config(state=tk.NORMAL)
+        cancel_button.config(state=tk.DISABLED)
+        if kind == "cancelled":
+            breathing_rate_label.config(text="Analysis cancelled")
+            return
+        if kind == "failed":
+            print(value)
+            breathing_rate_label.config(text="Analysis failed")
+            return
+        plot_filename, results = value
         print(results)
-        global breath_rate_bpm
         breath_rate_bpm = results["breath_rate_bpm"]
-        global apnea_count
         apnea_count = results["apnea_count"]
+        flow_waveform = results["flow_waveform"]
         breathing_rate_label.config(text=str(breath_rate_bpm))
         update_apnea_count_label(apnea_count)
         load_and_display_image(plot_filename, cpap_flow_image)
-        return plot_filename, results
+
+    def analyze_on_server(file):
+        """
+        Sends a CPAP data file to the server for analysis.
+
+        The file is uploaded to `/patient/analyze_cpap_file` along with the
+        entered patient information, which the server needs to store the
+        results once the analysis is done. The job is then followed with
+        `check_analysis_job`.
+
+        Parameters
+        ----------
+        file : file
+            The CPAP data file selected by the user.
+
+        Returns
+        -------
+        None
+        """
+        global room_number_upload
+        room_number_upload = room_number.get()
+        form = {"room_number": room_number.get(),
+                "patient_name": patient_name.get(),
+                "patient_mrn": patient_mrn.get(),
+                "cpap_pressure": cpap_pressure.get()}
+        with open(file.name, "rb") as data_file:
+            r = requests.post(server + "/patient/analyze_cpap_file",
+                              data=form, files={"cpap_file": data_file})
+        print(r.text)
+        if r.status_code != 202:
+            return
+        check_analysis_job(r.json()["job_id"])
+
+    def check_analysis_job(job_id):
+        """
+        Follows a server-side analysis job until its results are stored.
+
+        The job state is fetched every second and its progress is shown in
+        the breathing rate label. Once the job is done, the results and the
+        flow rate plot are displayed as for a local analysis. The server has
+        already stored them for the patient, so the GUI is updated as after
+        an upload.
+
+        Parameters
+        ----------
+        job_id : str
+            ID returned by `/patient/analyze_cpap_file`.
+
+        Returns
+        -------
+        None
+        """
+        r = requests.get(server + "/patient/analysis_job/" + job_id,
+                         headers={"Accept": accept_header()})
+        job = decode_body(r.content, r.headers["Content-Type"])
+        if r.status_code != 200 or job["status"] == "failed":
+            print(job)
+            breathing_rate_label.config(text="Analysis failed")
+            return
+        if job["status"] != "done":
+            breathing_rate_label.config(
+                text="Analyzing... {:.0%}".format(job["progress"]))
+            root.after(1000, lambda: check_analysis_job(job_id))
+            return
+        result = job["result"]
+        global plot_filename, breath_rate_bpm, apnea_count
+        plot_filename = "flow_rate_vs_time_plot.png"
+        b64_string_to_file(result["image"], plot_filename)
+        breath_rate_bpm = result["breath_rate_bpm"]
+        apnea_count = result["apnea_count"]
+        breathing_rate_label.config(text=str(breath_rate_bpm))
+        update_apnea_count_label(apnea_count)
+        load_and_display_image(plot_filename, cpap_flow_image)
+        update_gui_after_upload()
 
     def safe_int_conversion(text):
         # Tested using function above
@@ -281,7 +642,8 @@ def main_window():
 
         This function disables input fields for patient MRN and room number
         after a successful data upload. It also retrieves and shows the
-        current CPAP pressure in a label on the GUI.
+        current CPAP pressure in a label on the GUI, and subscribes to
+        pressure changes made from the monitoring side for this room.
 
         Returns
         -------
@@ -293,6 +655,7 @@ def main_window():
         room_number.config(state=tk.DISABLED)
         gui_pressure = cpap_pressure.get()
         cpap_events_label.config(text=gui_pressure)
+        start_pressure_subscription()
 
     def upload_data():
         """
@@ -302,11 +665,14 @@ def main_window():
         This function compiles patient data including room number,
         name, medical
         record number (MRN), CPAP pressure, and CPAP calculations
-        (including time, breath rate, apnea count, and plot filename).
+        (including time, breath rate and apnea count), along
+        with the compact flow rate waveform for the lab to plot.
         It then sends this
         data to a
-        server. If the upload is successful (indicated by a 200 status code),
-        the GUI is updated to reflect this state.
+        server. If the upload is successful (indicated by a 200 status code,
+        or 202 when the server journals uploads and stores them shortly),
+        the flow rate plot is uploaded as a binary file with `upload_plot`
+        and the GUI is updated to reflect this state.
 
         Returns
         -------
@@ -321,10 +687,6 @@ def main_window():
         gui_pressure = cpap_pressure.get()
         global room_number_upload
         room_number_upload = room_number.get()
-        try:
-            plot_b64 = file_to_b64_string(plot_filename)
-        except NameError:
-            plot_b64 = "No Image Uploaded"
         out_dict = {
             "room_number": safe_int_conversion(room_number.get()),
             "patient_name": patient_name.get(),
@@ -332,13 +694,20 @@ def main_window():
             "cpap_pressure": safe_int_conversion(gui_pressure),
             "cpap_calculations": [
                 formatted_time, breath_rate_bpm,
-                apnea_count, plot_b64
-            ]
+                apnea_count, None
+            ],
+            "flow_waveform": flow_waveform
         }
         r = requests.post(server + "/patient/upload_patient", json=out_dict)
         print(r.text)
         print(r.status_code)
-        if r.status_code == 200:
+        if r.status_code in (200, 202):
+            try:
+                r = upload_plot(out_dict["room_number"], formatted_time,
+                                plot_filename)
+                print(r.text)
+            except (NameError, OSError):
+                print("No Image Uploaded")
             update_gui_after_upload()
 
     def reset_gui():
@@ -368,6 +737,7 @@ def main_window():
         cpap_events_label.config(text="")
         apnea_events_label.config(text="")
         cpap_flow_image.config(image='', text="CPAP Flow Image Here")
+        stop_pressure_subscription()
 
     def reset_device():
         """
@@ -394,38 +764,65 @@ def main_window():
         # Placeholder function for updating patient information
         upload_data()
 
-    def contact_server():
+    def start_pressure_subscription():
         """
-        Contacts the server to fetch and update CPAP pressure in the GUI.
+        Starts receiving CPAP pressure changes for the uploaded room.
 
-        This function sends a request to the server to fetch the CPAP pressure
-        for the patient identified by their room number. If successful, it
-        updates the CPAP events label in the GUI with this information and
-        schedules the function to run again after 25 seconds. Handles TypeError
-        and ValueError by printing a message and rescheduling the call.
+        A background thread running `subscribe_pressure` is started for the
+        room number of the last upload, replacing any previous subscription.
+        Entries that are not valid room numbers are ignored.
 
         Returns
         -------
         None
-            The function does not return any value but updates the GUI and
-            periodically contacts the server.
         """
-        try:
-            room_num = int(room_number_upload)
-            print("contacting server to check for incoming pressure")
-            r1 = requests.get(
-                server + '/patient/fetch_pressure/' + str(room_num))
-            print(r1.text)
-            print(r1.status_code)
-            gui_pressure = r1.text
-            cpap_events_label.config(text=gui_pressure)
-            root.after(25000, contact_server)
-        except TypeError:
+        global pressure_subscription
+        room_num = safe_int_conversion(room_number_upload)
+        if room_num is None:
             print("Patient not specified in database yet")
-            root.after(25000, contact_server)
-        except ValueError:
-            print("Patient not specified in database yet")
-            root.after(25000, contact_server)
+            return
+        stop_pressure_subscription()
+        pressure_subscription = threading.Event()
+        threading.Thread(target=subscribe_pressure,
+                         args=(room_num, pressure_updates,
+                               pressure_subscription),
+                         daemon=True).start()
+
+    def stop_pressure_subscription():
+        """
+        Ends the running CPAP pressure subscription, if any.
+
+        Returns
+        -------
+        None
+        """
+        global pressure_subscription
+        if pressure_subscription is not None:
+            pressure_subscription.set()
+            pressure_subscription = None
+
+    def apply_pressure_updates():
+        """
+        Applies pressures received by the subscription thread to the GUI.
+
+        Tk widgets may only be changed from the main loop, so the background
+        thread hands new pressures over through a queue that this function
+        drains every half second. Only the newest pressure is displayed.
+
+        Returns
+        -------
+        None
+        """
+        pressure = None
+        while True:
+            try:
+                pressure = pressure_updates.get_nowait()
+            except queue.Empty:
+                break
+        if pressure is not None:
+            print("Received CPAP pressure {}".format(pressure))
+            cpap_events_label.config(text=pressure)
+        root.after(500, apply_pressure_updates)
 
     root = tk.Tk()
     root.title("CPAP Machine Patient Interface")
@@ -454,8 +851,12 @@ def main_window():
     cpap_events_label = tk.Label(root, text=str(gui_pressure))
     cpap_events_label.grid(row=3, column=2)
 
-    tk.Button(root, text="Select CPAP Data File", command=select_file).grid(
-        row=4, column=0, columnspan=2)
+    select_button = tk.Button(root, text="Select CPAP Data File",
+                              command=select_file)
+    select_button.grid(row=4, column=0, columnspan=2)
+    cancel_button = tk.Button(root, text="Cancel Analysis",
+                              command=cancel_analysis, state=tk.DISABLED)
+    cancel_button.grid(row=4, column=2)
 
     # Calculated Data Display
     tk.Label(root, text="Breathing Rate:").grid(row=5, column=0)
@@ -478,7 +879,7 @@ def main_window():
     tk.Button(root, text="Update Patient Info", command=upload_data).grid(
         row=9, column=0, columnspan=2)
 
-    root.after(3000, contact_server)
+    root.after(500, apply_pressure_updates)
     # Start the GUI
     root.mainloop()
 
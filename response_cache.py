@@ -0,0 +1,131 @@
+import collections
+import threading
+
+
+class ResponseCache:
+    """Bounded in-process cache of encoded responses, one per room and
+    representation.
+
+    Each entry holds the body of a response in one representation, such as
+    gzip compressed JSON, together with the version tag of the room it was
+    built from. A lookup only hits if the caller's current tag matches, so a
+    response built before a write is never served after it, even if the
+    write raced with the caching request. Writes should still call
+    `invalidate` so stale bodies do not take up room. Entries are evicted
+    least recently used first once their total size exceeds `max_bytes`.
+
+    Parameters
+    ----------
+    max_bytes : int
+        maximum total size of the cached bodies in bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, room_number, tag, variant=None):
+        """Returns the cached body of a room if it is still current.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of interest
+        tag : str
+            current version tag of the room
+        variant : hashable
+            representation of the body
+
+        Returns
+        -------
+        bytes or None
+            cached body, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get((room_number, variant))
+            if entry is None or entry[0] != tag:
+                self._misses += 1
+                return None
+            self._entries.move_to_end((room_number, variant))
+            self._hits += 1
+            return entry[1]
+
+    def put(self, room_number, tag, body, variant=None):
+        """Caches the body of a room, replacing any older entry of the same
+        representation.
+
+        Bodies larger than the whole cache are not stored.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of interest
+        tag : str
+            version tag of the room the body was built from
+        body : bytes
+            encoded response body
+        variant : hashable
+            representation of the body
+
+        Returns
+        -------
+        None
+        """
+        key = (room_number, variant)
+        with self._lock:
+            self._remove(key)
+            if len(body) > self.max_bytes:
+                return
+            self._entries[key] = (tag, body)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _key, (_tag, old) = self._entries.popitem(last=False)
+                self._size -= len(old)
+                self._evictions += 1
+
+    def invalidate(self, room_number):
+        """Drops every cached body of a room.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the modified room
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key[0] == room_number]:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def stats(self):
+        """Returns the counters of the cache.
+
+        Returns
+        -------
+        dict
+            number of hits, misses and evictions, hit rate as a fraction of
+            lookups (None before the first lookup), and the number of entries
+            and bytes cached
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {"hits": self._hits,
+                    "misses": self._misses,
+                    "evictions": self._evictions,
+                    "hit_rate": round(self._hits / lookups, 4)
+                    if lookups else None,
+                    "entries": len(self._entries),
+                    "bytes": self._size}
@@ -0,0 +1,286 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from DB_init import SleepLabRooms, ArchivedCalculations, DailySummaries
+from DB_init import TaskLeases, get_collection
+
+DUPLICATE_KEY_ERROR = 11000
+COMPACTION_LEASE = "history_compaction"
+
+
+def calculation_day(calculation):
+    """Returns midnight of the day a calculation was recorded on.
+
+    Parameters
+    ----------
+    calculation : dict
+        stored CpapCalculation subdocument
+
+    Returns
+    -------
+    datetime.datetime or None
+        start of the day, or None if the timestamp could not be parsed
+    """
+    recorded_at = calculation.get("recorded_at")
+    if recorded_at is None:
+        return None
+    return datetime(recorded_at.year, recorded_at.month, recorded_at.day)
+
+
+def summary_update(room_number, calculation):
+    """Builds the upsert rolling a calculation into its daily summary.
+
+    The update only matches a summary that does not list the timestamp of
+    the calculation yet. If the calculation was already rolled up, the
+    upsert instead tries to insert a second summary for the day and fails
+    on the unique index, so adding a calculation twice changes nothing.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    calculation : dict
+        stored CpapCalculation subdocument with a parsable timestamp
+
+    Returns
+    -------
+    pymongo.UpdateOne
+        update of the DailySummaries collection
+    """
+    breath_rate = calculation.get("breath_rate_bpm")
+    apnea_count = calculation.get("apnea_count")
+    update = {"$inc": {"count": 1,
+                       "breath_rate_sum": float(breath_rate or 0),
+                       "breath_rate_count": int(breath_rate is not None),
+                       "apnea_count_sum": apnea_count or 0,
+                       "apnea_count_count": int(apnea_count is not None)},
+              "$push": {"timestamps": calculation["timestamp"]}}
+    maxima = {}
+    if breath_rate is not None:
+        maxima["breath_rate_max"] = float(breath_rate)
+    if apnea_count is not None:
+        maxima["apnea_count_max"] = apnea_count
+    if maxima:
+        update["$max"] = maxima
+    return UpdateOne({"room_number": room_number,
+                      "day": calculation_day(calculation),
+                      "timestamps": {"$ne": calculation["timestamp"]}},
+                     update, upsert=True)
+
+
+def compact_room(room, retain):
+    """Compacts the calculation history of one room.
+
+    All calculations but the newest `retain` are copied, image included, to
+    the ArchivedCalculations collection and rolled into the daily summaries
+    of the room, then pulled from the room document. The pull removes
+    exactly the subdocuments that were read, so calculations appended by
+    concurrent uploads are never touched. Every step can be repeated
+    without effect, so a compaction interrupted half way is completed by
+    the next run. Entries not yet converted by `migrate_calculations` are
+    left alone.
+
+    Parameters
+    ----------
+    room : dict
+        room document with its "_id" and "cpap_calculations"
+    retain : int
+        number of newest calculations kept in full
+
+    Returns
+    -------
+    int
+        number of compacted calculations
+    """
+    room_number = room["_id"]
+    old = [calculation for calculation in room["cpap_calculations"][:-retain]
+           if isinstance(calculation, dict) and "timestamp" in calculation]
+    if not old:
+        return 0
+    get_collection(ArchivedCalculations).bulk_write(
+        [ReplaceOne({"room_number": room_number,
+                     "timestamp": calculation["timestamp"]},
+                    {"room_number": room_number,
+                     "timestamp": calculation["timestamp"],
+                     "calculation": calculation}, upsert=True)
+         for calculation in old], ordered=False)
+    updates = [summary_update(room_number, calculation)
+               for calculation in old
+               if calculation_day(calculation) is not None]
+    if updates:
+        try:
+            get_collection(DailySummaries).bulk_write(updates,
+                                                      ordered=False)
+        except BulkWriteError as error:
+            errors = error.details.get("writeErrors", [])
+            if any(e["code"] != DUPLICATE_KEY_ERROR for e in errors):
+                raise
+    get_collection(SleepLabRooms).update_one(
+        {"_id": room_number},
+        {"$pull": {"cpap_calculations": {"$in": old}}})
+    return len(old)
+
+
+def compact_history(retain, on_compacted=None):
+    """Enforces the retention policy on every room.
+
+    Only rooms holding more than `retain` calculations are read.
+
+    Parameters
+    ----------
+    retain : int
+        number of newest calculations kept in full in each room
+    on_compacted : callable
+        optional function called with the room number of every room whose
+        history was compacted
+
+    Returns
+    -------
+    int
+        number of compacted calculations
+    """
+    rooms = get_collection(SleepLabRooms).find(
+        {"cpap_calculations.{}".format(retain): {"$exists": True}},
+        {"cpap_calculations": 1})
+    compacted = 0
+    for room in rooms:
+        count = compact_room(room, retain)
+        if count and on_compacted is not None:
+            on_compacted(room["_id"])
+        compacted += count
+    return compacted
+
+
+def acquire_lease(name, holder, seconds):
+    """Takes or renews the lease of a background task.
+
+    The lease is granted if nobody holds it, if `holder` already does, or
+    if the lease of another holder has expired. A lease held by another
+    process makes the upsert insert a second lease of the same name, which
+    fails on the primary key.
+
+    Parameters
+    ----------
+    name : str
+        name of the task
+    holder : str
+        ID of the process asking for the lease
+    seconds : float
+        time the lease is granted for
+
+    Returns
+    -------
+    bool
+        True if `holder` now holds the lease
+    """
+    now = datetime.utcnow()
+    try:
+        get_collection(TaskLeases).update_one(
+            {"_id": name,
+             "$or": [{"holder": holder}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"holder": holder,
+                      "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def release_lease(name, holder):
+    """Gives up the lease of a background task, if `holder` holds it.
+
+    Parameters
+    ----------
+    name : str
+        name of the task
+    holder : str
+        ID of the process holding the lease
+
+    Returns
+    -------
+    None
+    """
+    get_collection(TaskLeases).delete_one({"_id": name, "holder": holder})
+
+
+class CompactionTask:
+    """Background thread enforcing the retention policy.
+
+    The history of every room is compacted with `compact_history` when the
+    task starts and then every `interval` seconds. Failures are logged and
+    retried at the next run. Every server process sharing the database
+    starts the task, but a run only proceeds while its process holds the
+    COMPACTION_LEASE, taken for two intervals at a time, so one process
+    compacts and another takes over once the lease of a stopped one
+    expires.
+
+    Parameters
+    ----------
+    retain : int
+        number of newest calculations kept in full in each room
+    interval : float
+        seconds between compactions
+    """
+
+    def __init__(self, retain, interval):
+        self.retain = max(int(retain), 1)
+        self.interval = interval
+        self.holder = "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+                                        uuid.uuid4().hex)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, on_compacted=None):
+        """Starts the background thread, unless it is already running.
+
+        Parameters
+        ----------
+        on_compacted : callable
+            optional function called with the room number of every room
+            whose history was compacted
+
+        Returns
+        -------
+        None
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(on_compacted,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and waits for it to finish.
+
+        Returns
+        -------
+        None
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            release_lease(COMPACTION_LEASE, self.holder)
+        except Exception:
+            logging.exception("Releasing the compaction lease failed")
+
+    def _run(self, on_compacted):
+        while True:
+            try:
+                if acquire_lease(COMPACTION_LEASE, self.holder,
+                                 2 * self.interval):
+                    compacted = compact_history(self.retain, on_compacted)
+                    if compacted:
+                        logging.info("Compacted %d calculations", compacted)
+            except Exception:
+                logging.exception("History compaction failed")
+            if self._stop.wait(self.interval):
+                return
@@ -1,13 +1,154 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response
+from pymongo import monitoring
 from pymodm import connect
 from pymodm import errors as pymodm_errors
 from datetime import datetime, timedelta
-from DB_init import SleepLabRooms as db
+from DB_init import make_calculation, parse_timestamp
+from storage import make_store, calculation_summary
+from events import EventChannel, stream_events
+from analysis_jobs import AnalysisJobs
+from retention import CompactionTask
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+from write_behind import WriteBehindQueue
+from metrics import RequestMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from wire import negotiate, encode_body
+from thumbnails import (THUMBNAIL_SIZES, THUMBNAIL_TYPE, make_thumbnail,
+                        thumbnails_available)
+from CPAP_measurement import (new_stream_state, parse_sample,
+                              update_stream_metrics, query_waveform,
+                              WAVEFORM_CHUNK, WAVEFORM_MAX_BUCKETS)
+import atexit
 import base64
+import hashlib
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 import requests
 
 app = Flask(__name__)
 
+# Per-route latency, size and database call metrics, exposed at /metrics.
+# The listener must be registered before the MongoDB client is created.
+request_metrics = RequestMetrics()
+monitoring.register(request_metrics)
+
+# Room storage behind the drivers, chosen with CPAP_STORAGE: "mongo" (the
+# default), "memory", or "sqlite:" followed by a database file.
+store = make_store(os.environ.get("CPAP_STORAGE", "mongo"))
+
+# Per-room version counters backing the ETags of the polling routes. Counters
+# are bumped after every write to a room, so a conditional GET can be
+# answered from memory without a database read. The boot token keeps tags
+# issued by a previous server process from matching after a restart.
+boot_token = uuid.uuid4().hex[:8]
+room_versions = {}
+room_versions_lock = threading.Lock()
+# Bumped with every room version, so reads covering the whole ward, such as
+# the room list, can be keyed by it.
+ward_version = 0
+
+# Encoded `/lab/fetch_patient` responses, keyed by room and version tag, so
+# repeated polls of an unchanged room cost neither a database read nor a
+# JSON encoding of the calculation history.
+RESPONSE_CACHE_BYTES = int(os.environ.get("CPAP_RESPONSE_CACHE_BYTES",
+                                          64 * 2 ** 20))
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES)
+
+# Concurrent identical reads of the polling routes share one storage call.
+# Keys carry the room or ward version, and a finished read is shared for
+# COALESCE_WINDOW more seconds to absorb bursts of polls.
+COALESCE_WINDOW = float(os.environ.get("CPAP_COALESCE_WINDOW", 0.5))
+single_flight = SingleFlight(COALESCE_WINDOW)
+
+# Events published on writes to a room, consumed by the streaming routes.
+room_events = EventChannel()
+SSE_HEARTBEAT_SECONDS = 15.0
+# Same threshold the GUIs use to display the apnea count in red.
+APNEA_ALERT_THRESHOLD = 2
+
+# Server-side analysis of uploaded CPAP data files.
+ANALYSIS_WORKERS = int(os.environ.get("CPAP_ANALYSIS_WORKERS",
+                                      os.cpu_count() or 1))
+MAX_PENDING_ANALYSES = int(os.environ.get("CPAP_MAX_PENDING_ANALYSES", 32))
+analysis_jobs = AnalysisJobs(ANALYSIS_WORKERS, MAX_PENDING_ANALYSES)
+
+# Incremental analysis of samples streamed from bedside devices, one entry
+# per room holding the session ID, the bounded analysis state and a lock
+# serializing the batches of the room.
+MAX_SAMPLES_PER_BATCH = 6000
+live_streams = {}
+live_streams_lock = threading.Lock()
+
+# Optional write-behind mode of /patient/upload_patient, enabled by naming a
+# journal file: uploads are journaled and acknowledged, then stored in group
+# commits every CPAP_FLUSH_INTERVAL seconds or CPAP_FLUSH_BATCH uploads.
+WRITE_BEHIND_JOURNAL = os.environ.get("CPAP_WRITE_BEHIND_JOURNAL")
+FLUSH_INTERVAL = float(os.environ.get("CPAP_FLUSH_INTERVAL", 1.0))
+FLUSH_BATCH = int(os.environ.get("CPAP_FLUSH_BATCH", 500))
+write_behind = WriteBehindQueue(WRITE_BEHIND_JOURNAL, FLUSH_INTERVAL,
+                                FLUSH_BATCH) if WRITE_BEHIND_JOURNAL else None
+
+# Largest number of records accepted by POST /patient/upload_batch.
+MAX_UPLOAD_BATCH = int(os.environ.get("CPAP_MAX_UPLOAD_BATCH", 1000))
+# Largest number of rooms read or updated by the multi-room pressure routes.
+MAX_PRESSURE_ROOMS = 500
+
+# Flow rate plots uploaded as raw bytes by PUT /patient/image, read from the
+# request stream in chunks and refused beyond the size limit.
+MAX_IMAGE_BYTES = int(os.environ.get("CPAP_MAX_IMAGE_BYTES", 8 * 2 ** 20))
+IMAGE_CONTENT_TYPES = ("image/png", "image/jpeg")
+IMAGE_READ_CHUNK = 64 * 1024
+# Plots and thumbnails are served with this Cache-Control max-age in seconds
+# and an ETag to revalidate them afterwards.
+IMAGE_MAX_AGE = int(os.environ.get("CPAP_IMAGE_MAX_AGE", 86400))
+
+# Default range and resolution of the trend route.
+TREND_DEFAULT_DAYS = 30
+TREND_DEFAULT_POINTS = 60
+TREND_MAX_POINTS = 1000
+
+# Retention policy of the calculation history kept in the room documents.
+# Older calculations are archived and rolled into daily summaries by a
+# background task.
+RETAIN_CALCULATIONS = int(os.environ.get("CPAP_RETAIN_CALCULATIONS", 30))
+COMPACTION_INTERVAL = float(os.environ.get("CPAP_COMPACTION_INTERVAL", 3600))
+compaction = CompactionTask(RETAIN_CALCULATIONS, COMPACTION_INTERVAL)
+
+
+def prepare_store():
+    """Readies the room storage before the server takes requests.
+
+    With MongoDB this creates missing indexes, migrates and backfills old
+    room documents and starts the history compaction, all of which are safe
+    to run from several workers at once. The other backends keep their full
+    history and need no maintenance. In write-behind mode the upload journal
+    is replayed and its flusher started.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    store.prepare()
+    if store.name == "mongo":
+        compaction.start(mark_room_changed)
+    if write_behind is not None:
+        if write_behind.start(commit_journaled_uploads):
+            atexit.register(write_behind.stop)
+        else:
+            logging.warning("Upload journal %s is used by another process; "
+                            "uploads are stored synchronously",
+                            WRITE_BEHIND_JOURNAL)
+
 
 def format_date(datetime_obj):
     """Converts datetime objects an appropriately formatted string
@@ -131,6 +272,255 @@ def format_type_list_string(type_list):
     return type_string
 
 
+@app.before_request
+def start_request_metrics():
+    """Notes the start of a request for `request_metrics`.
+
+    Returns
+    -------
+    None
+    """
+    g.request_started = time.perf_counter()
+    request_metrics.start_request()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Records the latency and sizes of a finished request.
+
+    The latency runs until the response is ready, so for event streams it
+    covers the time to the first byte only. Requests not matching any route
+    are grouped under a single "unmatched" route.
+
+    Parameters
+    ----------
+    response : Response
+        response of the request
+
+    Returns
+    -------
+    Response
+        the response, unchanged
+    """
+    started = g.get("request_started")
+    if started is not None:
+        rule = request.url_rule
+        request_metrics.finish_request(
+            rule.rule if rule is not None else "unmatched", request.method,
+            response.status_code, time.perf_counter() - started,
+            request.content_length or 0,
+            None if response.is_streamed else response.content_length)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """GET route exposing the server metrics to Prometheus.
+
+    Returns the request, database and response cache metrics of this worker
+    process in the Prometheus text format.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    Response
+        exposition text
+    """
+    cache = response_cache.stats()
+    coalescing = single_flight.stats()
+    samples = [
+        ("cpap_response_cache_hits_total", "counter",
+         "Lookups answered by the fetch_patient response cache.",
+         cache["hits"]),
+        ("cpap_response_cache_misses_total", "counter",
+         "Lookups missed by the fetch_patient response cache.",
+         cache["misses"]),
+        ("cpap_response_cache_evictions_total", "counter",
+         "Bodies evicted from the fetch_patient response cache.",
+         cache["evictions"]),
+        ("cpap_response_cache_entries", "gauge",
+         "Bodies held by the fetch_patient response cache.",
+         cache["entries"]),
+        ("cpap_response_cache_bytes", "gauge",
+         "Bytes held by the fetch_patient response cache.", cache["bytes"]),
+        ("cpap_coalesced_calls_total", "counter",
+         "Storage reads run by the polling routes.",
+         coalescing["calls"]),
+        ("cpap_coalesced_shared_total", "counter",
+         "Polling requests served the result of another request's read.",
+         coalescing["shared"]),
+        ("cpap_analysis_jobs_pending", "gauge",
+         "Analysis jobs queued or running.", analysis_jobs.pending())]
+    if write_behind is not None and write_behind.running():
+        queue = write_behind.stats()
+        samples += [
+            ("cpap_write_behind_pending", "gauge",
+             "Journaled uploads waiting for a group commit.",
+             queue["pending"]),
+            ("cpap_write_behind_oldest_pending_seconds", "gauge",
+             "Age of the oldest journaled upload waiting for a commit.",
+             queue["oldest_pending_seconds"] or 0),
+            ("cpap_write_behind_journal_bytes", "gauge",
+             "Size of the upload journal.", queue["journal_bytes"]),
+            ("cpap_write_behind_flushed_total", "counter",
+             "Journaled uploads committed to the room storage.",
+             queue["flushed"]),
+            ("cpap_write_behind_failed_flushes_total", "counter",
+             "Group commits that failed and were retried.",
+             queue["failed_flushes"])]
+    return Response(request_metrics.render(samples),
+                    content_type=METRICS_CONTENT_TYPE)
+
+
+def room_etag(room_number):
+    """Returns the current version tag of a room.
+
+    The tag combines the boot token of this server process, the room number
+    and the number of writes made to the room since startup. It is sent as
+    the ETag of the polling routes and compared against the `If-None-Match`
+    header of later requests.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of interest
+
+    Returns
+    -------
+    str
+        version tag of the room
+    """
+    version = room_versions.get(room_number, 0)
+    return "{}-{}-{}".format(boot_token, room_number, version)
+
+
+def rooms_etag(room_numbers):
+    """Returns a version tag covering several rooms.
+
+    The tag is a digest of the tags of the rooms, so it changes as soon as
+    any of the rooms is written.
+
+    Parameters
+    ----------
+    room_numbers : list of int
+        room numbers of interest, in request order
+
+    Returns
+    -------
+    str
+        version tag of the rooms
+    """
+    tags = ",".join(room_etag(room_number) for room_number in room_numbers)
+    digest = hashlib.sha1(tags.encode("utf-8")).hexdigest()[:16]
+    return "{}-{}".format(boot_token, digest)
+
+
+def mark_room_changed(room_number):
+    """Bumps the version tag of a room after a write.
+
+    This function must be called after a write to the room has been saved to
+    the database. Any tag previously handed out for the room stops matching,
+    so the next conditional GET performs a full read, and the cached response
+    of the room is dropped.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the modified room
+
+    Returns
+    -------
+    None
+    """
+    global ward_version
+    with room_versions_lock:
+        room_versions[room_number] = room_versions.get(room_number, 0) + 1
+        ward_version += 1
+    response_cache.invalidate(room_number)
+
+
+def room_not_modified(room_number, weak=False):
+    """Checks a conditional GET against the in-memory version table.
+
+    Returns True if the `If-None-Match` header of the current request contains
+    the current tag of the room, in which case the route can answer with
+    `304 Not Modified` without touching the database. Routes that send the
+    tag as a weak ETag must pass `weak`, so that it matches in its weak form.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of interest
+    weak : bool
+        True if the route sends the tag as a weak ETag
+
+    Returns
+    -------
+    bool
+        True if the client copy is still current, False otherwise
+    """
+    if weak:
+        return request.if_none_match.contains_weak(room_etag(room_number))
+    return request.if_none_match.contains(room_etag(room_number))
+
+
+def negotiated_response(body, media_type, encoding):
+    """Wraps an encoded body in a response.
+
+    Parameters
+    ----------
+    body : bytes
+        body built by `wire.encode_body`
+    media_type : str
+        media type of the body
+    encoding : str or None
+        content coding of the body
+
+    Returns
+    -------
+    Response
+        response that varies with the `Accept` and `Accept-Encoding` headers
+    """
+    response = Response(body, mimetype=media_type)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.update(("Accept", "Accept-Encoding"))
+    return response
+
+
+def api_response(data, status_code=200):
+    """Encodes the result of a driver in the representation the client asks
+    for.
+
+    The body is MessagePack if the client prefers it and JSON otherwise,
+    encoded with orjson when it is installed, and compressed with brotli or
+    gzip when the client accepts them and the body is large enough to
+    benefit. Used by the routes returning large payloads in place of
+    `jsonify`.
+
+    Parameters
+    ----------
+    data : object
+        JSON serializable result
+    status_code : int
+        status code
+
+    Returns
+    -------
+    Response
+        encoded response
+    int
+        status code
+    """
+    media_type, encoding = negotiate(request.accept_mimetypes,
+                                     request.accept_encodings)
+    body, encoding = encode_body(data, media_type, encoding)
+    return negotiated_response(body, media_type, encoding), status_code
+
+
 @app.route('/lab/list_rooms', methods=['GET'])
 def list_rooms():
     """Returns list of room numbers in server database.
@@ -151,7 +541,8 @@ def list_rooms():
     int
         status code
     """
-    rooms, status_code = list_rooms_driver()
+    rooms, status_code = single_flight.do(("list_rooms", ward_version),
+                                          list_rooms_driver)
     return jsonify(rooms), status_code
 
 
@@ -159,10 +550,9 @@ def list_rooms_driver():
     """
     Returns list of room numbers in server database.
 
-    This function implements the GET route `/lab/list_rooms`. A QuerySet
-    object containing SleepLabRooms objects is called from the database. The
-    QuerySet object is iterated over, and each room number is appended to a
-    list. The list of room numbers is returned with a 200 status code.
+    This function implements the GET route `/lab/list_rooms`. The room
+    numbers are read from the room storage in ascending order and returned
+    with a 200 status code.
 
     Parameters
     ----------
@@ -175,11 +565,200 @@ def list_rooms_driver():
     int
         status code
     """
-    results = db.objects.raw({})
-    rooms = []
-    for patient in results:
-        rooms.append(patient.room_number)
-    return rooms, 200
+    return store.list_rooms(), 200
+
+
+@app.route('/lab/dashboard', methods=['GET'])
+def dashboard():
+    """GET route returning a summary of every occupied room.
+
+    This function implements the GET `/lab/dashboard` route. A driver
+    function is called returning one summary per room, which is encoded by
+    `api_response` and returned with a 200 status code.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        JSON encoding of list of room summaries
+    int
+        status code
+    """
+    rooms, status_code = single_flight.do(("dashboard", ward_version),
+                                          dashboard_driver)
+    return api_response(rooms, status_code)
+
+
+def dashboard_driver():
+    """Returns a summary of every occupied room.
+
+    This function implements the GET `/lab/dashboard` route. All rooms are
+    read at once without their calculation history, relying on the summary
+    of the latest calculation kept with each room instead. The rooms are
+    returned as dictionaries with the following keys, ordered by room
+    number:
+
+        - room_number, patient_name, patient_mrn, cpap_pressure
+        - timestamp, breath_rate_bpm, apnea_count of the latest calculation,
+          or None if the patient has no calculation yet
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    list of dict
+        summary of each room
+    int
+        status code
+    """
+    return store.room_summaries(), 200
+
+
+@app.route('/lab/trend', methods=['GET'])
+def trend():
+    """GET route returning breath rate and apnea count trends.
+
+    This function implements the GET `/lab/trend` route. The query arguments
+    are passed to a driver function which aggregates the calculation history
+    of the requested rooms on the database server. The result, or an error
+    message, is encoded by `api_response` and returned with the status code
+    of the driver.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        JSON encoded trend or error message
+    int
+        status code
+    """
+    answer, status_code = trend_driver(request.args)
+    return api_response(answer, status_code)
+
+
+def trend_driver(args):
+    """Aggregates the calculation history of rooms into time buckets.
+
+    The following query arguments are accepted, all optional:
+
+        - rooms: comma-separated room numbers, every room if missing
+        - start, end: timestamps of the range, as "YYYY-MM-DD HH:MM:SS" or
+          ISO 8601; the range ends now and covers 30 days by default.
+          Timestamps with a UTC offset are converted to UTC, as those of
+          the calculations are
+        - points: maximum number of buckets per room, 60 by default and at
+          most 1000
+
+    The range is split into at most `points` buckets of equal length, never
+    shorter than a minute, and the calculations of each room falling in a
+    bucket are reduced to their count and the mean and maximum breath rate
+    and apnea count. The bucket totals are computed by the room storage,
+    on the database server where it has one. Only non-empty
+    buckets are returned, so the response stays small however long the
+    history is. Invalid arguments return an error message and a 400 status
+    code.
+
+    Parameters
+    ----------
+    args : dict
+        query arguments of the request
+
+    Returns
+    -------
+    dict or str
+        "start", "end" and "bucket_seconds" of the aggregation and a "rooms"
+        list holding the "room_number" and "buckets" of each room with data
+        in the range, or an error message
+    int
+        status code
+    """
+    try:
+        end = parse_timestamp(args["end"]) if "end" in args \
+            else datetime.now().replace(microsecond=0)
+        start = parse_timestamp(args["start"]) if "start" in args \
+            else end - timedelta(days=TREND_DEFAULT_DAYS)
+        points = int(args.get("points", TREND_DEFAULT_POINTS))
+        rooms = None
+        if args.get("rooms"):
+            rooms = [int(room) for room in args["rooms"].split(",")]
+    except ValueError:
+        return "start and end must be timestamps, points an integer and " \
+            "rooms a comma-separated list of room numbers.", 400
+    if end <= start or not 1 <= points <= TREND_MAX_POINTS:
+        return "end must be after start and points between 1 and " \
+            "{}.".format(TREND_MAX_POINTS), 400
+    span = (end - start).total_seconds()
+    bucket_seconds = max(int(-(-span // points)), 60)
+    totals = {}
+    for entry in store.trend_totals(rooms, start, end, bucket_seconds):
+        key = (entry["_id"]["room"], entry["_id"]["bucket"])
+        add_trend_totals(totals.setdefault(key, {}), entry)
+    trends = {}
+    for (room, bucket), total in sorted(totals.items()):
+        bucket_start = start + timedelta(seconds=bucket * bucket_seconds)
+        trends.setdefault(room, []).append({
+            "start": format_date(bucket_start),
+            "count": total["count"],
+            "breath_rate_mean": trend_mean(total, "breath_rate"),
+            "breath_rate_max": total["breath_rate_max"],
+            "apnea_count_mean": trend_mean(total, "apnea_count"),
+            "apnea_count_max": total["apnea_count_max"]})
+    return {"start": format_date(start),
+            "end": format_date(end),
+            "bucket_seconds": bucket_seconds,
+            "rooms": [{"room_number": room, "buckets": buckets}
+                      for room, buckets in sorted(trends.items())]}, 200
+
+
+def add_trend_totals(total, entry):
+    """Adds the totals of an aggregated bucket to a running total.
+
+    Parameters
+    ----------
+    total : dict
+        running total of a bucket, updated in place
+    entry : dict
+        bucket produced by `RoomStore.trend_totals`
+
+    Returns
+    -------
+    None
+    """
+    for key in ("count", "breath_rate_sum", "breath_rate_count",
+                "apnea_count_sum", "apnea_count_count"):
+        total[key] = total.get(key, 0) + entry[key]
+    for key in ("breath_rate_max", "apnea_count_max"):
+        if total.get(key) is None or (entry[key] is not None
+                                      and entry[key] > total[key]):
+            total[key] = entry[key]
+
+
+def trend_mean(total, name):
+    """Returns the mean of a trend value rounded to 3 decimals.
+
+    Parameters
+    ----------
+    total : dict
+        totals of a bucket
+    name : str
+        "breath_rate" or "apnea_count"
+
+    Returns
+    -------
+    float or None
+        mean of the calculations with a value, None if none had one
+    """
+    if not total[name + "_count"]:
+        return None
+    return round(total[name + "_sum"] / total[name + "_count"], 3)
 
 
 @app.route('/patient/upload_patient', methods=['POST'])
@@ -187,18 +766,862 @@ def upload_patient():
     """
     POST route for uploading patient data.
 
-    This function implements the POST route `/patient/upload_patient`. This
-    POST request receives a JSON string containing patient data and forwards
-    it to the `upload_patient_driver` function. The driver function processes
-    the data and returns a confirmation/error message along with a status code.
+    This function implements the POST route `/patient/upload_patient`. This
+    POST request receives a JSON string containing patient data and forwards
+    it to the `upload_patient_driver` function. The driver function processes
+    the data and returns a confirmation/error message along with a status code.
+
+    The JSON string should contain the following keys:
+        - room_number: int, patient room number.
+        - patient_name: string, patient name.
+        - patient_mrn: int, patient medical record number.
+        - cpap_pressure: int, entered cpap pressure number.
+        - cpap_calculations: list containing breathing rate,
+        number of apnea events and flow rate vs time.
+        - flow_waveform: optional dict, compact flow rate waveform of the
+        calculation built by `CPAP_measurement.encode_waveform`.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        Confirmation or error message.
+    int
+        HTTP status code.
+    """
+    in_data = request.get_json()
+    result, status_code = upload_patient_driver(in_data)
+    return result, status_code
+
+
+def upload_patient_function(in_data):
+    # Rigurously tested using the MongoDB database
+    """
+    Uploads or updates a patient's data in the database.
+
+    This function takes patient data from `in_data`, including CPAP pressure,
+    room number, and CPAP calculations. It attempts to find an existing patient
+    record by MRN. If found, the record is updated; if not, a new record is
+    created. A flow rate waveform sent along is checked first by
+    `waveform_validation`, which returns an error message and a 400 status
+    code if it is malformed, and stored once the patient is, in their room.
+    Returns a message and HTTP status code upon completion.
+
+    Parameters
+    ----------
+    in_data : dict
+        A dictionary containing the patient's data including MRN, name, CPAP
+        pressure, and calculations.
+
+    Returns
+    -------
+    tuple
+        A tuple containing a response message and HTTP status code.
+    """
+    new_pressure = in_data["cpap_pressure"]
+    room_number = in_data["room_number"]
+    new_cpap_calculations = in_data["cpap_calculations"]
+    if in_data.get("flow_waveform") is not None:
+        msg = waveform_validation(in_data["flow_waveform"])
+        if msg is not True:
+            return msg, 400
+    room_number, created = store.save_upload(
+        room_number, in_data["patient_mrn"], in_data["patient_name"],
+        new_pressure, new_cpap_calculations)
+    # Stored once the patient is, in the room they were stored in.
+    if in_data.get("flow_waveform") is not None:
+        store_waveform(room_number, new_cpap_calculations,
+                       in_data["flow_waveform"])
+    mark_room_changed(room_number)
+    publish_pressure(room_number, new_pressure)
+    publish_upload(room_number, new_cpap_calculations)
+    if created:
+        return "Patient successfully Added.", 200
+    return "Patient Info updated successfully.", 200
+
+
+def store_waveform(room_number, cpap_calculation, waveform):
+    """Stores the compact flow rate waveform of a CPAP calculation.
+
+    The waveform is saved in the room storage under the room number and
+    the timestamp of the calculation, replacing any waveform stored for
+    the same calculation. Calculations without a timestamp are ignored.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    cpap_calculation : list
+        calculation the waveform belongs to
+    waveform : dict
+        waveform built by `CPAP_measurement.encode_waveform`
+
+    Returns
+    -------
+    None
+    """
+    summary = calculation_summary(cpap_calculation)
+    if summary is None or type(waveform) is not dict:
+        return
+    store.put_waveform(room_number, summary["timestamp"], waveform)
+
+
+@app.route('/lab/waveform/<int:room_number>/<timestamp>', methods=['GET'])
+def fetch_waveform(room_number, timestamp):
+    """GET route returning the flow rate waveform of a CPAP calculation.
+
+    This function implements the GET
+    `/lab/waveform/<room_number>/<timestamp>` route, where the timestamp is
+    the one of the calculation as listed by `/lab/fetch_patient`. The
+    optional `t0` and `t1` query parameters select a time range in seconds
+    and `points` the maximum number of min/max buckets returned, 800 by
+    default. The driver function's result is encoded by `api_response` and
+    returned with its status code.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+
+    Returns
+    -------
+    string
+        JSON encoded waveform envelope or error message
+    int
+        status code
+    """
+    result, status_code = fetch_waveform_driver(room_number, timestamp,
+                                                request.args)
+    return api_response(result, status_code)
+
+
+def fetch_waveform_driver(room_number, timestamp, args):
+    """Returns the min/max envelope of a stored waveform.
+
+    The query arguments are converted to numbers; invalid values return an
+    error message and a 400 status code, as does a calculation without a
+    stored waveform. The envelope is computed by
+    `CPAP_measurement.query_waveform` with at most 5000 points, and holds the
+    start and end times of the returned buckets and the minimum and maximum
+    flow rate of each. Only the chunks the query reads are asked of the
+    store.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+    args : dict
+        "t0", "t1" and "points" query arguments, all optional
+
+    Returns
+    -------
+    dict or str
+        waveform envelope or error message
+    int
+        status code
+    """
+    try:
+        t0 = float(args["t0"]) if "t0" in args else None
+        t1 = float(args["t1"]) if "t1" in args else None
+        points = min(int(args.get("points", 800)), 5000)
+    except ValueError:
+        return "t0 and t1 must be numbers and points an integer.", 400
+    if points < 1 or (t0 is not None and t1 is not None and t1 <= t0):
+        return "points must be positive and t1 greater than t0.", 400
+    waveform = store.get_waveform(room_number, timestamp, t0, t1, points)
+    if waveform is None:
+        return "No waveform stored for this calculation.", 400
+    return query_waveform(waveform, t0, t1, points), 200
+
+
+@app.route('/patient/image/<int:room_number>/<timestamp>', methods=['PUT'])
+def upload_image(room_number, timestamp):
+    """PUT route storing the flow rate plot of a CPAP calculation.
+
+    This function implements the PUT `/patient/image/<room_number>/<timestamp>`
+    route. The body of the request is the image file itself, sent with an
+    `image/png` or `image/jpeg` content type, rather than a base-64 string
+    inside a JSON document. The timestamp is the one of the calculation sent
+    to `/patient/upload_patient`, which should carry None as its image. The
+    driver function's message is returned with its status code.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+
+    Returns
+    -------
+    string
+        confirmation or error message
+    int
+        status code
+    """
+    return upload_image_driver(room_number, timestamp, request.mimetype,
+                               request.content_length, request.stream)
+
+
+def upload_image_driver(room_number, timestamp, content_type, content_length,
+                        stream):
+    """Stores an image read from a request stream.
+
+    Images of another content type or for an unoccupied room are refused
+    with a 400 status code. In write-behind mode, uploads journaled for the
+    room are committed first: giving the room to a new patient deletes the
+    images stored for it, which must not include this one. The stream is
+    read in chunks of
+    IMAGE_READ_CHUNK bytes, and images larger than MAX_IMAGE_BYTES are
+    refused with a 413 status code, before reading when the request
+    declares its length. The image is then saved in the room storage.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+    content_type : str
+        media type of the request body
+    content_length : int or None
+        declared length of the request body
+    stream : file-like object
+        request body
+
+    Returns
+    -------
+    string
+        confirmation or error message
+    int
+        status code
+    """
+    if content_type not in IMAGE_CONTENT_TYPES:
+        return "Content type must be one of {}.".format(
+            ", ".join(IMAGE_CONTENT_TYPES)), 400
+    if upload_pending(room_number):
+        try:
+            write_behind.flush()
+        except Exception:
+            logging.exception("Write-behind flush failed")
+            return "The upload of the patient is not stored yet.", 503
+    msg = validate_room_number(room_number)
+    if msg is not True:
+        return msg, 400
+    too_large = "Image must be at most {} bytes.".format(MAX_IMAGE_BYTES), 413
+    if content_length is not None and content_length > MAX_IMAGE_BYTES:
+        return too_large
+    data = read_limited(stream, MAX_IMAGE_BYTES)
+    if data is None:
+        return too_large
+    if not data:
+        return "Image is empty.", 400
+    store.put_image(room_number, timestamp, content_type, data)
+    return "Image successfully uploaded.", 200
+
+
+def read_limited(stream, limit):
+    """Reads a stream in chunks up to a size limit.
+
+    Parameters
+    ----------
+    stream : file-like object
+        stream to read
+    limit : int
+        maximum number of bytes
+
+    Returns
+    -------
+    bytes or None
+        content of the stream, or None if it is longer than the limit
+    """
+    data = bytearray()
+    while True:
+        chunk = stream.read(IMAGE_READ_CHUNK)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+        if len(data) > limit:
+            return None
+
+
+@app.route('/lab/image/<int:room_number>/<timestamp>', methods=['GET'])
+def fetch_image(room_number, timestamp):
+    """GET route returning the flow rate plot of a CPAP calculation.
+
+    This function implements the GET `/lab/image/<room_number>/<timestamp>`
+    route. The image is returned as raw bytes with its content type, or an
+    error message and a 400 status code if the calculation has no image.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+
+    Returns
+    -------
+    Response or str
+        image or error message
+    int
+        status code
+    """
+    result, status_code = fetch_image_driver(room_number, timestamp)
+    if status_code != 200:
+        return result, status_code
+    return image_response(*result)
+
+
+@app.route('/lab/image/<int:room_number>/<timestamp>/<int:size>',
+           methods=['GET'])
+def fetch_thumbnail(room_number, timestamp, size):
+    """GET route returning a thumbnail of the flow rate plot of a CPAP
+    calculation.
+
+    This function implements the GET
+    `/lab/image/<room_number>/<timestamp>/<size>` route. The plot is
+    returned as a `size` by `size` PNG image, or an error message and a 400
+    status code if the size is not one of THUMBNAIL_SIZES or the
+    calculation has no image.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+    size : int
+        edge length of the thumbnail in pixels
+
+    Returns
+    -------
+    Response or str
+        image or error message
+    int
+        status code
+    """
+    result, status_code = fetch_thumbnail_driver(room_number, timestamp,
+                                                 size)
+    if status_code != 200:
+        return result, status_code
+    return image_response(*result)
+
+
+def fetch_thumbnail_driver(room_number, timestamp, size):
+    """Returns a thumbnail of the flow rate plot of a CPAP calculation.
+
+    Thumbnails are generated from the image returned by `fetch_image_driver`
+    the first time a size is requested and kept in the room storage next to
+    the image, so later requests neither read nor scale the full plot. If
+    Pillow is not installed, the full image is returned instead.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+    size : int
+        edge length of the thumbnail in pixels
+
+    Returns
+    -------
+    tuple or str
+        media type and bytes of the image, or error message
+    int
+        status code
+    """
+    if size not in THUMBNAIL_SIZES:
+        return "size must be one of {}.".format(
+            ", ".join(str(edge) for edge in THUMBNAIL_SIZES)), 400
+    data = store.get_thumbnail(room_number, timestamp, size)
+    if data is not None:
+        return (THUMBNAIL_TYPE, data), 200
+    result, status_code = fetch_image_driver(room_number, timestamp)
+    if status_code != 200 or not thumbnails_available():
+        return result, status_code
+    try:
+        data = make_thumbnail(result[1], size)
+    except (OSError, ValueError):
+        return "Stored image could not be decoded.", 400
+    store.put_thumbnail(room_number, timestamp, size, data)
+    return (THUMBNAIL_TYPE, data), 200
+
+
+def image_response(content_type, data):
+    """Wraps an image in a cacheable response.
+
+    The response may be kept by the client for IMAGE_MAX_AGE seconds and
+    carries a digest of the image as its ETag, so a client revalidating
+    an unchanged image receives a 304 without the body.
+
+    Parameters
+    ----------
+    content_type : str
+        media type of the image
+    data : bytes
+        image file
+
+    Returns
+    -------
+    Response
+        image, or 304 if the `If-None-Match` header matches
+    """
+    response = Response(data, mimetype=content_type)
+    response.set_etag(hashlib.sha1(data).hexdigest()[:16])
+    response.cache_control.private = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    return response.make_conditional(request)
+
+
+def fetch_image_driver(room_number, timestamp):
+    """Returns the flow rate plot of a CPAP calculation.
+
+    Images uploaded to `/patient/image` are read from the room storage.
+    Calculations uploaded before that route existed carry their plot as a
+    base-64 string, which is decoded and returned as a PNG image instead.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    timestamp : str
+        timestamp of the calculation
+
+    Returns
+    -------
+    tuple or str
+        media type and bytes of the image, or error message
+    int
+        status code
+    """
+    image = store.get_image(room_number, timestamp)
+    if image is not None:
+        return image, 200
+    room = store.get_room(room_number)
+    for calculation in (room or {}).get("cpap_calculations", []):
+        if calculation[0] != timestamp or type(calculation[3]) is not str:
+            continue
+        try:
+            return ("image/png",
+                    base64.b64decode(calculation[3], validate=True)), 200
+        except ValueError:
+            break
+    return "No image stored for this calculation.", 400
+
+
+def upload_patient_driver(in_data):
+    # Rigurously tested using the MongoDB database
+    # Helper functions also rigorously tested
+    """
+    Driver function for processing patient data.
+
+    This function takes the input data received from the `upload_patient` POST
+    route, verifies the input, and updates the patient data in the database.
+    It checks for the presence and type of required fields: 'room_number' and
+    'patient_mrn', both of which should be integers. Additional patient data
+    is then processed and saved to the database.
+
+    Parameters
+    ----------
+    in_data : dict
+        A dictionary containing the patient data. Expected keys are:
+        'room_number', 'patient_mrn', and other patient-specific data.
+
+    Returns
+    -------
+    string
+        Confirmation or error message.
+    int
+        HTTP status code (200 for success, 400 for invalid input).
+    """
+    expected_keys = ["room_number", "patient_mrn"]
+    expected_types = [[int], [int]]
+    msg = input_verification(in_data, expected_keys, expected_types)
+    if msg is not True:
+        return msg, 400
+    new_pressure = in_data["cpap_pressure"]
+    room_number = in_data["room_number"]
+    new_cpap_calculations = in_data["cpap_calculations"]
+    msg = cpap_pressure_validation(new_pressure)
+    if msg is not True:
+        return msg, 400
+    elif make_calculation(new_cpap_calculations) is None:
+        return "cpap_calculations must be a [timestamp, breath rate, " \
+            "apnea count, image] list.", 400
+    elif write_behind is not None and write_behind.running():
+        msg = upload_record_validation(in_data)
+        if msg is not True:
+            return msg, 400
+        write_behind.append({key: in_data[key] for key in (
+            "room_number", "patient_mrn", "patient_name", "cpap_pressure",
+            "cpap_calculations", "flow_waveform") if key in in_data})
+        return "Patient upload queued.", 202
+    else:
+        return upload_patient_function(in_data)
+
+
+@app.route('/patient/upload_batch', methods=['POST'])
+def upload_batch():
+    """POST route uploading the data of many patients at once.
+
+    This function implements the POST route `/patient/upload_batch`. This
+    POST request should receive a JSON string containing a list of at most
+    MAX_UPLOAD_BATCH records, each a dictionary with the keys taken by
+    `/patient/upload_patient`. The list is sent to a driver function, which
+    returns the status of each record, or an error message, and a status
+    code.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        JSON encoded list of per-record results or error message
+    int
+        status code
+    """
+    in_data = request.get_json()
+    result, status_code = upload_batch_driver(in_data)
+    return jsonify(result), status_code
+
+
+def upload_batch_driver(in_data):
+    """Validates and stores a batch of patient uploads.
+
+    Every record is verified on its own, and the valid records are then
+    stored together by `store.save_uploads`, which with MongoDB sends them
+    in a single bulk write. Records of the same patient are applied in list
+    order. The flow rate waveforms of the stored records are saved, and each
+    affected room is marked as changed and announced on the event channel
+    once, with its last pressure and calculation.
+
+    Parameters
+    ----------
+    in_data : list of dict
+        records with the keys taken by `upload_patient_driver`
+
+    Returns
+    -------
+    dict or str
+        "results" list holding the index, status code, message and room
+        number of each record, or error message
+    int
+        status code
+    """
+    if type(in_data) is not list:
+        return "Data sent must be a list of patient records.", 400
+    if len(in_data) > MAX_UPLOAD_BATCH:
+        return "A batch may hold at most {} records.".format(
+            MAX_UPLOAD_BATCH), 400
+    results = []
+    valid = []
+    for index, record in enumerate(in_data):
+        msg = upload_record_validation(record)
+        results.append({"index": index, "status": 400, "message": msg,
+                        "room_number": None})
+        if msg is True:
+            valid.append(index)
+    stored = store_uploads([in_data[index] for index in valid])
+    for index, outcome in zip(valid, stored):
+        result = results[index]
+        if outcome is None:
+            result.update(status=500, message="Record could not be stored.")
+            continue
+        room_number, created = outcome
+        result.update(status=200, room_number=room_number,
+                      message="Patient successfully Added." if created
+                      else "Patient Info updated successfully.")
+    return {"results": results}, 200
+
+
+def store_uploads(records):
+    """Stores validated upload records together.
+
+    The records are saved by `store.save_uploads`, with MongoDB in a single
+    bulk write, and the flow rate waveforms of the stored records are saved.
+    Each affected room is then marked as changed and announced on the event
+    channel once, with its last pressure and calculation.
+
+    Parameters
+    ----------
+    records : list of dict
+        records with the keys taken by `upload_patient_driver`
+
+    Returns
+    -------
+    list of tuple or None
+        (room number, created) of each record, or None for records that
+        could not be stored
+    """
+    stored = store.save_uploads([
+        (record["room_number"], record["patient_mrn"],
+         record["patient_name"], record["cpap_pressure"],
+         record["cpap_calculations"]) for record in records])
+    changed = {}
+    taken_over = set()
+    for record, outcome in reversed(list(zip(records, stored))):
+        if outcome is None:
+            continue
+        room_number, created = outcome
+        # The waveform of an upload followed by a new patient in the same
+        # room was deleted with the room data, as if stored one by one.
+        if record.get("flow_waveform") and room_number not in taken_over:
+            store_waveform(room_number, record["cpap_calculations"],
+                           record["flow_waveform"])
+        if created:
+            taken_over.add(room_number)
+        changed.setdefault(room_number, record)
+    for room_number, record in changed.items():
+        mark_room_changed(room_number)
+        publish_pressure(room_number, record["cpap_pressure"])
+        publish_upload(room_number, record["cpap_calculations"])
+    return stored
+
+
+def commit_journaled_uploads(records):
+    """Group-commits uploads taken from the write-behind journal.
+
+    Errors that leave the outcome of the group unknown, such as a lost
+    connection or a write concern error, propagate, so the group stays
+    journaled and is sent again; `store.save_uploads` does not repeat the
+    calculations already stored. Records refused by the database itself
+    are logged and dropped, since sending them again would fail again.
+
+    Parameters
+    ----------
+    records : list of dict
+        journaled upload records
+
+    Returns
+    -------
+    None
+    """
+    stored = store_uploads(records)
+    for record, outcome in zip(records, stored):
+        if outcome is None:
+            logging.error("Journaled upload refused by the database: "
+                          "room %s, MRN %s, calculation %s",
+                          record["room_number"], record["patient_mrn"],
+                          record["cpap_calculations"][0])
+
+
+def upload_pending(room_number):
+    """Checks whether the write-behind journal holds an upload for a room.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of interest
+
+    Returns
+    -------
+    bool
+        True if an upload to the room is waiting to be committed
+    """
+    if write_behind is None or not write_behind.running():
+        return False
+    return any(record["room_number"] == room_number
+               for record in write_behind.pending_records())
+
+
+def upload_record_validation(record):
+    """Verifies one record of a batch upload.
+
+    Parameters
+    ----------
+    record : dict
+        record with the keys taken by `upload_patient_driver`
+
+    Returns
+    -------
+    bool or string
+        True if valid, error message if not
+    """
+    expected_keys = ["room_number", "patient_mrn", "patient_name",
+                     "cpap_pressure", "cpap_calculations"]
+    expected_types = [[int], [int], [str], [int], [list]]
+    msg = input_verification(record, expected_keys, expected_types)
+    if msg is not True:
+        return msg
+    msg = cpap_pressure_validation(record["cpap_pressure"])
+    if msg is not True:
+        return msg
+    if make_calculation(record["cpap_calculations"]) is None:
+        return "cpap_calculations must be a [timestamp, breath rate, " \
+            "apnea count, image] list."
+    if record.get("flow_waveform") is not None:
+        return waveform_validation(record["flow_waveform"])
+    return True
+
+
+@app.route('/patient/analyze_cpap_file', methods=['POST'])
+def analyze_cpap_file():
+    """POST route queueing a raw CPAP data file for server-side analysis.
+
+    This function implements the POST route `/patient/analyze_cpap_file`. The
+    request must be sent as `multipart/form-data` with the CPAP data file in
+    the `cpap_file` field and the following form fields:
+
+        - room_number: patient room number
+        - patient_name: patient name
+        - patient_mrn: patient medical record number
+        - cpap_pressure: entered CPAP pressure
+
+    The form and file are forwarded to `analyze_cpap_file_driver`, which
+    returns the ID of the queued job or an error message, along with a
+    status code.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        JSON encoded job ID or error message
+    int
+        status code
+    """
+    in_data = request.form.to_dict()
+    cpap_file = request.files.get("cpap_file")
+    result, status_code = analyze_cpap_file_driver(in_data, cpap_file)
+    return jsonify(result), status_code
+
+
+def analyze_cpap_file_driver(in_data, cpap_file):
+    """Validates a CPAP data file upload and queues it for analysis.
+
+    Form values arrive as strings, so the room number, MRN and CPAP pressure
+    are converted with `validate_and_convert_int` and the pressure is checked
+    with `cpap_pressure_validation`. If anything is missing or invalid, an
+    error message and a 400 status code are returned. Otherwise the file is
+    streamed to a temporary working directory and submitted to the analysis
+    worker pool. If the pool already holds MAX_PENDING_ANALYSES unfinished
+    jobs, the upload is refused with a 503 status code.
+
+    When the job completes, the breathing rate and apnea count are stored as
+    a new CPAP calculation through `store_uploads`, timestamped with the
+    time of the upload, and the flow rate plot is stored as a binary image
+    served by `/lab/image` in the room the patient was stored in. If the
+    calculation is invalid or not stored, the job fails.
+
+    Parameters
+    ----------
+    in_data : dict
+        form fields of the request
+    cpap_file : werkzeug FileStorage or None
+        uploaded CPAP data file
+
+    Returns
+    -------
+    dict or str
+        dictionary with the "job_id" key, or error message
+    int
+        status code
+    """
+    if cpap_file is None:
+        return "cpap_file is not found in the input", 400
+    if "patient_name" not in in_data:
+        return "patient_name key is not found in the input", 400
+    patient = {"patient_name": in_data["patient_name"]}
+    for key in ["room_number", "patient_mrn", "cpap_pressure"]:
+        valid, value = validate_and_convert_int(in_data.get(key, ""))
+        if valid is not True:
+            return "{} key should be an integer.".format(key), 400
+        patient[key] = value
+    msg = cpap_pressure_validation(patient["cpap_pressure"])
+    if msg is not True:
+        return msg, 400
+    timestamp = format_date(datetime.now())
+
+    def store_result(result):
+        # Raising fails the job, with the message shown to the client.
+        record = dict(patient, flow_waveform=result["flow_waveform"],
+                      cpap_calculations=[timestamp, result["breath_rate_bpm"],
+                                         result["apnea_count"], None])
+        msg = upload_record_validation(record)
+        if msg is not True:
+            raise ValueError(msg)
+        outcome, = store_uploads([record])
+        if outcome is None:
+            raise RuntimeError("The calculation could not be stored.")
+        # A known patient is kept in their room whatever room was entered.
+        room_number, created = outcome
+        store.put_image(room_number, timestamp, "image/png",
+                        base64.b64decode(result["image"]))
+
+    work_dir = tempfile.mkdtemp(prefix="cpap_analysis_")
+    data_path = os.path.join(work_dir, "cpap_data.txt")
+    cpap_file.save(data_path)
+    job_id = analysis_jobs.submit(data_path, work_dir,
+                                  patient["room_number"], store_result)
+    if job_id is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return "Analysis queue is full, try again later.", 503
+    return {"job_id": job_id}, 202
+
+
+@app.route('/patient/analysis_job/<job_id>', methods=['GET'])
+def analysis_job(job_id):
+    """GET route returning the state of a server-side analysis job.
+
+    This function implements the GET `/patient/analysis_job/<job_id>` route.
+    The job returned by `/patient/analyze_cpap_file` is looked up and its
+    state is returned as a dictionary with the following keys:
+
+        - job_id, room_number
+        - status: "queued", "running", "done" or "failed"
+        - progress: fraction of the data file parsed so far
+        - result: breathing rate, apnea count and base-64 encoded flow rate
+          plot once the job is done, otherwise None
+        - error: error message if the job failed, otherwise None
+
+    An unknown job ID returns an error message and a 400 status code.
+
+    Parameters
+    ----------
+    job_id : str
+        ID of the job
+
+    Returns
+    -------
+    string
+        encoded job state or error message
+    int
+        status code
+    """
+    job = analysis_jobs.status(job_id)
+    if job is None:
+        return jsonify("Analysis job {} not found".format(job_id)), 400
+    return api_response(job)
+
+
+@app.route('/patient/ingest_samples', methods=['POST'])
+def ingest_samples():
+    """POST route receiving a batch of raw CPAP samples during the night.
+
+    This function implements the POST route `/patient/ingest_samples`. This
+    POST request should receive a JSON string containing a dictionary as
+    follows:
 
-    The JSON string should contain the following keys:
-        - room_number: int, patient room number.
-        - patient_name: string, patient name.
-        - patient_mrn: int, patient medical record number.
-        - cpap_pressure: int, entered cpap pressure number.
-        - cpap_calculations: list containing breathing rate,
-        number of apnea events and flow rate vs time.
+        {
+            "room_number": <int of patient room number>,
+            "session_id": <str identifying the recording, e.g. its start>,
+            "samples": <list of [time, 6 ADC readings] lists>,
+        }
+    This input is sent to a driver function implementing the route and
+    receives the ingestion summary or an error message, and a status code.
 
     Parameters
     ----------
@@ -207,100 +1630,162 @@ def upload_patient():
     Returns
     -------
     string
-        Confirmation or error message.
+        JSON encoded ingestion summary or error message
     int
-        HTTP status code.
+        status code
     """
     in_data = request.get_json()
-    result, status_code = upload_patient_driver(in_data)
-    return result, status_code
+    result, status_code = ingest_samples_driver(in_data)
+    return jsonify(result), status_code
 
 
-def upload_patient_function(in_data):
-    # Rigurously tested using the MongoDB database
-    """
-    Uploads or updates a patient's data in the database.
+def ingest_samples_driver(in_data):
+    """Stores a batch of raw CPAP samples and updates the live metrics.
 
-    This function takes patient data from `in_data`, including CPAP pressure,
-    room number, and CPAP calculations. It attempts to find an existing patient
-    record by MRN. If found, the record is updated; if not, a new record is
-    created. Returns a message and HTTP status code upon completion.
+    The input is verified and batches larger than MAX_SAMPLES_PER_BATCH or
+    for unoccupied rooms are refused with a 400 status code. Invalid samples
+    are skipped, as invalid datafile lines are in the batch analysis. The
+    valid samples are stored by the room storage, which with MongoDB keeps
+    them in SampleBuckets documents, one per room, session and minute of
+    recording time, written in a single bulk write. They are then added to
+    the incremental analysis of the room, whose running breathing rate,
+    breath count and apnea count are saved as the live metrics of the room
+    and published as a `live_metrics` event
+    on the ward event stream. Samples of a session must be sent in time
+    order; a new session ID restarts the analysis.
+
+    A batch may carry an integer "sequence" number, unique within its
+    session, so that it can be sent again when its response was lost. A
+    batch whose sequence number the storage already holds changes nothing
+    and is answered with 200, no accepted samples and "duplicate" set.
 
     Parameters
     ----------
     in_data : dict
-        A dictionary containing the patient's data including MRN, name, CPAP
-        pressure, and calculations.
+        dictionary containing input data described above
 
     Returns
     -------
-    tuple
-        A tuple containing a response message and HTTP status code.
+    dict or str
+        number of accepted and skipped samples, whether the batch was a
+        duplicate and the live metrics, or error message
+    int
+        status code
     """
-    new_pressure = in_data["cpap_pressure"]
+    expected_keys = ["room_number", "session_id", "samples"]
+    expected_types = [[int], [str], [list]]
+    msg = input_verification(in_data, expected_keys, expected_types)
+    if msg is not True:
+        return msg, 400
     room_number = in_data["room_number"]
-    new_cpap_calculations = in_data["cpap_calculations"]
-    try:
-        existing_patient = db.objects.get(
-            {'patient_mrn': in_data["patient_mrn"]})
-
-        # Update the existing record
-        existing_patient.patient_name = in_data["patient_name"]
-        existing_patient.cpap_pressure = new_pressure
-        existing_patient.cpap_calculations.append(new_cpap_calculations)
-        existing_patient.save()
-        return "Patient Info updated successfully.", 200
-
-    except db.DoesNotExist:
-        new_patient = db(room_number=room_number,
-                         patient_name=in_data["patient_name"],
-                         patient_mrn=in_data["patient_mrn"],
-                         cpap_pressure=new_pressure,
-                         cpap_calculations=[new_cpap_calculations])
-        new_patient.save()
+    sequence = in_data.get("sequence")
+    if sequence is not None and type(sequence) is not int:
+        return "sequence must be an integer.", 400
+    if len(in_data["samples"]) > MAX_SAMPLES_PER_BATCH:
+        return "A batch may hold at most {} samples.".format(
+            MAX_SAMPLES_PER_BATCH), 400
+    msg = validate_room_number(room_number)
+    if msg is not True:
+        return msg, 400
+    samples = [parse_sample(sample) for sample in in_data["samples"]]
+    samples = [sample for sample in samples if sample is not None]
+    stream = live_stream(room_number, in_data["session_id"])
+    with stream["lock"]:
+        if not store.append_samples(room_number, in_data["session_id"],
+                                    samples, sequence):
+            return {"accepted": 0, "skipped": 0, "duplicate": True,
+                    "live_metrics": live_metrics_summary(stream)}, 200
+        update_stream_metrics(stream["state"], samples)
+        metrics = live_metrics_summary(stream)
+        store.set_live_metrics(room_number, metrics)
+    room_events.publish("live_metrics", dict(metrics,
+                                             room_number=room_number))
+    return {"accepted": len(samples),
+            "skipped": len(in_data["samples"]) - len(samples),
+            "duplicate": False, "live_metrics": metrics}, 200
+
+
+def live_stream(room_number, session_id):
+    """Returns the incremental analysis of a room's recording session.
+
+    A new analysis is started when the room has none yet or is recording a
+    different session. If the room storage holds live metrics for the same
+    session, for instance after a server restart, the counts continue from
+    them; only the peak-finding window is lost.
 
-        return "Patient successfully Added.", 200
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    session_id : str
+        ID of the recording session
 
+    Returns
+    -------
+    dict
+        session ID, analysis state and lock of the room
+    """
+    with live_streams_lock:
+        stream = live_streams.get(room_number)
+        if stream is not None and stream["session_id"] == session_id:
+            return stream
+        state = new_stream_state()
+        stored = store.get_live_metrics(room_number) or {}
+        if stored.get("session_id") == session_id:
+            state.update({key: value for key, value in stored.items()
+                          if key in state})
+        stream = {"session_id": session_id,
+                  "state": state,
+                  "lock": threading.Lock()}
+        live_streams[room_number] = stream
+        return stream
+
+
+def live_metrics_summary(stream):
+    """Returns the running metrics of an incremental analysis.
 
-def upload_patient_driver(in_data):
-    # Rigurously tested using the MongoDB database
-    # Helper functions also rigorously tested
+    Parameters
+    ----------
+    stream : dict
+        entry of `live_streams`
+
+    Returns
+    -------
+    dict
+        session ID and analysis state without the peak-finding window
     """
-    Driver function for processing patient data.
+    metrics = {key: value for key, value in stream["state"].items()
+               if not key.startswith("window_")}
+    metrics["session_id"] = stream["session_id"]
+    return metrics
 
-    This function takes the input data received from the `upload_patient` POST
-    route, verifies the input, and updates the patient data in the database.
-    It checks for the presence and type of required fields: 'room_number' and
-    'patient_mrn', both of which should be integers. Additional patient data
-    is then processed and saved to the database.
+
+@app.route('/lab/live_metrics/<int:room_number>', methods=['GET'])
+def live_metrics(room_number):
+    """GET route returning the live metrics of a room.
+
+    This function implements the GET `/lab/live_metrics/<room_number>` route,
+    returning the running metrics of the samples streamed in for the room,
+    as saved by `ingest_samples_driver`. An empty dictionary is returned for
+    a room that has not streamed any samples. If the room has no patient, an
+    error message and a 400 status code are returned.
 
     Parameters
     ----------
-    in_data : dict
-        A dictionary containing the patient data. Expected keys are:
-        'room_number', 'patient_mrn', and other patient-specific data.
+    room_number : int
+        room number of the patient
 
     Returns
     -------
     string
-        Confirmation or error message.
+        JSON encoded live metrics or error message
     int
-        HTTP status code (200 for success, 400 for invalid input).
+        status code
     """
-    expected_keys = ["room_number", "patient_mrn"]
-    expected_types = [[int], [int]]
-    msg = input_verification(in_data, expected_keys, expected_types)
-    if msg is not True:
-        return msg, 400
-    new_pressure = in_data["cpap_pressure"]
-    room_number = in_data["room_number"]
-    print(room_number)
-    new_cpap_calculations = in_data["cpap_calculations"]
-    msg = cpap_pressure_validation(new_pressure)
-    if msg is not True:
-        return msg, 400
-    else:
-        return upload_patient_function(in_data)
+    metrics = store.get_live_metrics(room_number)
+    if metrics is None:
+        return jsonify("Patient not associated with room number entry."), 400
+    return jsonify(metrics), 200
 
 
 @app.route('/lab/update_cpap_pressure', methods=['POST'])
@@ -379,12 +1864,171 @@ def lab_update_cpap_pressure_driver(in_data):
     msg = cpap_pressure_validation(new_pressure)
     if msg is not True:
         return msg, 400
-    patient = db.objects.raw({"_id": room_number}).first()
-    patient.cpap_pressure = new_pressure
-    patient.save()
+    if not store.update_pressure(room_number, new_pressure):
+        return "Patient not associated with room number entry.", 400
+    mark_room_changed(room_number)
+    publish_pressure(room_number, new_pressure)
     return "CPAP pressure successfully updated.", 200
 
 
+@app.route('/lab/update_cpap_pressures', methods=['POST'])
+def lab_update_cpap_pressures():
+    """POST route setting the CPAP pressure of many rooms at once.
+
+    This function implements the POST route `/lab/update_cpap_pressures`.
+    This POST request should receive a JSON string containing a list of at
+    most MAX_PRESSURE_ROOMS dictionaries as follows:
+
+        [
+            {
+                "room_number": <int of patient room number>,
+                "cpap_pressure": <int containing new CPAP pressure>,
+            },
+            ...
+        ]
+    This input is sent to a driver function, which returns the status of
+    each entry, or an error message, and a status code.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        JSON encoded list of per-entry results or error message
+    int
+        status code
+    """
+    in_data = request.get_json()
+    result, status_code = lab_update_cpap_pressures_driver(in_data)
+    return jsonify(result), status_code
+
+
+def lab_update_cpap_pressures_driver(in_data):
+    """Updates the CPAP pressure of many rooms.
+
+    Each entry is verified as by `lab_update_cpap_pressure_driver`. The
+    occupied rooms among the valid entries are found with a single
+    projected query, and the new pressures are then applied by
+    `store.update_pressures`, with MongoDB in a single bulk write. If a room
+    appears more than once, only its last valid entry is applied and the
+    earlier ones are reported as superseded with status 409. Every updated
+    room is marked as changed and its new pressure published.
+
+    Parameters
+    ----------
+    in_data : list of dict
+        entries holding a room number and a CPAP pressure
+
+    Returns
+    -------
+    dict or str
+        "results" list holding the index, status code, message and room
+        number of each entry, or error message
+    int
+        status code
+    """
+    if type(in_data) is not list:
+        return "Data sent must be a list of room pressures.", 400
+    if len(in_data) > MAX_PRESSURE_ROOMS:
+        return "At most {} rooms may be updated at once.".format(
+            MAX_PRESSURE_ROOMS), 400
+    results = []
+    for index, entry in enumerate(in_data):
+        msg = input_verification(entry, ["room_number", "cpap_pressure"],
+                                 [[int], [int]])
+        if msg is True:
+            msg = cpap_pressure_validation(entry["cpap_pressure"])
+        results.append({"index": index, "status": 400, "message": msg,
+                        "room_number": None})
+    last = {}
+    for index, result in enumerate(results):
+        if result["message"] is True:
+            last[in_data[index]["room_number"]] = index
+    for index, result in enumerate(results):
+        if result["message"] is True and \
+                last[in_data[index]["room_number"]] != index:
+            result.update(status=409,
+                          message="Superseded by a later entry for room "
+                                  "{}.".format(in_data[index]["room_number"]))
+    valid = sorted(last.values())
+    occupied = store.get_pressures(list(last))
+    pressures = {}
+    for index in valid:
+        room_number = in_data[index]["room_number"]
+        if room_number in occupied:
+            pressures[room_number] = in_data[index]["cpap_pressure"]
+    updated = set(store.update_pressures(pressures))
+    for index in valid:
+        room_number = in_data[index]["room_number"]
+        if room_number in updated:
+            results[index].update(
+                status=200, room_number=room_number,
+                message="CPAP pressure successfully updated.")
+        else:
+            results[index]["message"] = \
+                "Patient not associated with room number entry."
+    for room_number in updated:
+        mark_room_changed(room_number)
+        publish_pressure(room_number, pressures[room_number])
+    return {"results": results}, 200
+
+
+def publish_pressure(room_number, cpap_pressure):
+    """Publishes a CPAP pressure change to the room event channel.
+
+    Subscribers of `/patient/pressure_stream/<room_number>` receive the new
+    pressure as soon as this function is called, so it must only be called
+    once the new value has been saved to the database.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    cpap_pressure : int
+        new CPAP pressure
+
+    Returns
+    -------
+    None
+    """
+    room_events.publish("pressure", {"room_number": room_number,
+                                     "cpap_pressure": cpap_pressure})
+
+
+def publish_upload(room_number, cpap_calculation):
+    """Publishes a stored CPAP calculation to the room event channel.
+
+    An `upload` event carrying the timestamp, breathing rate and apnea count
+    of the calculation is published. If the apnea count reaches
+    APNEA_ALERT_THRESHOLD, an `apnea_alert` event is published as well. The
+    flow rate image is left out to keep the events small. Calculations that
+    are not in the `[timestamp, breath rate, apnea count, image]` form are
+    ignored.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    cpap_calculation : list
+        calculation stored for the patient
+
+    Returns
+    -------
+    None
+    """
+    summary = calculation_summary(cpap_calculation)
+    if summary is None:
+        return
+    room_events.publish("upload", dict(summary, room_number=room_number))
+    apnea_count = summary["apnea_count"]
+    if type(apnea_count) is int and apnea_count >= APNEA_ALERT_THRESHOLD:
+        room_events.publish("apnea_alert", {"room_number": room_number,
+                                            "timestamp": summary["timestamp"],
+                                            "apnea_count": apnea_count})
+
+
 def cpap_pressure_validation(pressure):
     """Verfies CPAP pressure input
 
@@ -407,6 +2051,56 @@ def cpap_pressure_validation(pressure):
     return "Pressure must be an integer between 4 and 25, inclusive."
 
 
+def waveform_validation(waveform):
+    """Verifies a flow rate waveform uploaded with a CPAP calculation.
+
+    The waveform must have the layout built by
+    `CPAP_measurement.encode_waveform`: numeric "t0", "t1" and "scale", a
+    power of two of "buckets", and one level per halving of the buckets
+    down to one, each holding as many packed "min" and "max" chunks as its
+    buckets need. A waveform that passes can be queried by
+    `CPAP_measurement.query_waveform`. The chunks themselves are not
+    decoded.
+
+    Parameters
+    ----------
+    waveform : dict
+        uploaded waveform
+
+    Returns
+    -------
+    bool or string
+        True if valid, error message if not
+    """
+    msg = "flow_waveform must be a waveform built by encode_waveform."
+    if type(waveform) is not dict:
+        return msg
+    numbers = (int, float)
+    if type(waveform.get("t0")) not in numbers \
+            or type(waveform.get("t1")) not in numbers \
+            or type(waveform.get("scale")) not in numbers \
+            or type(waveform.get("buckets")) is not int \
+            or type(waveform.get("levels")) is not list:
+        return msg
+    buckets = waveform["buckets"]
+    if not (waveform["t0"] <= waveform["t1"] and waveform["scale"] > 0
+            and 1 <= buckets <= WAVEFORM_MAX_BUCKETS
+            and buckets & (buckets - 1) == 0
+            and len(waveform["levels"]) == buckets.bit_length()):
+        return msg
+    for level in waveform["levels"]:
+        chunks = math.ceil(buckets / WAVEFORM_CHUNK)
+        if type(level) is not dict:
+            return msg
+        for key in ("min", "max"):
+            if type(level.get(key)) is not list \
+                    or len(level[key]) != chunks \
+                    or any(type(chunk) is not str for chunk in level[key]):
+                return msg
+        buckets //= 2
+    return True
+
+
 def validate_room_number(room_number):
     """Verifies occupied room number.
 
@@ -442,6 +2136,17 @@ def fetch_patient(room_number):
     SleepLabRooms database object and a status code of 200. The result is JSON
     encoded and the status code is returned.
 
+    Successful responses carry the version tag of the room as a weak ETag,
+    since every representation of the same version shares it while their
+    bytes differ. If the `If-None-Match` header of the request holds the
+    current tag, an empty response with status code 304 is returned without
+    reading the database.
+    Otherwise the response is encoded as negotiated by `api_response`,
+    compressed whatever its size, and served from `response_cache` while
+    the room is unchanged, each representation being cached after its first
+    full read. Concurrent misses for the same room version and
+    representation share one read through `single_flight`.
+
     Parameters
     ----------
     None
@@ -453,8 +2158,75 @@ def fetch_patient(room_number):
     int
         status code
     """
+    valid, room_int = validate_and_convert_int(room_number)
+    if valid is True and room_not_modified(room_int, weak=True):
+        return "", 304
+    tag = room_etag(room_int) if valid is True else None
+    variant = negotiate(request.accept_mimetypes, request.accept_encodings)
+    body = response_cache.get(room_int, tag, variant) \
+        if valid is True else None
+    if body is None:
+        result, status_code, body = single_flight.do(
+            ("fetch_patient", room_number, tag, variant),
+            lambda: encode_patient(room_number, tag, variant))
+        if status_code != 200:
+            return api_response(result, status_code)
+    response = negotiated_response(body, *variant)
+    response.set_etag(tag, weak=True)
+    return response, 200
+
+
+def encode_patient(room_number, tag, variant):
+    """Reads and encodes the `/lab/fetch_patient` response of a room.
+
+    The encoded body is added to `response_cache`.
+
+    Parameters
+    ----------
+    room_number : str
+        room number from the URL
+    tag : str or None
+        version tag of the room, read before the database
+    variant : tuple
+        negotiated media type and content coding
+
+    Returns
+    -------
+    str or None
+        error message, or None on success
+    int
+        status code
+    bytes or None
+        encoded body, or None on error
+    """
     result, status_code, _patient = fetch_patient_driver(room_number)
-    return jsonify(result), status_code
+    if status_code != 200:
+        return result, status_code, None
+    body, _encoding = encode_body(result, *variant, min_size=0)
+    response_cache.put(int(room_number), tag, body, variant)
+    return None, 200, body
+
+
+@app.route('/lab/cache_stats', methods=['GET'])
+def cache_stats():
+    """GET route returning the counters of the response cache.
+
+    This function implements the GET `/lab/cache_stats` route, returning the
+    hits, misses, evictions, hit rate and size of the cache serving
+    `/lab/fetch_patient/<room_number>`, counted since the server started.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        JSON encoded cache counters
+    int
+        status code
+    """
+    return jsonify(response_cache.stats()), 200
 
 
 def fetch_patient_driver(room_number):
@@ -465,17 +2237,11 @@ def fetch_patient_driver(room_number):
     using the validate_and_convert_int function. In the case of being called
     from fetch_patient this will always be a string. However, in the rare case
     the parameter cannot be converted into an integer an error message is
-    returned with a status code of 400 and None. A validation function is
-    called to verify the existence of patient data associated with the input
-    room number. If no data is present, the error message from
-    validate_room_number is returned with a status code of 400 and None
-    Otherwise, the validate_room_number returns True and the SleepLabRooms
-    object is called from the database with the associated room number. This
-    object is then converted into a dictionary for later JSON encoding. The
-    dictionary containg patient data is then returned with a status code of
-    200. Note the error messaged from SleepLabRooms_to_dict will never be
-    returned due to the function verifying the existence of a SleepLabRooms
-    instance with the input room number.
+    returned with a status code of 400 and None. If no patient is associated
+    with the room number, an error message is returned with a status code of
+    400 and None. Otherwise, the room is read from the room storage as a
+    dictionary ready for JSON encoding, which is returned with a status code
+    of 200.
 
     Parameters
     ----------
@@ -485,23 +2251,19 @@ def fetch_patient_driver(room_number):
     Returns
     -------
     dict or str
-        patient data from SleepLabRooms database object or error message
+        patient data or error message
     int
         status code
-    SleepLabRooms object or None
-        instance of SleepLabRooms from database or None in the case of an error
+    dict or None
+        room as stored, or None in the case of an error
     """
     valid, result = validate_and_convert_int(room_number)
     if valid is not True:
         return result, 400, None
-    msg = validate_room_number(result)
-    if msg is not True:
-        return msg, 400, None
-    patient = db.objects.raw({"_id": result}).first()
-    status, result = SleepLabRooms_to_dict(patient)
-    if status is not True:
-        return result, 400, None
-    return result, 200, patient
+    room = store.get_room(result)
+    if room is None:
+        return "Patient not associated with room number entry.", 400, None
+    return room, 200, room
 
 
 @app.route('/patient/fetch_pressure/<room_number>', methods=['GET'])
@@ -518,6 +2280,10 @@ def fetch_patient_pressure(room_number):
     and a status code of 200. The result is JSON encoded
     and the status code is returned.
 
+    As with `/lab/fetch_patient/<room_number>`, successful responses carry
+    the version tag of the room as their ETag and a matching `If-None-Match`
+    header is answered with status code 304 without reading the database.
+
     Parameters
     ----------
     None
@@ -530,8 +2296,16 @@ def fetch_patient_pressure(room_number):
         status code
     """
     room_int = int(room_number)
-    result, status_code = fetch_pressure_driver(room_int)
-    return str(result), status_code
+    if room_not_modified(room_int):
+        return "", 304
+    tag = room_etag(room_int)
+    result, status_code = single_flight.do(
+        ("fetch_pressure", room_int, tag),
+        lambda: fetch_pressure_driver(room_int))
+    response = make_response(str(result), status_code)
+    if status_code == 200:
+        response.set_etag(tag)
+    return response
 
 
 def fetch_pressure_driver(room_number):
@@ -539,12 +2313,9 @@ def fetch_pressure_driver(room_number):
 
     This function implements the GET `/patient/fetch_patient/<room_number>`
     route.
-    A validation function is called to verify the existence of patient data
-    associated with the input room number. If no data is present, the error
-    message from validate_room_number is returned with a status code of 400.
-    Otherwise, the patient data is obtained in the form of a callable
-    SleepLabRooms object from the imported MongoDB database and returned with
-    a status code of 200.
+    The CPAP pressure of the patient is read from the room storage and
+    returned with a status code of 200. If the room has no patient, an error
+    message is returned with a status code of 400.
 
     Parameters
     ----------
@@ -553,19 +2324,203 @@ def fetch_pressure_driver(room_number):
 
     Returns
     -------
-    fields.IntegerField()
+    int
         patient pressure
     int
         status code
     """
-    msg = validate_room_number(room_number)
-    if msg is not True:
-        return msg, 400
-    patient = db.objects.raw({"_id": room_number}).first()
-    patient_cpap_pressure = patient.cpap_pressure
+    patient_cpap_pressure = store.get_pressure(room_number)
+    if patient_cpap_pressure is None:
+        return "Patient not associated with room number entry.", 400
     return patient_cpap_pressure, 200
 
 
+@app.route('/patient/fetch_pressures', methods=['GET'])
+def fetch_pressures():
+    """GET route returning the CPAP pressures of many rooms.
+
+    This function implements the GET `/patient/fetch_pressures` route. The
+    optional `rooms` query argument lists the room numbers, separated by
+    commas; every occupied room is returned if it is missing. The pressures
+    are read by a driver function and returned as JSON with a status code.
+
+    When rooms are listed, successful responses carry a version tag
+    covering all of them as their ETag, and a matching `If-None-Match`
+    header is answered with status code 304 without reading the database.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        JSON encoded pressures or error message
+    int
+        status code
+    """
+    tag = None
+    if request.args.get("rooms"):
+        try:
+            tag = rooms_etag([int(room) for room in
+                              request.args["rooms"].split(",")])
+        except ValueError:
+            pass
+    if tag is not None and request.if_none_match.contains(tag):
+        return "", 304
+    result, status_code = fetch_pressures_driver(request.args)
+    response = jsonify(result)
+    if status_code == 200 and tag is not None:
+        response.set_etag(tag)
+    return response, status_code
+
+
+def fetch_pressures_driver(args):
+    """Reads the CPAP pressures of many rooms in a single query.
+
+    Parameters
+    ----------
+    args : dict
+        query arguments of the request, with an optional comma-separated
+        list of at most MAX_PRESSURE_ROOMS room numbers under "rooms"
+
+    Returns
+    -------
+    dict or str
+        "rooms" list holding the "room_number" and "cpap_pressure" of each
+        room, with a pressure of None for empty rooms, or an error message
+    int
+        status code
+    """
+    rooms = None
+    if args.get("rooms"):
+        try:
+            rooms = [int(room) for room in args["rooms"].split(",")]
+        except ValueError:
+            return "rooms must be a comma-separated list of room " \
+                "numbers.", 400
+        if len(rooms) > MAX_PRESSURE_ROOMS:
+            return "At most {} rooms may be fetched at once.".format(
+                MAX_PRESSURE_ROOMS), 400
+    pressures = store.get_pressures(rooms)
+    if rooms is None:
+        rooms = sorted(pressures)
+    return {"rooms": [{"room_number": room_number,
+                       "cpap_pressure": pressures.get(room_number)}
+                      for room_number in rooms]}, 200
+
+
+@app.route('/patient/pressure_stream/<int:room_number>', methods=['GET'])
+def pressure_stream(room_number):
+    """GET route streaming CPAP pressure changes to the patient side.
+
+    This function implements the GET `/patient/pressure_stream/<room_number>`
+    route as a Server-Sent Events stream. Each pressure written for the room,
+    either from the monitoring side or by an upload, is pushed as a
+    `pressure` event with a JSON payload holding the room number and the new
+    CPAP pressure. A heartbeat comment is sent when the stream is idle.
+
+    A reconnecting client may send the ID of the last event it received in
+    the `Last-Event-ID` header (or the `last_event_id` query parameter), in
+    which case the missed events are replayed. Otherwise, or if those events
+    are no longer available, the stream starts with the current pressure read
+    from the database. If the room has no patient, an error message and a
+    400 status code are returned instead of a stream.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+
+    Returns
+    -------
+    Response
+        `text/event-stream` response, or error message and status code
+    """
+    last_event_id = request.headers.get("Last-Event-ID",
+                                        request.args.get("last_event_id"))
+    seq = room_events.resume_point(last_event_id)
+    initial = []
+    if seq is None:
+        seq = room_events.latest_seq()
+        pressure, status_code = fetch_pressure_driver(room_number)
+        if status_code != 200:
+            return pressure, status_code
+        initial.append((seq, "pressure", {"room_number": room_number,
+                                          "cpap_pressure": pressure}))
+
+    def accept(event, data):
+        return event == "pressure" and data["room_number"] == room_number
+
+    body = stream_events(room_events, seq, accept, initial,
+                         SSE_HEARTBEAT_SECONDS)
+    return event_stream_response(body)
+
+
+@app.route('/lab/event_stream', methods=['GET'])
+def lab_event_stream():
+    """GET route streaming events of all rooms to the monitoring side.
+
+    This function implements the GET `/lab/event_stream` route as a single
+    Server-Sent Events stream covering the whole ward, so a lab station does
+    not have to poll every room. The following events are sent, each with a
+    JSON payload including the room number:
+
+        - rooms: list of occupied room numbers, sent when the stream starts
+        - upload: timestamp, breathing rate and apnea count of a new
+          calculation
+        - apnea_alert: sent with an upload whose apnea count is at least
+          APNEA_ALERT_THRESHOLD
+        - pressure: new CPAP pressure of the room
+        - reset: the patient was removed from the room
+
+    Resuming with `Last-Event-ID` works as for
+    `/patient/pressure_stream/<room_number>`. When the missed events cannot
+    be replayed, the stream starts with a fresh `rooms` event instead.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    Response
+        `text/event-stream` response
+    """
+    last_event_id = request.headers.get("Last-Event-ID",
+                                        request.args.get("last_event_id"))
+    seq = room_events.resume_point(last_event_id)
+    initial = []
+    if seq is None:
+        seq = room_events.latest_seq()
+        rooms, _status_code = list_rooms_driver()
+        initial.append((seq, "rooms", {"rooms": rooms}))
+    body = stream_events(room_events, seq, lambda event, data: True,
+                         initial, SSE_HEARTBEAT_SECONDS)
+    return event_stream_response(body)
+
+
+def event_stream_response(body):
+    """Wraps an SSE generator in a streaming response.
+
+    Caching and proxy buffering are disabled so each event reaches the client
+    as soon as it is generated.
+
+    Parameters
+    ----------
+    body : generator of str
+        SSE messages
+
+    Returns
+    -------
+    Response
+        `text/event-stream` response
+    """
+    return Response(body, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
+
+
 @app.route('/reset/<int:mrn>', methods=['GET'])
 def reset_patient_data(mrn):
     """
@@ -613,13 +2568,14 @@ def delete_patient_record(mrn):
         A tuple containing a boolean indicating success or failure, and a
         message string.
     """
-    try:
-        # Fetch the patient record by MRN
-        patient = db.objects.get({'patient_mrn': mrn})
-        patient.delete()
-        return True, "Patient data reset successfully"
-    except db.DoesNotExist:
+    room_number = store.delete_patient(mrn)
+    if room_number is None:
         return False, "Patient with MRN {} not found".format(mrn)
+    with live_streams_lock:
+        live_streams.pop(room_number, None)
+    mark_room_changed(room_number)
+    room_events.publish("reset", {"room_number": room_number})
+    return True, "Patient data reset successfully"
 
 
 def file_to_b64_string(filename):
@@ -675,41 +2631,9 @@ def b64_string_to_file(b64_string, filename):
     return None
 
 
-def SleepLabRooms_to_dict(patient):
-    """Converts an instance of a SleepLabRooms object to a dictionary
-
-    Data contained in an SleepLabRooms instance must be JSON encoded and sent
-    from the web server. Since a SleepLabRooms instance cannot be JSON encoded,
-    this function takes the data from the fields of a SleepLabRooms instance
-    and creates a dictionary to be returned. If the parameter passed to the
-    function is not a SleepLabRooms instance, False and an error message are
-    returned. Otherwise, the function returns True and return the associated
-    dictionary.
-
-    Parameters
-    ----------
-    patient : SleepLabRooms object
-        SleepLabRooms instance containing data of interest
-
-    Returns
-    -------
-    dict
-        dictionary containing data from SleepLabRooms instance
-    """
-    if isinstance(patient, db) is False:
-        return False, "Input must be SleepLabRooms instance."
-    patient_dict = {"room_number": patient.room_number,
-                    "patient_name": patient.patient_name,
-                    "patient_mrn": patient.patient_mrn,
-                    "cpap_pressure": patient.cpap_pressure,
-                    "cpap_calculations": patient.cpap_calculations
-                    }
-    return True, patient_dict
-
-
 def main():
-    print("Server running")
-    print(type(db.objects.get({"_id": 3})))
+    print("Server running on {} storage".format(store.name))
+    prepare_store()
     print(fetch_patient_driver(4)[0])
     # app.run()
 
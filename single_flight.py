@@ -0,0 +1,103 @@
+import threading
+import time
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished = None
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Shares one call among concurrent callers asking for the same key.
+
+    The first caller of `do` for a key runs the function; callers arriving
+    while it runs wait for it and receive the same result, or the same
+    exception. A successful result keeps being handed out for `window`
+    seconds after the call finished, so a burst of polls arriving just
+    after a read still shares it. Keys should include the version of the
+    data read, such as the room version tag, so that a write is never
+    hidden by the window. Results are shared between threads and must not
+    be modified by the callers.
+
+    Parameters
+    ----------
+    window : float
+        seconds a finished result stays shared, 0 to share in-flight calls
+        only
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._shared = 0
+
+    def do(self, key, function):
+        """Returns the result of `function()`, shared with concurrent calls
+        for the same key.
+
+        Parameters
+        ----------
+        key : hashable
+            identity of the read, such as the route, room and version tag
+        function : callable
+            function performing the read, called without arguments
+
+        Returns
+        -------
+        object
+            result of the call
+        """
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.finished is not None \
+                    and now - flight.finished > self.window:
+                flight = None
+            leader = flight is None
+            if leader:
+                self._expire(now)
+                flight = self._flights[key] = _Flight()
+                self._calls += 1
+            else:
+                self._shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                flight.finished = time.monotonic()
+                if (flight.error is not None or self.window <= 0) \
+                        and self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _expire(self, now):
+        for key in [key for key, flight in self._flights.items()
+                    if flight.finished is not None
+                    and now - flight.finished > self.window]:
+            del self._flights[key]
+
+    def stats(self):
+        """Returns the counters of the coalescing.
+
+        Returns
+        -------
+        dict
+            number of calls run and of callers served a shared result
+        """
+        with self._lock:
+            return {"calls": self._calls, "shared": self._shared}
@@ -0,0 +1,1587 @@
+import copy
+import json
+import sqlite3
+import threading
+from datetime import timedelta
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from DB_init import SleepLabRooms, SampleBuckets, Waveforms
+from DB_init import CalculationImages, CalculationThumbnails
+from DB_init import DailySummaries
+from DB_init import make_calculation, calculation_to_list, parse_timestamp
+from DB_init import get_collection, create_indexes, delete_room_data
+from CPAP_measurement import waveform_window, chunk_window
+
+
+def calculation_summary(cpap_calculation):
+    """Summarizes a CPAP calculation without its flow rate image.
+
+    Calculations are stored as `[timestamp, breath rate, apnea count, image]`
+    lists. This function returns the first three entries as a dictionary, or
+    None if the calculation is not in that form.
+
+    Parameters
+    ----------
+    cpap_calculation : list
+        calculation uploaded for a patient
+
+    Returns
+    -------
+    dict or None
+        dictionary with "timestamp", "breath_rate_bpm" and "apnea_count" keys
+    """
+    if type(cpap_calculation) is not list or len(cpap_calculation) < 3:
+        return None
+    timestamp, breath_rate, apnea_count = cpap_calculation[:3]
+    return {"timestamp": timestamp,
+            "breath_rate_bpm": breath_rate,
+            "apnea_count": apnea_count}
+
+
+def SleepLabRooms_to_dict(patient):
+    """Converts an instance of a SleepLabRooms object to a dictionary
+
+    Data contained in an SleepLabRooms instance must be JSON encoded and sent
+    from the web server. Since a SleepLabRooms instance cannot be JSON encoded,
+    this function takes the data from the fields of a SleepLabRooms instance
+    and creates a dictionary to be returned. If the parameter passed to the
+    function is not a SleepLabRooms instance, False and an error message are
+    returned. Otherwise, the function returns True and return the associated
+    dictionary.
+
+    Parameters
+    ----------
+    patient : SleepLabRooms object
+        SleepLabRooms instance containing data of interest
+
+    Returns
+    -------
+    dict
+        dictionary containing data from SleepLabRooms instance
+    """
+    if isinstance(patient, SleepLabRooms) is False:
+        return False, "Input must be SleepLabRooms instance."
+    patient_dict = {"room_number": patient.room_number,
+                    "patient_name": patient.patient_name,
+                    "patient_mrn": patient.patient_mrn,
+                    "cpap_pressure": patient.cpap_pressure,
+                    "cpap_calculations": [calculation_to_list(calculation)
+                                          for calculation
+                                          in patient.cpap_calculations]
+                    }
+    return True, patient_dict
+
+
+def backfill_latest_calculations():
+    """Adds the latest calculation summary to rooms stored without one.
+
+    Room documents written before the `latest_calculation` field existed are
+    given a summary of the last entry of their calculation history. Rooms
+    that already have a summary are not read, so this is cheap to run at
+    every server start.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    int
+        number of updated rooms
+    """
+    updated = 0
+    missing = SleepLabRooms.objects.raw(
+        {"latest_calculation": {"$exists": False}})
+    for patient in missing.only("room_number", "cpap_calculations"):
+        if not patient.cpap_calculations:
+            continue
+        summary = calculation_summary(
+            calculation_to_list(patient.cpap_calculations[-1]))
+        if summary is None:
+            continue
+        SleepLabRooms.objects.raw({"_id": patient.room_number}).update(
+            {"$set": {"latest_calculation": summary}})
+        updated += 1
+    return updated
+
+
+def migrate_calculations(batch_size=100):
+    """Converts calculation histories stored as lists into subdocuments.
+
+    Calculations used to be stored as `[timestamp, breath rate, apnea count,
+    image]` lists. Rooms still holding such lists are read in batches of
+    `batch_size`, ordered by room number, and each batch is rewritten with
+    one `bulk_write`. Every update only applies if the history is unchanged
+    since it was read, so a calculation appended meanwhile is never lost;
+    such a room, or one with a malformed entry, is simply left for the next
+    run. Converted rooms no longer match the query, so an interrupted
+    migration resumes where it stopped when run again, and running it on a
+    migrated database reads nothing.
+
+    Parameters
+    ----------
+    batch_size : int
+        number of rooms converted per batch
+
+    Returns
+    -------
+    int
+        number of converted rooms
+    """
+    collection = get_collection(SleepLabRooms)
+    query = {"cpap_calculations": {
+        "$elemMatch": {"timestamp": {"$exists": False}}}}
+    converted = 0
+    last_room = None
+    while True:
+        if last_room is not None:
+            query["_id"] = {"$gt": last_room}
+        batch = list(collection.find(query, {"cpap_calculations": 1})
+                     .sort("_id", 1).limit(batch_size))
+        if not batch:
+            return converted
+        last_room = batch[-1]["_id"]
+        operations = []
+        for room in batch:
+            calculations = [entry if isinstance(entry, dict)
+                            else make_calculation(entry)
+                            for entry in room["cpap_calculations"]]
+            if None in calculations:
+                continue
+            operations.append(UpdateOne(
+                {"_id": room["_id"],
+                 "cpap_calculations": room["cpap_calculations"]},
+                {"$set": {"cpap_calculations": [
+                    entry if isinstance(entry, dict)
+                    else entry.to_son().to_dict()
+                    for entry in calculations]}}))
+        if operations:
+            converted += collection.bulk_write(
+                operations, ordered=False).modified_count
+
+
+def trend_pipeline(rooms, start, end, bucket_seconds):
+    """Builds the aggregation pipeline behind the trend route.
+
+    Rooms with a calculation recorded in [start, end) are selected through
+    the index on `cpap_calculations.recorded_at`, then each of their
+    calculations is unwound into its own document and those outside the
+    range dropped. The rest are grouped by room and by the index of the
+    `bucket_seconds` long bucket they fall in, counted from `start`, so only
+    one small document per non-empty bucket leaves the database server.
+    Buckets hold sums and counts rather than means so they can be combined
+    with the daily summaries of compacted calculations.
+
+    Parameters
+    ----------
+    rooms : list of int or None
+        room numbers to aggregate, or None for every room
+    start : datetime.datetime
+        start of the range
+    end : datetime.datetime
+        end of the range
+    bucket_seconds : int
+        length of a bucket in seconds
+
+    Returns
+    -------
+    list of dict
+        aggregation pipeline, yielding documents with an "_id" holding the
+        "room" and "bucket" index, the "count" of calculations and the sum,
+        count of calculations with a value and maximum of the breath rate
+        and apnea count, as "breath_rate_sum", "breath_rate_count",
+        "breath_rate_max" and likewise for "apnea_count"
+    """
+    in_range = {"cpap_calculations.recorded_at": {"$gte": start,
+                                                  "$lt": end}}
+    breath_rate = "$cpap_calculations.breath_rate_bpm"
+    apnea_count = "$cpap_calculations.apnea_count"
+    match = dict(in_range)
+    if rooms is not None:
+        match["_id"] = {"$in": rooms}
+    return [
+        {"$match": match},
+        {"$project": {"cpap_calculations.recorded_at": 1,
+                      "cpap_calculations.breath_rate_bpm": 1,
+                      "cpap_calculations.apnea_count": 1}},
+        {"$unwind": "$cpap_calculations"},
+        {"$match": in_range},
+        {"$group": {
+            "_id": {"room": "$_id",
+                    "bucket": {"$floor": {"$divide": [
+                        {"$subtract": ["$cpap_calculations.recorded_at",
+                                       start]},
+                        bucket_seconds * 1000]}}},
+            "count": {"$sum": 1},
+            "breath_rate_sum": {"$sum": breath_rate},
+            "breath_rate_count": {"$sum": {"$cond": [
+                {"$gt": [breath_rate, None]}, 1, 0]}},
+            "breath_rate_max": {"$max": breath_rate},
+            "apnea_count_sum": {"$sum": apnea_count},
+            "apnea_count_count": {"$sum": {"$cond": [
+                {"$gt": [apnea_count, None]}, 1, 0]}},
+            "apnea_count_max": {"$max": apnea_count}}}]
+
+
+def summary_trend_pipeline(rooms, start, end, bucket_seconds):
+    """Builds the aggregation pipeline adding daily summaries to trends.
+
+    Calculations compacted out of the room documents by the retention policy
+    survive as `DailySummaries` records. Their totals are grouped into the
+    same buckets as `trend_pipeline`, each day counted whole in the bucket
+    holding its midnight. A day that began before `start` but ends after it
+    is counted in the first bucket. Summaries have a resolution of one day:
+    with buckets shorter than a day, the totals of a compacted day all land
+    in one bucket and the buckets of its other hours stay empty.
+
+    Parameters
+    ----------
+    rooms : list of int or None
+        room numbers to aggregate, or None for every room
+    start : datetime.datetime
+        start of the range
+    end : datetime.datetime
+        end of the range
+    bucket_seconds : int
+        length of a bucket in seconds
+
+    Returns
+    -------
+    list of dict
+        aggregation pipeline yielding documents shaped like those of
+        `trend_pipeline`
+    """
+    match = {"day": {"$gt": start - timedelta(days=1), "$lt": end}}
+    if rooms is not None:
+        match["room_number"] = {"$in": rooms}
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"room": "$room_number",
+                    "bucket": {"$max": [0, {"$floor": {"$divide": [
+                        {"$subtract": ["$day", start]},
+                        bucket_seconds * 1000]}}]}},
+            "count": {"$sum": "$count"},
+            "breath_rate_sum": {"$sum": "$breath_rate_sum"},
+            "breath_rate_count": {"$sum": "$breath_rate_count"},
+            "breath_rate_max": {"$max": "$breath_rate_max"},
+            "apnea_count_sum": {"$sum": "$apnea_count_sum"},
+            "apnea_count_count": {"$sum": "$apnea_count_count"},
+            "apnea_count_max": {"$max": "$apnea_count_max"}}}]
+
+
+def store_sample_buckets(room_number, session_id, samples, sequence=None):
+    """Appends raw samples to their per-minute SampleBuckets documents.
+
+    Samples are grouped by minute of recording time and each group is pushed
+    onto its bucket document with an upsert, all in one unordered bulk write.
+    A batch with a sequence number is recorded in the "sequences" list of
+    each bucket it wrote to, and skipped by the buckets already holding it:
+    their upsert fails on the unique bucket index and the error is ignored.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    session_id : str
+        ID of the recording session
+    samples : list of list
+        validated samples
+    sequence : int or None
+        sequence number of the batch in its session
+
+    Returns
+    -------
+    bool
+        False if every bucket of the batch already held it
+    """
+    buckets = {}
+    for sample in samples:
+        buckets.setdefault(int(sample[0] // 60), []).append(sample)
+    if not buckets:
+        return True
+    operations = []
+    for minute, bucket in sorted(buckets.items()):
+        key = {"room_number": room_number, "session_id": session_id,
+               "minute": minute}
+        update = {"$push": {"samples": {"$each": bucket}},
+                  "$inc": {"count": len(bucket)}}
+        if sequence is not None:
+            key["sequences"] = {"$ne": sequence}
+            update["$push"]["sequences"] = sequence
+        operations.append(UpdateOne(key, update, upsert=True))
+    try:
+        get_collection(SampleBuckets).bulk_write(operations, ordered=False)
+    except BulkWriteError as error:
+        details = error.details
+        if sequence is None or details.get("writeConcernErrors") or any(
+                write["code"] != 11000 for write in details["writeErrors"]):
+            raise
+        return len(details["writeErrors"]) < len(operations)
+    return True
+
+
+class RoomStore:
+    """Interface of the room storage behind the server drivers.
+
+    Rooms are exchanged as dictionaries in the form sent to clients, with
+    calculations as `[timestamp, breath rate, apnea count, image]` lists, so
+    drivers never depend on how a backend lays out its data. Every method
+    may be called from several request threads at once.
+    """
+
+    name = None
+
+    def prepare(self):
+        """Readies the backend before the server takes requests.
+
+        Returns
+        -------
+        None
+        """
+
+    def list_rooms(self):
+        """Returns the occupied room numbers in ascending order.
+
+        Returns
+        -------
+        list of int
+            room numbers
+        """
+        raise NotImplementedError
+
+    def get_room(self, room_number):
+        """Returns a room with its full calculation history.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+
+        Returns
+        -------
+        dict or None
+            room_number, patient_name, patient_mrn, cpap_pressure and
+            cpap_calculations, or None if the room is empty
+        """
+        raise NotImplementedError
+
+    def get_pressure(self, room_number):
+        """Returns the CPAP pressure of a room.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+
+        Returns
+        -------
+        int or None
+            CPAP pressure, or None if the room is empty
+        """
+        raise NotImplementedError
+
+    def get_pressures(self, room_numbers=None):
+        """Returns the CPAP pressures of many rooms.
+
+        Backends override this to read every room in one query.
+
+        Parameters
+        ----------
+        room_numbers : list of int or None
+            room numbers of interest, every room if None
+
+        Returns
+        -------
+        dict
+            CPAP pressure of each occupied room, keyed by room number
+        """
+        if room_numbers is None:
+            room_numbers = self.list_rooms()
+        pressures = {}
+        for room_number in room_numbers:
+            pressure = self.get_pressure(room_number)
+            if pressure is not None:
+                pressures[room_number] = pressure
+        return pressures
+
+    def room_summaries(self):
+        """Returns a summary of every room, ordered by room number.
+
+        Returns
+        -------
+        list of dict
+            room_number, patient_name, patient_mrn and cpap_pressure of each
+            room, and the timestamp, breath_rate_bpm and apnea_count of its
+            latest calculation, or None if it has none
+        """
+        raise NotImplementedError
+
+    def save_upload(self, room_number, patient_mrn, patient_name,
+                    cpap_pressure, cpap_calculation):
+        """Stores an upload from the patient side.
+
+        If a patient with the MRN exists, their name and pressure are updated
+        and the calculation is appended to their history, whatever room the
+        upload names. Otherwise a new patient is created in the room,
+        replacing any patient stored there.
+
+        Parameters
+        ----------
+        room_number : int
+            room number given with the upload
+        patient_mrn : int
+            medical record number of the patient
+        patient_name : str
+            name of the patient
+        cpap_pressure : int
+            CPAP pressure
+        cpap_calculation : list
+            calculation validated by `DB_init.make_calculation`
+
+        Returns
+        -------
+        int
+            room number of the patient
+        bool
+            True if a new patient was created
+        """
+        raise NotImplementedError
+
+    def save_uploads(self, uploads):
+        """Stores a batch of uploads as if saved one after the other.
+
+        Backends override this to store the batch in fewer round trips than
+        one `save_upload` per entry. Errors that leave unknown which uploads
+        were stored, such as a lost connection, are raised, and the same
+        batch can then be sent again: a calculation already stored in the
+        patient's room is not added a second time, while the name and
+        pressure of the patient are still updated. MongoDB compares whole
+        calculations, the other backends their timestamps.
+
+        Parameters
+        ----------
+        uploads : list of tuple
+            room_number, patient_mrn, patient_name, cpap_pressure and
+            cpap_calculation of each upload, as taken by `save_upload`
+
+        Returns
+        -------
+        list of tuple or None
+            (room number, created) of each upload, as returned by
+            `save_upload`, or None for uploads refused by the database
+        """
+        return [self.save_upload(*upload) for upload in uploads]
+
+    def update_pressure(self, room_number, cpap_pressure):
+        """Sets the CPAP pressure of a room.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        cpap_pressure : int
+            new CPAP pressure
+
+        Returns
+        -------
+        bool
+            False if the room is empty
+        """
+        raise NotImplementedError
+
+    def update_pressures(self, pressures):
+        """Sets the CPAP pressures of many rooms.
+
+        Backends override this to apply every change in one write.
+
+        Parameters
+        ----------
+        pressures : dict
+            new CPAP pressure of each room, keyed by room number
+
+        Returns
+        -------
+        list of int
+            room numbers of the updated rooms, leaving out empty rooms
+        """
+        return [room_number for room_number, cpap_pressure in
+                pressures.items()
+                if self.update_pressure(room_number, cpap_pressure)]
+
+    def delete_patient(self, patient_mrn):
+        """Deletes a patient and every record kept for their room.
+
+        Parameters
+        ----------
+        patient_mrn : int
+            medical record number of the patient
+
+        Returns
+        -------
+        int or None
+            room number of the deleted patient, or None if not found
+        """
+        raise NotImplementedError
+
+    def get_live_metrics(self, room_number):
+        """Returns the live metrics saved for a room.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+
+        Returns
+        -------
+        dict or None
+            live metrics, empty if none were saved, or None if the room is
+            empty
+        """
+        raise NotImplementedError
+
+    def set_live_metrics(self, room_number, metrics):
+        """Saves the live metrics of a room.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        metrics : dict
+            live metrics
+
+        Returns
+        -------
+        None
+        """
+        raise NotImplementedError
+
+    def append_samples(self, room_number, session_id, samples,
+                       sequence=None):
+        """Stores raw samples streamed from a bedside device.
+
+        A batch sent with a sequence number is stored once per session:
+        sending it again, for instance after a lost response, stores
+        nothing.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        session_id : str
+            ID of the recording session
+        samples : list of list
+            validated samples
+        sequence : int or None
+            sequence number of the batch in its session
+
+        Returns
+        -------
+        bool
+            False if the batch of that sequence number was already stored
+        """
+        raise NotImplementedError
+
+    def put_waveform(self, room_number, timestamp, waveform):
+        """Stores the flow rate waveform of a calculation.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        timestamp : str
+            timestamp of the calculation
+        waveform : dict
+            waveform built by `CPAP_measurement.encode_waveform`
+
+        Returns
+        -------
+        None
+        """
+        raise NotImplementedError
+
+    def get_waveform(self, room_number, timestamp, t0=None, t1=None,
+                     points=None):
+        """Returns the flow rate waveform of a calculation.
+
+        When `points` is given, the waveform only needs to hold what
+        `CPAP_measurement.query_waveform` reads for that range and number
+        of points, so a store may leave the other chunks out.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        timestamp : str
+            timestamp of the calculation
+        t0, t1 : float or None
+            time range that will be queried, the whole recording if None
+        points : int or None
+            number of points that will be queried, None for the whole
+            waveform
+
+        Returns
+        -------
+        dict or None
+            waveform, or None if none is stored
+        """
+        raise NotImplementedError
+
+    def put_image(self, room_number, timestamp, content_type, data):
+        """Stores the flow rate plot of a calculation.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        timestamp : str
+            timestamp of the calculation
+        content_type : str
+            media type of the image
+        data : bytes
+            image file
+
+        Returns
+        -------
+        None
+        """
+        raise NotImplementedError
+
+    def get_image(self, room_number, timestamp):
+        """Returns the flow rate plot of a calculation.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        timestamp : str
+            timestamp of the calculation
+
+        Returns
+        -------
+        tuple or None
+            media type and bytes of the image, or None if none is stored
+        """
+        raise NotImplementedError
+
+    def put_thumbnail(self, room_number, timestamp, size, data):
+        """Stores a PNG thumbnail of the flow rate plot of a calculation.
+
+        Thumbnails of a calculation are dropped by `put_image` when its plot
+        is replaced.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        timestamp : str
+            timestamp of the calculation
+        size : int
+            edge length of the thumbnail in pixels
+        data : bytes
+            PNG file
+
+        Returns
+        -------
+        None
+        """
+        raise NotImplementedError
+
+    def get_thumbnail(self, room_number, timestamp, size):
+        """Returns a PNG thumbnail of the flow rate plot of a calculation.
+
+        Parameters
+        ----------
+        room_number : int
+            room number of the patient
+        timestamp : str
+            timestamp of the calculation
+        size : int
+            edge length of the thumbnail in pixels
+
+        Returns
+        -------
+        bytes or None
+            PNG file, or None if no thumbnail of that size is stored
+        """
+        raise NotImplementedError
+
+    def trend_totals(self, rooms, start, end, bucket_seconds):
+        """Aggregates the calculations recorded in a range into buckets.
+
+        Parameters
+        ----------
+        rooms : list of int or None
+            room numbers to aggregate, or None for every room
+        start : datetime.datetime
+            start of the range
+        end : datetime.datetime
+            end of the range
+        bucket_seconds : int
+            length of a bucket in seconds
+
+        Returns
+        -------
+        iterable of dict
+            bucket totals shaped like the documents of `trend_pipeline`; a
+            bucket may appear more than once and must then be added up
+        """
+        raise NotImplementedError
+
+
+class MongoRoomStore(RoomStore):
+    """Room storage in MongoDB through the pymodm models of `DB_init`."""
+
+    name = "mongo"
+
+    def prepare(self):
+        create_indexes()
+        migrate_calculations()
+        backfill_latest_calculations()
+
+    def list_rooms(self):
+        rooms = get_collection(SleepLabRooms).find({}, {"_id": 1})
+        return [room["_id"] for room in rooms.sort("_id", 1)]
+
+    def get_room(self, room_number):
+        try:
+            patient = SleepLabRooms.objects.raw({"_id": room_number}).first()
+        except SleepLabRooms.DoesNotExist:
+            return None
+        return SleepLabRooms_to_dict(patient)[1]
+
+    def get_pressure(self, room_number):
+        room = get_collection(SleepLabRooms).find_one(
+            {"_id": room_number}, {"cpap_pressure": 1})
+        return None if room is None else room.get("cpap_pressure")
+
+    def get_pressures(self, room_numbers=None):
+        query = {} if room_numbers is None \
+            else {"_id": {"$in": list(room_numbers)}}
+        rooms = get_collection(SleepLabRooms).find(query,
+                                                   {"cpap_pressure": 1})
+        return {room["_id"]: room.get("cpap_pressure") for room in rooms}
+
+    def room_summaries(self):
+        results = SleepLabRooms.objects.raw({}).only(
+            "room_number", "patient_name", "patient_mrn", "cpap_pressure",
+            "latest_calculation").order_by([("_id", 1)]).values()
+        return [room_summary(room["_id"], room) for room in results]
+
+    def save_upload(self, room_number, patient_mrn, patient_name,
+                    cpap_pressure, cpap_calculation):
+        calculation = make_calculation(cpap_calculation)
+        summary = calculation_summary(cpap_calculation)
+        try:
+            existing = SleepLabRooms.objects.only("room_number").get(
+                {"patient_mrn": patient_mrn})
+        except SleepLabRooms.DoesNotExist:
+            # Nothing of a previous patient of the room is kept.
+            delete_room_data(room_number)
+            SleepLabRooms(room_number=room_number,
+                          patient_name=patient_name,
+                          patient_mrn=patient_mrn,
+                          cpap_pressure=cpap_pressure,
+                          cpap_calculations=[calculation],
+                          latest_calculation=summary).save()
+            return room_number, True
+        # Append the calculation in place rather than rewriting the whole
+        # history
+        SleepLabRooms.objects.raw({"_id": existing.room_number}).update({
+            "$set": {"patient_name": patient_name,
+                     "cpap_pressure": cpap_pressure,
+                     "latest_calculation": summary},
+            "$push": {"cpap_calculations": calculation.to_son().to_dict()}})
+        return existing.room_number, False
+
+    def save_uploads(self, uploads):
+        # The uploads are replayed in order against the rooms of the
+        # patients in the batch, found with a single query: an upload of a
+        # known patient is an update of their room, and one of a new patient
+        # replaces the room it names, displacing the patient stored there.
+        # The data of the rooms given to new patients is deleted once the
+        # bulk write is done.
+        # Writes to different rooms commute, so an upload is merged into
+        # the last write to its room when that write is for the same
+        # patient, and each patient usually costs one write. All writes
+        # are sent in one ordered bulk write. A write refused by the
+        # database fails its uploads only: the bulk write stops there and
+        # is resent from the next write. Calculations are added with
+        # $addToSet, so a batch sent again after an error, such as a write
+        # concern error that leaves it unknown what was stored, does not
+        # repeat them.
+        if not uploads:
+            return []
+        rooms = self._patient_rooms({upload[1] for upload in uploads})
+        occupants = {room_number: patient_mrn
+                     for patient_mrn, room_number in rooms.items()}
+        results = []
+        writes = []
+        last_writes = {}
+        for index, upload in enumerate(uploads):
+            room_number, patient_mrn = upload[0], upload[1]
+            created = patient_mrn not in rooms
+            if created:
+                rooms.pop(occupants.get(room_number), None)
+                rooms[patient_mrn] = room_number
+                occupants[room_number] = patient_mrn
+            else:
+                room_number = rooms[patient_mrn]
+            write = last_writes.get(room_number)
+            if created or write is None or write[1] != patient_mrn:
+                write = last_writes[room_number] = (room_number, patient_mrn,
+                                                    created, [])
+                writes.append(write)
+            write[3].append(index)
+            results.append((room_number, created))
+        operations = [self._upload_operation(write, uploads)
+                      for write in writes]
+        collection = get_collection(SleepLabRooms)
+        start = 0
+        while start < len(operations):
+            try:
+                collection.bulk_write(operations[start:])
+                break
+            except BulkWriteError as error:
+                write_errors = error.details.get("writeErrors")
+                if not write_errors or error.details.get(
+                        "writeConcernErrors"):
+                    raise
+                failed = start + write_errors[0]["index"]
+                for index in writes[failed][3]:
+                    results[index] = None
+                start = failed + 1
+        delete_room_data(*{write[0] for write in writes
+                           if write[2] and results[write[3][0]]})
+        return results
+
+    def _patient_rooms(self, patient_mrns):
+        # Returns the room of each of the patients that exist.
+        return {room["patient_mrn"]: room["_id"] for room in
+                get_collection(SleepLabRooms).find(
+                    {"patient_mrn": {"$in": list(patient_mrns)}},
+                    {"patient_mrn": 1})}
+
+    def _upload_operation(self, write, uploads):
+        # Builds the bulk write operation storing the uploads of a patient
+        # merged by save_uploads.
+        room_number, patient_mrn, created, indexes = write
+        last = uploads[indexes[-1]]
+        calculations = [make_calculation(uploads[index][4])
+                        for index in indexes]
+        summary = calculation_summary(last[4])
+        if created:
+            room = SleepLabRooms(room_number=room_number,
+                                 patient_name=last[2],
+                                 patient_mrn=patient_mrn,
+                                 cpap_pressure=last[3],
+                                 cpap_calculations=calculations,
+                                 latest_calculation=summary)
+            return ReplaceOne({"_id": room_number}, room.to_son().to_dict(),
+                              upsert=True)
+        return UpdateOne({"_id": room_number, "patient_mrn": patient_mrn}, {
+            "$set": {"patient_name": last[2],
+                     "cpap_pressure": last[3],
+                     "latest_calculation": summary},
+            "$addToSet": {"cpap_calculations": {"$each": [
+                calculation.to_son().to_dict()
+                for calculation in calculations]}}})
+
+    def update_pressure(self, room_number, cpap_pressure):
+        result = get_collection(SleepLabRooms).update_one(
+            {"_id": room_number}, {"$set": {"cpap_pressure": cpap_pressure}})
+        return result.matched_count > 0
+
+    def update_pressures(self, pressures):
+        if not pressures:
+            return []
+        collection = get_collection(SleepLabRooms)
+        result = collection.bulk_write(
+            [UpdateOne({"_id": room_number},
+                       {"$set": {"cpap_pressure": cpap_pressure}})
+             for room_number, cpap_pressure in pressures.items()],
+            ordered=False)
+        if result.matched_count == len(pressures):
+            return list(pressures)
+        # Some rooms were empty; the bulk result only counts the matches,
+        # so look up which of the rooms are occupied.
+        occupied = {room["_id"] for room in collection.find(
+            {"_id": {"$in": list(pressures)}}, {"_id": 1})}
+        return [room_number for room_number in pressures
+                if room_number in occupied]
+
+    def delete_patient(self, patient_mrn):
+        room = get_collection(SleepLabRooms).find_one_and_delete(
+            {"patient_mrn": patient_mrn}, {"_id": 1})
+        if room is None:
+            return None
+        delete_room_data(room["_id"])
+        return room["_id"]
+
+    def get_live_metrics(self, room_number):
+        room = get_collection(SleepLabRooms).find_one(
+            {"_id": room_number}, {"live_metrics": 1})
+        return None if room is None else room.get("live_metrics") or {}
+
+    def set_live_metrics(self, room_number, metrics):
+        get_collection(SleepLabRooms).update_one(
+            {"_id": room_number}, {"$set": {"live_metrics": metrics}})
+
+    def append_samples(self, room_number, session_id, samples,
+                       sequence=None):
+        return store_sample_buckets(room_number, session_id, samples,
+                                    sequence)
+
+    def put_waveform(self, room_number, timestamp, waveform):
+        key = {"room_number": room_number, "timestamp": timestamp}
+        get_collection(Waveforms).replace_one(
+            key, dict(key, waveform=waveform), upsert=True)
+
+    def get_waveform(self, room_number, timestamp, t0=None, t1=None,
+                     points=None):
+        key = {"room_number": room_number, "timestamp": timestamp}
+        collection = get_collection(Waveforms)
+        if points is None:
+            stored = collection.find_one(key)
+            return None if stored is None else stored["waveform"]
+        # A pyramid holds up to a few MiB of chunks. The level and chunks to
+        # read are chosen from the header, and only they are fetched.
+        stored = collection.find_one(key, {
+            "_id": 0, "waveform.t0": 1, "waveform.t1": 1,
+            "waveform.buckets": 1, "waveform.scale": 1})
+        if stored is None:
+            return None
+        waveform = stored["waveform"]
+        level, i0, i1 = waveform_window(waveform, t0, t1, points)
+        first, last = chunk_window(i0, i1)
+        project = {"_id": 0}
+        for bound in ("min", "max"):
+            project[bound] = {"$slice": [
+                {"$arrayElemAt": ["$waveform.levels." + bound, level]},
+                first, last - first + 1]}
+        # The header must still match, in case the waveform was replaced.
+        match = dict(key, **{"waveform." + name: waveform[name]
+                             for name in ("t0", "t1", "buckets")})
+        chunks = next(collection.aggregate([{"$match": match},
+                                            {"$project": project}]), None)
+        if chunks is None:
+            return None
+        waveform["levels"] = [None] * level + [
+            {bound: [None] * first + chunks[bound]
+             for bound in ("min", "max")}]
+        return waveform
+
+    def put_image(self, room_number, timestamp, content_type, data):
+        key = {"room_number": room_number, "timestamp": timestamp}
+        get_collection(CalculationImages).replace_one(
+            key, dict(key, content_type=content_type, data=data),
+            upsert=True)
+        get_collection(CalculationThumbnails).delete_many(key)
+
+    def get_image(self, room_number, timestamp):
+        stored = get_collection(CalculationImages).find_one(
+            {"room_number": room_number, "timestamp": timestamp})
+        if stored is None:
+            return None
+        return stored["content_type"], bytes(stored["data"])
+
+    def put_thumbnail(self, room_number, timestamp, size, data):
+        key = {"room_number": room_number, "timestamp": timestamp,
+               "size": size}
+        get_collection(CalculationThumbnails).replace_one(
+            key, dict(key, data=data), upsert=True)
+
+    def get_thumbnail(self, room_number, timestamp, size):
+        stored = get_collection(CalculationThumbnails).find_one(
+            {"room_number": room_number, "timestamp": timestamp,
+             "size": size}, {"data": 1})
+        return None if stored is None else bytes(stored["data"])
+
+    def trend_totals(self, rooms, start, end, bucket_seconds):
+        sources = [(SleepLabRooms,
+                    trend_pipeline(rooms, start, end, bucket_seconds)),
+                   (DailySummaries,
+                    summary_trend_pipeline(rooms, start, end,
+                                           bucket_seconds))]
+        for model, pipeline in sources:
+            yield from get_collection(model).aggregate(pipeline)
+
+
+def room_summary(room_number, room):
+    """Builds the dashboard summary of a room.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    room : dict
+        room holding patient_name, patient_mrn, cpap_pressure and
+        latest_calculation
+
+    Returns
+    -------
+    dict
+        summary described in `RoomStore.room_summaries`
+    """
+    latest = room.get("latest_calculation") or {}
+    return {"room_number": room_number,
+            "patient_name": room.get("patient_name"),
+            "patient_mrn": room.get("patient_mrn"),
+            "cpap_pressure": room.get("cpap_pressure"),
+            "timestamp": latest.get("timestamp"),
+            "breath_rate_bpm": latest.get("breath_rate_bpm"),
+            "apnea_count": latest.get("apnea_count")}
+
+
+def bucket_totals(room_number, bucket, calculations):
+    """Totals a group of calculations the way `trend_pipeline` does.
+
+    Parameters
+    ----------
+    room_number : int
+        room number of the patient
+    bucket : int
+        index of the bucket
+    calculations : list of list
+        calculations in the bucket
+
+    Returns
+    -------
+    dict
+        bucket totals
+    """
+    breath_rates = [c[1] for c in calculations if c[1] is not None]
+    apnea_counts = [c[2] for c in calculations if c[2] is not None]
+    return {"_id": {"room": room_number, "bucket": bucket},
+            "count": len(calculations),
+            "breath_rate_sum": sum(breath_rates),
+            "breath_rate_count": len(breath_rates),
+            "breath_rate_max": max(breath_rates, default=None),
+            "apnea_count_sum": sum(apnea_counts),
+            "apnea_count_count": len(apnea_counts),
+            "apnea_count_max": max(apnea_counts, default=None)}
+
+
+def recorded_at(cpap_calculation):
+    """Parses the timestamp of a calculation.
+
+    The time is naive, in UTC if the timestamp has a UTC offset, as parsed
+    by `DB_init.parse_timestamp`.
+
+    Parameters
+    ----------
+    cpap_calculation : list
+        calculation in list form
+
+    Returns
+    -------
+    datetime.datetime or None
+        recording time, or None if the timestamp cannot be parsed
+    """
+    try:
+        return parse_timestamp(cpap_calculation[0])
+    except (TypeError, ValueError):
+        return None
+
+
+class MemoryRoomStore(RoomStore):
+    """Room storage in the memory of the server process.
+
+    Nothing survives a restart. Meant for tests, benchmarks that measure the
+    server's own overhead, and demonstrations.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._rooms = {}
+        self._waveforms = {}
+        self._images = {}
+        self._thumbnails = {}
+        self._samples = {}
+        self._sample_batches = {}
+        self._lock = threading.Lock()
+
+    def list_rooms(self):
+        with self._lock:
+            return sorted(self._rooms)
+
+    def get_room(self, room_number):
+        with self._lock:
+            room = self._rooms.get(room_number)
+            if room is None:
+                return None
+            return copy.deepcopy(
+                {key: room[key] for key in ("room_number", "patient_name",
+                                            "patient_mrn", "cpap_pressure",
+                                            "cpap_calculations")})
+
+    def get_pressure(self, room_number):
+        with self._lock:
+            room = self._rooms.get(room_number)
+            return None if room is None else room["cpap_pressure"]
+
+    def room_summaries(self):
+        with self._lock:
+            return [room_summary(number, room)
+                    for number, room in sorted(self._rooms.items())]
+
+    def save_upload(self, room_number, patient_mrn, patient_name,
+                    cpap_pressure, cpap_calculation):
+        with self._lock:
+            return self._save_upload(room_number, patient_mrn, patient_name,
+                                     cpap_pressure, cpap_calculation)
+
+    def save_uploads(self, uploads):
+        # The batch is stored under one hold of the lock, and calculations
+        # the room already holds are skipped, so a batch sent again, as the
+        # write-behind journal does after a crash, does not repeat them.
+        with self._lock:
+            return [self._save_upload(*upload, unique=True)
+                    for upload in uploads]
+
+    def _save_upload(self, room_number, patient_mrn, patient_name,
+                     cpap_pressure, cpap_calculation, unique=False):
+        cpap_calculation = list(cpap_calculation)
+        summary = calculation_summary(cpap_calculation)
+        for room in self._rooms.values():
+            if room["patient_mrn"] == patient_mrn:
+                room["patient_name"] = patient_name
+                room["cpap_pressure"] = cpap_pressure
+                if not unique or all(
+                        calculation[0] != cpap_calculation[0]
+                        for calculation in room["cpap_calculations"]):
+                    room["cpap_calculations"].append(cpap_calculation)
+                room["latest_calculation"] = summary
+                return room["room_number"], False
+        self._delete_room_data(room_number)
+        self._rooms[room_number] = {"room_number": room_number,
+                                    "patient_name": patient_name,
+                                    "patient_mrn": patient_mrn,
+                                    "cpap_pressure": cpap_pressure,
+                                    "cpap_calculations": [cpap_calculation],
+                                    "latest_calculation": summary,
+                                    "live_metrics": {}}
+        return room_number, True
+
+    def update_pressure(self, room_number, cpap_pressure):
+        with self._lock:
+            room = self._rooms.get(room_number)
+            if room is None:
+                return False
+            room["cpap_pressure"] = cpap_pressure
+            return True
+
+    def delete_patient(self, patient_mrn):
+        with self._lock:
+            for number, room in self._rooms.items():
+                if room["patient_mrn"] == patient_mrn:
+                    break
+            else:
+                return None
+            del self._rooms[number]
+            self._delete_room_data(number)
+            return number
+
+    def _delete_room_data(self, room_number):
+        # Removes everything stored for a room besides the room itself.
+        for table in (self._waveforms, self._images, self._thumbnails,
+                      self._samples, self._sample_batches):
+            for key in [key for key in table if key[0] == room_number]:
+                del table[key]
+
+    def get_live_metrics(self, room_number):
+        with self._lock:
+            room = self._rooms.get(room_number)
+            return None if room is None else dict(room["live_metrics"])
+
+    def set_live_metrics(self, room_number, metrics):
+        with self._lock:
+            room = self._rooms.get(room_number)
+            if room is not None:
+                room["live_metrics"] = dict(metrics)
+
+    def append_samples(self, room_number, session_id, samples,
+                       sequence=None):
+        with self._lock:
+            if sequence is not None:
+                batches = self._sample_batches.setdefault(
+                    (room_number, session_id), set())
+                if sequence in batches:
+                    return False
+                batches.add(sequence)
+            self._samples.setdefault((room_number, session_id),
+                                     []).extend(samples)
+            return True
+
+    def put_waveform(self, room_number, timestamp, waveform):
+        with self._lock:
+            self._waveforms[(room_number, timestamp)] = waveform
+
+    def get_waveform(self, room_number, timestamp, t0=None, t1=None,
+                     points=None):
+        with self._lock:
+            return self._waveforms.get((room_number, timestamp))
+
+    def put_image(self, room_number, timestamp, content_type, data):
+        with self._lock:
+            self._images[(room_number, timestamp)] = (content_type,
+                                                      bytes(data))
+            for key in [key for key in self._thumbnails
+                        if key[:2] == (room_number, timestamp)]:
+                del self._thumbnails[key]
+
+    def get_image(self, room_number, timestamp):
+        with self._lock:
+            return self._images.get((room_number, timestamp))
+
+    def put_thumbnail(self, room_number, timestamp, size, data):
+        with self._lock:
+            self._thumbnails[(room_number, timestamp, size)] = bytes(data)
+
+    def get_thumbnail(self, room_number, timestamp, size):
+        with self._lock:
+            return self._thumbnails.get((room_number, timestamp, size))
+
+    def trend_totals(self, rooms, start, end, bucket_seconds):
+        buckets = {}
+        with self._lock:
+            for number, room in self._rooms.items():
+                if rooms is not None and number not in rooms:
+                    continue
+                for calculation in room["cpap_calculations"]:
+                    time = recorded_at(calculation)
+                    if time is None or not start <= time < end:
+                        continue
+                    bucket = int((time - start).total_seconds()
+                                 // bucket_seconds)
+                    buckets.setdefault((number, bucket),
+                                       []).append(calculation)
+        return [bucket_totals(number, bucket, calculations)
+                for (number, bucket), calculations in buckets.items()]
+
+
+class SqliteRoomStore(RoomStore):
+    """Room storage in a SQLite database file.
+
+    Lets a small site run the server without a MongoDB deployment. All
+    requests share one connection, serialized by a lock, and file databases
+    use write-ahead logging so readers in other processes are not blocked.
+
+    Parameters
+    ----------
+    path : str
+        database file, or ":memory:" for a private in-memory database
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rooms (
+            room_number INTEGER PRIMARY KEY,
+            patient_name TEXT,
+            patient_mrn INTEGER UNIQUE,
+            cpap_pressure INTEGER,
+            latest_calculation TEXT,
+            live_metrics TEXT);
+        CREATE TABLE IF NOT EXISTS calculations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_number INTEGER NOT NULL,
+            timestamp TEXT,
+            recorded_at TEXT,
+            breath_rate_bpm REAL,
+            apnea_count INTEGER,
+            image TEXT);
+        CREATE INDEX IF NOT EXISTS calculations_room_time
+            ON calculations (room_number, recorded_at);
+        CREATE INDEX IF NOT EXISTS calculations_room_timestamp
+            ON calculations (room_number, timestamp);
+        CREATE TABLE IF NOT EXISTS waveforms (
+            room_number INTEGER,
+            timestamp TEXT,
+            waveform TEXT,
+            PRIMARY KEY (room_number, timestamp));
+        CREATE TABLE IF NOT EXISTS images (
+            room_number INTEGER,
+            timestamp TEXT,
+            content_type TEXT,
+            data BLOB,
+            PRIMARY KEY (room_number, timestamp));
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            room_number INTEGER,
+            timestamp TEXT,
+            size INTEGER,
+            data BLOB,
+            PRIMARY KEY (room_number, timestamp, size));
+        CREATE TABLE IF NOT EXISTS samples (
+            room_number INTEGER,
+            session_id TEXT,
+            time REAL,
+            readings TEXT);
+        CREATE INDEX IF NOT EXISTS samples_room
+            ON samples (room_number, session_id, time);
+        CREATE TABLE IF NOT EXISTS sample_batches (
+            room_number INTEGER,
+            session_id TEXT,
+            sequence INTEGER,
+            PRIMARY KEY (room_number, session_id, sequence));
+        """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            if path != ":memory:":
+                self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(self.SCHEMA)
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def list_rooms(self):
+        rows = self._query("SELECT room_number FROM rooms "
+                           "ORDER BY room_number")
+        return [row[0] for row in rows]
+
+    def get_room(self, room_number):
+        with self._lock:
+            room = self._db.execute(
+                "SELECT patient_name, patient_mrn, cpap_pressure FROM rooms "
+                "WHERE room_number = ?", (room_number,)).fetchone()
+            if room is None:
+                return None
+            calculations = self._db.execute(
+                "SELECT timestamp, breath_rate_bpm, apnea_count, image "
+                "FROM calculations WHERE room_number = ? ORDER BY id",
+                (room_number,)).fetchall()
+        return {"room_number": room_number,
+                "patient_name": room[0],
+                "patient_mrn": room[1],
+                "cpap_pressure": room[2],
+                "cpap_calculations": [list(row) for row in calculations]}
+
+    def get_pressure(self, room_number):
+        rows = self._query("SELECT cpap_pressure FROM rooms "
+                           "WHERE room_number = ?", (room_number,))
+        return rows[0][0] if rows else None
+
+    def get_pressures(self, room_numbers=None):
+        if room_numbers is None:
+            rows = self._query("SELECT room_number, cpap_pressure FROM rooms")
+        else:
+            room_numbers = list(room_numbers)
+            rows = self._query(
+                "SELECT room_number, cpap_pressure FROM rooms WHERE "
+                "room_number IN ({})".format(
+                    ", ".join("?" * len(room_numbers))), room_numbers)
+        return dict(rows)
+
+    def room_summaries(self):
+        rows = self._query(
+            "SELECT room_number, patient_name, patient_mrn, cpap_pressure, "
+            "latest_calculation FROM rooms ORDER BY room_number")
+        return [room_summary(row[0], {
+                    "patient_name": row[1],
+                    "patient_mrn": row[2],
+                    "cpap_pressure": row[3],
+                    "latest_calculation": json.loads(row[4] or "null")})
+                for row in rows]
+
+    def save_upload(self, room_number, patient_mrn, patient_name,
+                    cpap_pressure, cpap_calculation):
+        with self._lock, self._db:
+            return self._save_upload(room_number, patient_mrn, patient_name,
+                                     cpap_pressure, cpap_calculation)
+
+    def save_uploads(self, uploads):
+        # A single transaction commits the whole batch at once. Calculations
+        # the room already holds are skipped, so a batch sent again, as the
+        # write-behind journal does after a crash, does not repeat them.
+        with self._lock, self._db:
+            return [self._save_upload(*upload, unique=True)
+                    for upload in uploads]
+
+    def _save_upload(self, room_number, patient_mrn, patient_name,
+                     cpap_pressure, cpap_calculation, unique=False):
+        timestamp, breath_rate, apnea_count, image = cpap_calculation
+        time = recorded_at(cpap_calculation)
+        summary = json.dumps(calculation_summary(list(cpap_calculation)))
+        row = self._db.execute(
+            "SELECT room_number FROM rooms WHERE patient_mrn = ?",
+            (patient_mrn,)).fetchone()
+        created = row is None
+        if created:
+            self._delete_room(room_number)
+            self._db.execute(
+                "INSERT INTO rooms (room_number, patient_name, patient_mrn, "
+                "cpap_pressure, latest_calculation, live_metrics) "
+                "VALUES (?, ?, ?, ?, ?, '{}')",
+                (room_number, patient_name, patient_mrn, cpap_pressure,
+                 summary))
+        else:
+            room_number = row[0]
+            self._db.execute(
+                "UPDATE rooms SET patient_name = ?, cpap_pressure = ?, "
+                "latest_calculation = ? WHERE room_number = ?",
+                (patient_name, cpap_pressure, summary, room_number))
+            if unique and self._db.execute(
+                    "SELECT 1 FROM calculations WHERE room_number = ? "
+                    "AND timestamp IS ?", (room_number, timestamp)).fetchone():
+                return room_number, created
+        self._db.execute(
+            "INSERT INTO calculations (room_number, timestamp, recorded_at, "
+            "breath_rate_bpm, apnea_count, image) VALUES (?, ?, ?, ?, ?, ?)",
+            (room_number, timestamp,
+             None if time is None else time.isoformat(" "),
+             breath_rate, apnea_count, image))
+        return room_number, created
+
+    def update_pressure(self, room_number, cpap_pressure):
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "UPDATE rooms SET cpap_pressure = ? WHERE room_number = ?",
+                (cpap_pressure, room_number))
+            return cursor.rowcount > 0
+
+    def update_pressures(self, pressures):
+        with self._lock, self._db:
+            return [room_number for room_number, cpap_pressure in
+                    pressures.items() if self._db.execute(
+                        "UPDATE rooms SET cpap_pressure = ? "
+                        "WHERE room_number = ?",
+                        (cpap_pressure, room_number)).rowcount > 0]
+
+    def _delete_room(self, room_number):
+        for table in ("rooms", "calculations", "waveforms", "images",
+                      "thumbnails", "samples", "sample_batches"):
+            self._db.execute(
+                "DELETE FROM {} WHERE room_number = ?".format(table),
+                (room_number,))
+
+    def delete_patient(self, patient_mrn):
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT room_number FROM rooms WHERE patient_mrn = ?",
+                (patient_mrn,)).fetchone()
+            if row is None:
+                return None
+            self._delete_room(row[0])
+            return row[0]
+
+    def get_live_metrics(self, room_number):
+        rows = self._query("SELECT live_metrics FROM rooms "
+                           "WHERE room_number = ?", (room_number,))
+        return json.loads(rows[0][0] or "{}") if rows else None
+
+    def set_live_metrics(self, room_number, metrics):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE rooms SET live_metrics = ? WHERE room_number = ?",
+                (json.dumps(metrics), room_number))
+
+    def append_samples(self, room_number, session_id, samples,
+                       sequence=None):
+        with self._lock, self._db:
+            if sequence is not None and self._db.execute(
+                    "INSERT OR IGNORE INTO sample_batches (room_number, "
+                    "session_id, sequence) VALUES (?, ?, ?)",
+                    (room_number, session_id, sequence)).rowcount == 0:
+                return False
+            self._db.executemany(
+                "INSERT INTO samples (room_number, session_id, time, "
+                "readings) VALUES (?, ?, ?, ?)",
+                [(room_number, session_id, sample[0],
+                  json.dumps(sample[1:])) for sample in samples])
+            return True
+
+    def put_waveform(self, room_number, timestamp, waveform):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO waveforms (room_number, timestamp, "
+                "waveform) VALUES (?, ?, ?)",
+                (room_number, timestamp, json.dumps(waveform)))
+
+    def get_waveform(self, room_number, timestamp, t0=None, t1=None,
+                     points=None):
+        rows = self._query("SELECT waveform FROM waveforms "
+                           "WHERE room_number = ? AND timestamp = ?",
+                           (room_number, timestamp))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put_image(self, room_number, timestamp, content_type, data):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO images (room_number, timestamp, "
+                "content_type, data) VALUES (?, ?, ?, ?)",
+                (room_number, timestamp, content_type, bytes(data)))
+            self._db.execute(
+                "DELETE FROM thumbnails WHERE room_number = ? AND "
+                "timestamp = ?", (room_number, timestamp))
+
+    def get_image(self, room_number, timestamp):
+        rows = self._query("SELECT content_type, data FROM images "
+                           "WHERE room_number = ? AND timestamp = ?",
+                           (room_number, timestamp))
+        return (rows[0][0], bytes(rows[0][1])) if rows else None
+
+    def put_thumbnail(self, room_number, timestamp, size, data):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO thumbnails (room_number, timestamp, "
+                "size, data) VALUES (?, ?, ?, ?)",
+                (room_number, timestamp, size, bytes(data)))
+
+    def get_thumbnail(self, room_number, timestamp, size):
+        rows = self._query("SELECT data FROM thumbnails WHERE room_number = ? "
+                           "AND timestamp = ? AND size = ?",
+                           (room_number, timestamp, size))
+        return bytes(rows[0][0]) if rows else None
+
+    def trend_totals(self, rooms, start, end, bucket_seconds):
+        sql = ("SELECT room_number, CAST(ROUND((julianday(recorded_at) "
+               "- julianday(?)) * 86400) AS INTEGER) / ? AS bucket, "
+               "COUNT(*), TOTAL(breath_rate_bpm), COUNT(breath_rate_bpm), "
+               "MAX(breath_rate_bpm), COALESCE(SUM(apnea_count), 0), "
+               "COUNT(apnea_count), MAX(apnea_count) FROM calculations "
+               "WHERE recorded_at >= ? AND recorded_at < ?")
+        parameters = [start.isoformat(" "), int(bucket_seconds),
+                      start.isoformat(" "), end.isoformat(" ")]
+        if rooms is not None:
+            sql += " AND room_number IN ({})".format(
+                ", ".join("?" * len(rooms)))
+            parameters += rooms
+        sql += " GROUP BY room_number, bucket"
+        return [{"_id": {"room": row[0], "bucket": row[1]},
+                 "count": row[2],
+                 "breath_rate_sum": row[3],
+                 "breath_rate_count": row[4],
+                 "breath_rate_max": row[5],
+                 "apnea_count_sum": row[6],
+                 "apnea_count_count": row[7],
+                 "apnea_count_max": row[8]}
+                for row in self._query(sql, parameters)]
+
+
+def make_store(spec):
+    """Creates the room storage named by a `CPAP_STORAGE` setting.
+
+    Parameters
+    ----------
+    spec : str
+        "mongo", "memory", or "sqlite:" followed by the path of the database
+        file
+
+    Returns
+    -------
+    RoomStore
+        storage backend
+    """
+    if spec == "mongo":
+        return MongoRoomStore()
+    if spec == "memory":
+        return MemoryRoomStore()
+    if spec.startswith("sqlite:"):
+        return SqliteRoomStore(spec[len("sqlite:"):])
+    raise ValueError("Unknown storage backend {!r}.".format(spec))
@@ -0,0 +1,98 @@
+import io
+import math
+import numpy as np
+import pytest
+
+
+def cpap_samples(seconds=120, period=4.0, gap=None):
+    samples = []
+    for i in range(int(seconds * 100)):
+        t = i / 100
+        s = math.sin(2 * math.pi * t / period)
+        if gap is not None and gap[0] <= t < gap[1]:
+            s = 0.0
+        ins = 2000 + int(300 * max(0, s))
+        exp = 2000 + int(300 * max(0, -s))
+        samples.append([t, 2000, ins, exp, 2000, ins, exp])
+    return samples
+
+
+@pytest.mark.parametrize("sample, expected", [
+    ([1.5, 1, 2, 3, 4, 5, 6], [1.5, 1, 2, 3, 4, 5, 6]),
+    ([1, 1, 2, 3, 4, 5, 6.0], [1.0, 1, 2, 3, 4, 5, 6]),
+    ([1.5, 1, 2, 3, 4, 5], None),
+    ([1.5, 1, 2, 3, 4, 5, 6.5], None),
+    ([1.5, 1, 2, 3, 4, 5, "6"], None),
+    (["a", 1, 2, 3, 4, 5, 6], None),
+    ("1.5,1,2,3,4,5,6", None),
+])
+def test_parse_sample(sample, expected):
+    from CPAP_measurement import parse_sample
+    assert parse_sample(sample) == expected
+
+
+@pytest.mark.parametrize("gap, batch_size", [
+    (None, 500),
+    ((30, 50), 537),
+    ((30, 50), 6000),
+])
+def test_update_stream_metrics_matches_batch(tmp_path, gap, batch_size):
+    from CPAP_measurement import (new_stream_state, update_stream_metrics,
+                                  process_cpap_data, STREAM_WINDOW)
+    samples = cpap_samples(gap=gap)
+    text = "".join(",".join(str(x) for x in s) + "\n" for s in samples)
+    _plot, expected = process_cpap_data(io.StringIO(text),
+                                        str(tmp_path / "plot.png"))
+    state = new_stream_state()
+    for i in range(0, len(samples), batch_size):
+        assert update_stream_metrics(state, samples[i:i + batch_size]) == 0
+        assert len(state["window_flow"]) <= STREAM_WINDOW
+    assert state["samples"] == len(samples)
+    assert state["breath_rate_bpm"] == expected["breath_rate_bpm"]
+    assert state["apnea_count"] == expected["apnea_count"]
+
+
+def test_update_stream_metrics_skips_bad_samples():
+    from CPAP_measurement import new_stream_state, update_stream_metrics
+    state = new_stream_state()
+    samples = cpap_samples(seconds=1)
+    assert update_stream_metrics(state, ["bad", [1, 2]] + samples) == 2
+    assert state["samples"] == len(samples)
+    assert state["start_time"] == 0.0
+
+
+def test_pack_ints_round_trip():
+    from CPAP_measurement import pack_ints, unpack_ints
+    values = np.array([0, 5, -3, 32767, -32767, 0, 12])
+    assert list(unpack_ints(pack_ints(values))) == list(values)
+
+
+def test_encode_and_query_waveform():
+    from CPAP_measurement import encode_waveform, query_waveform
+    time = np.linspace(0, 100, 10001)
+    flow = np.sin(2 * np.pi * time / 4)
+    flow[5000] = 3.0
+    waveform = encode_waveform(time, flow, max_buckets=1024)
+    whole = query_waveform(waveform, points=100)
+    assert len(whole["min"]) == len(whole["max"])
+    assert 50 < len(whole["min"]) <= 100
+    assert whole["t0"] == pytest.approx(0)
+    assert whole["t1"] == pytest.approx(100)
+    assert max(whole["max"]) == pytest.approx(3.0, abs=1e-3)
+    assert min(whole["min"]) == pytest.approx(-1.0, abs=1e-3)
+    part = query_waveform(waveform, 10, 20, 1000)
+    assert len(part["min"]) <= 1000
+    assert part["t0"] <= 10 < 20 <= part["t1"] + 0.1
+    assert max(part["max"]) == pytest.approx(1.0, abs=1e-2)
+
+
+def test_query_waveform_uses_finest_level():
+    from CPAP_measurement import encode_waveform, query_waveform
+    time = np.linspace(0, 1000, 100001)
+    waveform = encode_waveform(time, np.sin(time), max_buckets=2 ** 14)
+    assert waveform["buckets"] == 2 ** 14
+    assert len(waveform["levels"]) == 15
+    zoomed = query_waveform(waveform, 500, 510, 800)
+    width = (zoomed["t1"] - zoomed["t0"]) / len(zoomed["min"])
+    assert width == pytest.approx(1000 / 2 ** 14)
+    assert max(zoomed["max"]) == pytest.approx(1.0, abs=1e-3)
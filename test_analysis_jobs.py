@@ -0,0 +1,51 @@
+import math
+import time
+import pytest
+
+
+def write_cpap_file(path, seconds=60, period=4.0):
+    with open(path, "w") as out_file:
+        for i in range(int(seconds * 100)):
+            t = i / 100
+            s = math.sin(2 * math.pi * t / period)
+            ins = 2000 + int(300 * max(0, s))
+            exp = 2000 + int(300 * max(0, -s))
+            out_file.write("{:.2f},2000,{},{},2000,{},{}\n".format(
+                t, ins, exp, ins, exp))
+
+
+def test_run_analysis(tmp_path):
+    from analysis_jobs import run_analysis
+    data_path = str(tmp_path / "data.txt")
+    write_cpap_file(data_path)
+    progress = {}
+    result = run_analysis(data_path, str(tmp_path), "job", progress)
+    assert result["breath_rate_bpm"] == pytest.approx(15.0, abs=0.5)
+    assert result["apnea_count"] == 0
+    assert result["image"][0:8] == "iVBORw0K"
+    assert progress["job"] == 1.0
+
+
+def test_analysis_jobs(tmp_path):
+    from analysis_jobs import AnalysisJobs
+    jobs = AnalysisJobs(max_workers=1, max_pending=1)
+    work_dir = tmp_path / "job"
+    work_dir.mkdir()
+    write_cpap_file(str(work_dir / "data.txt"))
+    stored = []
+    job_id = jobs.submit(str(work_dir / "data.txt"), str(work_dir), 3,
+                         stored.append)
+    assert jobs.submit(str(work_dir / "data.txt"), str(work_dir), 3,
+                       stored.append) is None
+    for _ in range(600):
+        job = jobs.status(job_id)
+        if job["status"] in ("done", "failed"):
+            break
+        time.sleep(0.1)
+    assert job["status"] == "done"
+    assert job["progress"] == 1.0
+    assert job["room_number"] == 3
+    assert stored == [job["result"]]
+    assert not work_dir.exists()
+    assert jobs.pending() == 0
+    assert jobs.status("unknown") is None
@@ -0,0 +1,60 @@
+import pytest
+
+
+def test_publish_and_wait():
+    from events import EventChannel
+    channel = EventChannel()
+    assert channel.wait(0, 0.01) == []
+    seq = channel.publish("pressure", {"room_number": 1, "cpap_pressure": 9})
+    assert seq == 1
+    assert channel.latest_seq() == 1
+    assert channel.wait(0, 0.01) == [
+        (1, "pressure", {"room_number": 1, "cpap_pressure": 9})]
+    assert channel.wait(1, 0.01) == []
+
+
+def test_resume_point():
+    from events import EventChannel
+    channel = EventChannel(maxlen=2)
+    for i in range(4):
+        channel.publish("pressure", {"cpap_pressure": i})
+    assert channel.resume_point(channel.format_id(3)) == 3
+    assert channel.resume_point(channel.format_id(2)) == 2
+    assert channel.resume_point(channel.format_id(1)) is None
+    assert channel.resume_point(channel.format_id(5)) is None
+    assert channel.resume_point("abc-3") is None
+    assert channel.resume_point(channel.boot_token + "-x") is None
+    assert channel.resume_point(None) is None
+
+
+def test_format_sse():
+    from events import format_sse
+    expected = 'id: a-1\nevent: pressure\ndata: {"cpap_pressure": 5}\n\n'
+    assert format_sse("a-1", "pressure", {"cpap_pressure": 5}) == expected
+
+
+def test_parse_sse_lines():
+    from events import parse_sse_lines, format_sse
+    lines = [": heartbeat", "", "id: a-1", "event: pressure",
+             'data: {"cpap_pressure": 12}', "", "data: x", "data: y", ""]
+    messages = list(parse_sse_lines(lines))
+    assert messages == [
+        {"id": "a-1", "event": "pressure", "data": '{"cpap_pressure": 12}'},
+        {"id": None, "event": "message", "data": "x\ny"}]
+    message = format_sse("a-2", "upload", {"room_number": 3})
+    assert list(parse_sse_lines(message.split("\n"))) == [
+        {"id": "a-2", "event": "upload", "data": '{"room_number": 3}'}]
+
+
+def test_stream_events():
+    from events import EventChannel, stream_events
+    channel = EventChannel()
+    channel.publish("pressure", {"room_number": 1})
+    channel.publish("pressure", {"room_number": 2})
+    stream = stream_events(channel, 0,
+                           lambda event, data: data["room_number"] == 2,
+                           [(0, "pressure", {"room_number": 2})],
+                           heartbeat=0.01)
+    assert next(stream).startswith("id: {}-0\n".format(channel.boot_token))
+    assert next(stream).startswith("id: {}-2\n".format(channel.boot_token))
+    assert next(stream) == ": heartbeat\n\n"
@@ -0,0 +1,57 @@
+import threading
+import pytest
+import requests
+from unittest.mock import MagicMock, patch
+
+
+def test_recorder():
+    from load_test import Recorder
+    recorder = Recorder()
+    responses = [MagicMock(status_code=200), MagicMock(status_code=304),
+                 MagicMock(status_code=500),
+                 requests.exceptions.ConnectionError()]
+    with patch('load_test.requests.request', side_effect=responses):
+        assert recorder.request("fetch_pressure", "GET", "url") is \
+            responses[0]
+        assert recorder.request("fetch_pressure", "GET", "url") is \
+            responses[1]
+        assert recorder.request("fetch_pressure", "GET", "url") is None
+        assert recorder.request("upload_patient", "POST", "url") is None
+    summary = recorder.summary(2.0)
+    assert summary["fetch_pressure"]["requests"] == 3
+    assert summary["fetch_pressure"]["requests_per_second"] == 1.5
+    assert summary["fetch_pressure"]["error_rate"] == pytest.approx(1 / 3,
+                                                                    abs=1e-4)
+    assert summary["upload_patient"] == {
+        "requests": 1, "requests_per_second": 0.5, "p50_ms": 0,
+        "p99_ms": 0, "error_rate": 1.0}
+    assert summary["list_rooms"]["requests"] == 0
+    assert summary["list_rooms"]["error_rate"] == 0.0
+
+
+def test_run_ward():
+    from werkzeug.serving import make_server
+    from load_test import run_ward, PLOT_FILE
+    from storage import MemoryRoomStore
+    import server
+    store = MemoryRoomStore()
+    with open(PLOT_FILE, "rb") as plot_file:
+        plot = plot_file.read()
+    with patch('server.store', store):
+        httpd = make_server("127.0.0.1", 0, server.app, threaded=True)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            summary = run_ward(
+                "http://127.0.0.1:{}".format(httpd.server_port), 2, 1, 1.0,
+                {"pressure": 0.2, "upload": 0.5, "lab": 0.2}, plot,
+                {"Accept": "application/json"})
+        finally:
+            httpd.shutdown()
+            thread.join()
+    for operation, result in summary.items():
+        assert result["requests"] > 0, operation
+        assert result["error_rate"] == 0.0, operation
+    assert store.get_room(1)["patient_mrn"] == 900001
+    assert store.get_room(2)["patient_mrn"] == 900002
+    assert store.get_pressure(2) is not None
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+
+
+def test_histogram_render():
+    from metrics import Histogram
+    histogram = Histogram("test_seconds", "Test.", ("route",), (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(("/a\"b",), value)
+    assert histogram.render() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a\\"b",le="0.1"} 2',
+        'test_seconds_bucket{route="/a\\"b",le="1.0"} 3',
+        'test_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{route="/a\\"b"} 3.65',
+        'test_seconds_count{route="/a\\"b"} 4']
+
+
+def test_request_db_tally():
+    from metrics import RequestMetrics
+    metrics = RequestMetrics()
+    command = SimpleNamespace(command_name="find", duration_micros=2000)
+    metrics.succeeded(command)
+    metrics.start_request()
+    metrics.succeeded(command)
+    metrics.failed(command)
+    metrics.finish_request("/r/<n>", "GET", 200, 0.01, 0, 100)
+    text = metrics.render([("up", "gauge", "Up.", 1)])
+    assert 'cpap_http_request_db_commands_count{route="/r/<n>",' \
+        'method="GET"} 1' in text
+    assert 'cpap_http_request_db_commands_sum{route="/r/<n>",' \
+        'method="GET"} 2' in text
+    assert 'cpap_db_command_duration_seconds_count{command="find",' \
+        'outcome="success"} 2' in text
+    assert text.endswith("# TYPE up gauge\nup 1\n")
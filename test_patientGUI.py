@@ -1,6 +1,9 @@
+import math
+import queue
+import threading
 import pytest
 from datetime import datetime, timedelta
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from DB_init import SleepLabRooms as db
 from patientGUI import safe_int_conversion
 
@@ -33,3 +36,60 @@ def test_apnea_count_color(capsys, count, expected_output):
     apnea_count_color(count)
     captured = capsys.readouterr()
     assert captured.out == expected_output
+
+
+def write_cpap_file(path, seconds=60, period=4.0):
+    with open(path, "w") as out_file:
+        for i in range(int(seconds * 100)):
+            t = i / 100
+            s = math.sin(2 * math.pi * t / period)
+            ins = 2000 + int(300 * max(0, s))
+            exp = 2000 + int(300 * max(0, -s))
+            out_file.write("{:.2f},2000,{},{},2000,{},{}\n".format(
+                t, ins, exp, ins, exp))
+
+
+def drain(updates):
+    messages = []
+    while not updates.empty():
+        messages.append(updates.get_nowait())
+    return messages
+
+
+def test_analyze_file(tmp_path, monkeypatch):
+    from patientGUI import analyze_file
+    monkeypatch.chdir(tmp_path)
+    write_cpap_file("data.txt")
+    updates = queue.Queue()
+    data_file = open("data.txt")
+    analyze_file(data_file, updates, threading.Event())
+    messages = drain(updates)
+    progress = [value for kind, value in messages[:-1]]
+    assert [kind for kind, value in messages[:-1]] == ["progress"] * 6
+    assert progress == sorted(progress) and 0 < progress[-1] < 1
+    kind, (plot_filename, results) = messages[-1]
+    assert kind == "done"
+    assert (tmp_path / plot_filename).exists()
+    assert results["breath_rate_bpm"] == pytest.approx(15.0, abs=0.5)
+    assert data_file.closed
+
+
+def test_analyze_file_cancelled(tmp_path):
+    from patientGUI import analyze_file
+    write_cpap_file(str(tmp_path / "data.txt"))
+    updates = queue.Queue()
+    cancel_event = threading.Event()
+    cancel_event.set()
+    analyze_file(open(str(tmp_path / "data.txt")), updates, cancel_event)
+    assert drain(updates) == [("cancelled", None)]
+
+
+def test_analyze_file_failed(tmp_path):
+    from patientGUI import analyze_file
+    (tmp_path / "data.txt").write_text("1,2,3\n")
+    updates = queue.Queue()
+    with patch("patientGUI.process_cpap_data",
+               side_effect=ValueError("no breaths")):
+        analyze_file(open(str(tmp_path / "data.txt")), updates,
+                     threading.Event())
+    assert drain(updates) == [("failed", "no breaths")]
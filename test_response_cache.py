@@ -0,0 +1,28 @@
+def test_get_and_put():
+    from response_cache import ResponseCache
+    cache = ResponseCache(100)
+    assert cache.get(1, "a-1-0") is None
+    cache.put(1, "a-1-0", b"room 1")
+    assert cache.get(1, "a-1-0") == b"room 1"
+    assert cache.get(1, "a-1-1") is None
+    cache.invalidate(1)
+    assert cache.get(1, "a-1-0") is None
+    assert cache.stats() == {"hits": 1, "misses": 3, "evictions": 0,
+                             "hit_rate": 0.25, "entries": 0, "bytes": 0}
+
+
+def test_eviction():
+    from response_cache import ResponseCache
+    cache = ResponseCache(10)
+    cache.put(1, "t1", b"1234")
+    cache.put(2, "t2", b"1234")
+    assert cache.get(1, "t1") == b"1234"
+    cache.put(3, "t3", b"1234")
+    assert cache.get(2, "t2") is None
+    assert cache.get(1, "t1") == b"1234"
+    cache.put(4, "t4", b"12345678901")
+    assert cache.get(4, "t4") is None
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 2
+    assert stats["bytes"] == 8
@@ -0,0 +1,87 @@
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+from pymongo.errors import BulkWriteError
+
+
+def calculation(timestamp, breath_rate=17.0, apnea_count=2):
+    recorded_at = datetime.fromisoformat(timestamp)
+    return {"timestamp": timestamp, "recorded_at": recorded_at,
+            "breath_rate_bpm": breath_rate, "apnea_count": apnea_count,
+            "image": "image.png"}
+
+
+def test_summary_update():
+    from retention import summary_update
+    update = summary_update(3, calculation("2023-11-29 22:15:00", None, 4))
+    assert update._filter == {"room_number": 3,
+                              "day": datetime(2023, 11, 29),
+                              "timestamps": {"$ne": "2023-11-29 22:15:00"}}
+    assert update._doc["$inc"] == {"count": 1, "breath_rate_sum": 0.0,
+                                   "breath_rate_count": 0,
+                                   "apnea_count_sum": 4,
+                                   "apnea_count_count": 1}
+    assert update._doc["$max"] == {"apnea_count_max": 4}
+    assert update._upsert
+
+
+@pytest.mark.parametrize("code, raises", [(11000, False), (121, True)])
+def test_compact_room(code, raises):
+    from retention import compact_room
+    history = [calculation("2023-11-29 22:00:00"),
+               ["2023-11-30 22:00:00", 16, 1, "old.png"],
+               calculation("2023-12-01 22:00:00"),
+               calculation("2023-12-02 22:00:00")]
+    error = BulkWriteError({"writeErrors": [{"code": code}]})
+    with patch('retention.SleepLabRooms') as rooms, \
+            patch('retention.ArchivedCalculations') as archive, \
+            patch('retention.DailySummaries') as summaries, \
+            patch('retention.get_collection',
+                  lambda model: model._mongometa.collection):
+        summaries._mongometa.collection.bulk_write.side_effect = error
+        if raises:
+            with pytest.raises(BulkWriteError):
+                compact_room({"_id": 3, "cpap_calculations": history}, 2)
+            return
+        assert compact_room({"_id": 3, "cpap_calculations": history}, 2) == 1
+        archived = archive._mongometa.collection.bulk_write.call_args[0][0]
+        pull = rooms._mongometa.collection.update_one.call_args[0]
+    assert [op._doc["timestamp"] for op in archived] == ["2023-11-29 22:00:00"]
+    assert pull == ({"_id": 3},
+                    {"$pull": {"cpap_calculations": {"$in": history[:1]}}})
+
+
+@pytest.mark.parametrize("leased", [True, False])
+def test_compaction_task_runs_until_stopped(leased):
+    from retention import CompactionTask, COMPACTION_LEASE
+    with patch('retention.compact_history') as compact, \
+            patch('retention.acquire_lease', return_value=leased) as lease, \
+            patch('retention.release_lease') as release:
+        task = CompactionTask(retain=5, interval=0.01)
+        task.start(print)
+        task.start(print)
+        task.stop()
+    lease.assert_called_with(COMPACTION_LEASE, task.holder, 0.02)
+    release.assert_called_once_with(COMPACTION_LEASE, task.holder)
+    if leased:
+        assert compact.call_count >= 1
+        compact.assert_called_with(5, print)
+    else:
+        compact.assert_not_called()
+
+
+@pytest.mark.mongo
+def test_acquire_lease():
+    from retention import acquire_lease, release_lease
+    from DB_init import get_collection, TaskLeases
+    get_collection(TaskLeases).delete_many({})
+    assert acquire_lease("task", "a", 60) is True
+    assert acquire_lease("task", "b", 60) is False
+    assert acquire_lease("task", "a", 0) is True
+    # The lease of "a" has expired.
+    assert acquire_lease("task", "b", 60) is True
+    release_lease("task", "a")
+    assert acquire_lease("task", "a", 60) is False
+    release_lease("task", "b")
+    assert acquire_lease("task", "a", 60) is True
+    get_collection(TaskLeases).delete_many({})
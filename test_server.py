@@ -1,3 +1,4 @@
+import io
 import pytest
 from datetime import datetime, timedelta
 from DB_init import SleepLabRooms as db
@@ -8,35 +9,31 @@ t1 = datetime(2023, 11, 30, 20, 0, 0)
 
 
 @pytest.fixture
-def mock_db():
-    with patch('server.db') as mock:
+def mock_store():
+    with patch('server.store') as mock:
         yield mock
 
 
 @pytest.fixture
-def mock_validate_room_number():
-    with patch('server.validate_room_number') as mock:
-        yield mock
-
-
-@pytest.mark.parametrize("room_number, valid_room, patient_data, expected", [
-    (101, True, {"cpap_pressure": 20}, (20, 200)),  # Valid room with data
-    (102, False, None, (False, 400)),  # Invalid room
+def room_store():
+    from storage import MemoryRoomStore
+    store = MemoryRoomStore()
+    store.save_upload(1, 100, "John Doe", 15,
+                      ["2023-11-29T10:00:00", 18, 2, None])
+    store.save_upload(2, 101, "Jane Smith", 10, [None, None, None, None])
+    with patch('server.store', store):
+        yield store
+
+
+@pytest.mark.parametrize("room_number, pressure, expected", [
+    (101, 20, (20, 200)),  # Valid room with data
+    (102, None, ("Patient not associated with room number entry.",
+                 400)),  # Invalid room
 ])
-def test_fetch_pressure_driver(
-    mock_db, mock_validate_room_number, room_number,
-    valid_room, patient_data, expected
-):
+def test_fetch_pressure_driver(mock_store, room_number, pressure, expected):
     from server import fetch_pressure_driver
-    # Setup the mocks
-    mock_validate_room_number.return_value = valid_room
-    if valid_room:
-        mock_patient = MagicMock()
-        mock_patient.cpap_pressure = patient_data['cpap_pressure']
-        mock_db.objects.raw({"_id": room_number}
-                            ).first.return_value = mock_patient
-    else:
-        mock_db.objects.raw({"_id": room_number}).first.return_value = None
+    # Setup the mock
+    mock_store.get_pressure.return_value = pressure
 
     # Call the function
     result = fetch_pressure_driver(room_number)
@@ -53,23 +50,64 @@ def test_fetch_pressure_driver(
                 "patient_mrn": "1234",
                 "patient_name": "John Doe",
                 "cpap_pressure": "20",
-                "cpap_calculations": "calc1",
+                "cpap_calculations": ["2023-11-30 20:00:00", 15.5, 1,
+                                      "image.png"],
                 "room_number": "101"
             },
             ("Patient Info updated successfully.", 200)
         ),
     ]
 )
-def test_upload_patient_function(mock_db, in_data, expected_response):
+def test_upload_patient_function(mock_store, in_data, expected_response):
     from server import upload_patient_function
-    # Mock existing or new patient
-    mock_db.objects.get.side_effect = [MagicMock(), db.DoesNotExist()]
+    # Mock an existing patient
+    mock_store.save_upload.return_value = (101, False)
 
     response = upload_patient_function(in_data)
 
     assert response == expected_response
 
 
+def test_upload_patient_function_waveform(room_store):
+    from server import upload_patient_function
+    from CPAP_measurement import encode_waveform
+    import numpy as np
+    time = np.linspace(0, 50, 5001)
+    waveform = encode_waveform(time, np.sin(time))
+    record = {"room_number": 3, "patient_name": "John Doe",
+              "patient_mrn": 100, "cpap_pressure": 12,
+              "cpap_calculations": ["2023-11-29T12:00:00", 17, 3, None],
+              "flow_waveform": dict(waveform, levels=waveform["levels"][1:])}
+    assert upload_patient_function(record) == (
+        "flow_waveform must be a waveform built by encode_waveform.", 400)
+    assert room_store.get_pressure(1) == 15
+    assert upload_patient_function(dict(
+        record, flow_waveform=waveform))[1] == 200
+    # The waveform follows the patient into room 1.
+    assert room_store.get_waveform(3, "2023-11-29T12:00:00") is None
+    assert room_store.get_waveform(1, "2023-11-29T12:00:00") == waveform
+
+
+def test_waveform_validation():
+    import numpy as np
+    from server import waveform_validation
+    from CPAP_measurement import encode_waveform
+    time = np.linspace(0, 50, 5001)
+    waveform = encode_waveform(time, np.sin(time))
+    assert waveform_validation(waveform) is True
+    level = waveform["levels"][0]
+    for change in [{"t0": "0"}, {"t1": -1.0}, {"scale": 0}, {"buckets": 3},
+                   {"buckets": 2 ** 19}, {"levels": None},
+                   {"levels": waveform["levels"][1:]},
+                   {"levels": [dict(level, min=level["min"][1:])] +
+                    waveform["levels"][1:]},
+                   {"levels": [dict(level, max=[1] * len(level["max"]))] +
+                    waveform["levels"][1:]}]:
+        assert waveform_validation(dict(waveform, **change)) == \
+            "flow_waveform must be a waveform built by encode_waveform."
+    assert waveform_validation([waveform]) is not True
+
+
 @pytest.mark.parametrize("input, expected", [
     (t1, "2023-11-30 20:00:00"),
     ("2023-11-30 20:00:00",
@@ -130,6 +168,7 @@ def test_input_verification(data, keys, types, expected):
     assert input_verification(data, keys, types) == expected
 
 
+@pytest.mark.mongo
 def test_list_rooms_driver():
     from server import list_rooms_driver
     assert list_rooms_driver() == ([1, 2, 3, 4], 200)
@@ -142,6 +181,7 @@ mock_update4 = {"room_number": 5, "cpap_pressure": 10}
 mock_update5 = {"room_number": 4, "cpap_pressure": 14}
 
 
+@pytest.mark.mongo
 def test_lab_update_cpap_pressure_driver():
     from server import lab_update_cpap_pressure_driver as func
     msg1 = "Pressure must be an integer between 4 and 25, inclusive."
@@ -171,6 +211,7 @@ def test_cpap_pressure_validation(input, expected):
     assert cpap_pressure_validation(input) == expected
 
 
+@pytest.mark.mongo
 @pytest.mark.parametrize("input, expected", [
     (2, True),
     (3, True),
@@ -182,12 +223,14 @@ def test_validate_room_number(input, expected):
     assert validate_room_number(input) == expected
 
 
+@pytest.mark.mongo
 def test_fetch_patient_driver():
     from server import fetch_patient_driver
     patient_dict, status_code, result = fetch_patient_driver(4)
     assert (
         db.objects.raw(
-            {"patient_name": result.patient_name}).first().room_number == 4)
+            {"patient_name": result["patient_name"]}).first().room_number
+        == 4)
     assert patient_dict["room_number"] == 4
     assert status_code == 200
     result, status_code, patient = fetch_patient_driver(5)
@@ -217,18 +260,510 @@ def test_b64_string_to_file():
     assert answer
 
 
-patient_dict1 = {"room_number": 1,
-                 "patient_name": "John Doe",
-                 "patient_mrn": 100,
-                 "cpap_pressure": 15,
-                 "cpap_calculations": [
-                     ["2023-11-29T10:00:00", 18, 2, "image1.png"],
-                     ["2023-11-29T12:00:00", 17, 3, "image2.png"]]}
-
-
-def test_SleepLabRooms_to_dict():
-    from server import SleepLabRooms_to_dict as func
-    patient1 = db.objects.raw({"_id": 1}).first()
-    msg1 = "Input must be SleepLabRooms instance."
-    assert func(patient1) == (True, patient_dict1)
-    assert func(patient_dict1) == (False, msg1)
+def test_fetch_patient_cache():
+    from server import app, response_cache, mark_room_changed
+    client = app.test_client()
+    with patch('server.fetch_patient_driver',
+               return_value=({"room_number": 2}, 200, None)) as mock_driver:
+        first = client.get('/lab/fetch_patient/2')
+        second = client.get('/lab/fetch_patient/2')
+        assert mock_driver.call_count == 1
+        assert second.get_data() == first.get_data()
+        assert second.headers["ETag"] == first.headers["ETag"]
+        mark_room_changed(2)
+        client.get('/lab/fetch_patient/2')
+        assert mock_driver.call_count == 2
+    assert response_cache.stats()["hits"] >= 1
+
+
+@pytest.mark.mongo
+def test_fetch_patient_negotiation():
+    import gzip
+    from server import app
+    from wire import decode_body
+    client = app.test_client()
+    plain = client.get('/lab/fetch_patient/1')
+    assert plain.headers.get("Content-Encoding") is None
+    compressed = client.get('/lab/fetch_patient/1',
+                            headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["Vary"]
+    # Both representations share the version of the room, as a weak tag.
+    assert plain.headers["ETag"].startswith('W/"')
+    assert compressed.headers["ETag"] == plain.headers["ETag"]
+    assert client.get('/lab/fetch_patient/1', headers={
+        "Accept-Encoding": "gzip",
+        "If-None-Match": plain.headers["ETag"]}).status_code == 304
+    assert decode_body(gzip.decompress(compressed.get_data()),
+                       compressed.mimetype) == plain.get_json()
+
+
+def test_list_rooms_coalesced():
+    from server import app, mark_room_changed
+    from storage import MemoryRoomStore
+    store = MemoryRoomStore()
+    store.save_upload(7, 700, "John Doe", 10, [None, None, None, None])
+    client = app.test_client()
+    with patch('server.store', store):
+        mark_room_changed(7)
+        assert client.get('/lab/list_rooms').get_json() == [7]
+        store.save_upload(8, 800, "Jane Smith", 10, [None, None, None, None])
+        assert client.get('/lab/list_rooms').get_json() == [7]
+        mark_room_changed(8)
+        assert client.get('/lab/list_rooms').get_json() == [7, 8]
+
+
+def test_metrics_route():
+    from server import app
+    client = app.test_client()
+    client.get('/lab/cache_stats')
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    text = r.get_data(as_text=True)
+    assert 'cpap_http_request_duration_seconds_count{' \
+        'route="/lab/cache_stats",method="GET",status="200"}' in text
+    assert "cpap_response_cache_hits_total " in text
+
+
+def test_room_etag_changes_after_write():
+    from server import room_etag, mark_room_changed
+    tag1 = room_etag(1)
+    assert room_etag(1) == tag1
+    mark_room_changed(1)
+    tag2 = room_etag(1)
+    assert tag2 != tag1
+    assert room_etag(2) != tag2
+
+
+def test_room_not_modified():
+    from server import app, room_etag, mark_room_changed, room_not_modified
+    tag = room_etag(3)
+    with app.test_request_context(
+            headers={"If-None-Match": '"{}"'.format(tag)}):
+        assert room_not_modified(3) is True
+        mark_room_changed(3)
+        assert room_not_modified(3) is False
+    with app.test_request_context():
+        assert room_not_modified(3) is False
+    with app.test_request_context(
+            headers={"If-None-Match": 'W/"{}"'.format(room_etag(3))}):
+        assert room_not_modified(3) is False
+        assert room_not_modified(3, weak=True) is True
+
+
+def test_pressure_stream():
+    from server import app, room_events
+    with patch('server.fetch_pressure_driver') as mock_driver:
+        mock_driver.return_value = (12, 200)
+        response = app.test_client().get('/patient/pressure_stream/2')
+        assert response.mimetype == "text/event-stream"
+        body = response.iter_encoded()
+        first = next(body).decode()
+        assert 'event: pressure' in first
+        assert '"cpap_pressure": 12' in first
+        room_events.publish("pressure",
+                            {"room_number": 1, "cpap_pressure": 5})
+        room_events.publish("pressure",
+                            {"room_number": 2, "cpap_pressure": 7})
+        assert '"cpap_pressure": 7' in next(body).decode()
+        response.close()
+        mock_driver.return_value = ("Patient not associated with room "
+                                    "number entry.", 400)
+        response = app.test_client().get('/patient/pressure_stream/9')
+        assert response.status_code == 400
+
+
+@pytest.mark.parametrize("calculation, expected", [
+    (["2023-11-29 10:00:00", 18.0, 1, "img"], ["upload"]),
+    (["2023-11-29 10:00:00", 18.0, 2, "img"], ["upload", "apnea_alert"]),
+    ("calc1", []),
+])
+def test_publish_upload(calculation, expected):
+    from server import publish_upload, room_events
+    seq = room_events.latest_seq()
+    publish_upload(7, calculation)
+    events = room_events.wait(seq, 0.01)
+    assert [event for _seq, event, _data in events] == expected
+    for _seq, _event, data in events:
+        assert data["room_number"] == 7
+        assert "image" not in data
+
+
+def test_lab_event_stream():
+    from server import app, room_events
+    with patch('server.list_rooms_driver') as mock_driver:
+        mock_driver.return_value = ([1, 2], 200)
+        response = app.test_client().get('/lab/event_stream')
+        body = response.iter_encoded()
+        first = next(body).decode()
+        assert 'event: rooms' in first
+        assert '"rooms": [1, 2]' in first
+        room_events.publish("reset", {"room_number": 2})
+        assert 'event: reset' in next(body).decode()
+        response.close()
+
+
+def test_dashboard_driver(room_store):
+    from server import dashboard_driver
+    room_store.save_upload(1, 100, "John Doe", 15,
+                           ["2023-11-29T12:00:00", 17, 3, "image2.png"])
+    rooms, status_code = dashboard_driver()
+    assert status_code == 200
+    assert rooms == [
+        {"room_number": 1, "patient_name": "John Doe", "patient_mrn": 100,
+         "cpap_pressure": 15, "timestamp": "2023-11-29T12:00:00",
+         "breath_rate_bpm": 17, "apnea_count": 3},
+        {"room_number": 2, "patient_name": "Jane Smith", "patient_mrn": 101,
+         "cpap_pressure": 10, "timestamp": None, "breath_rate_bpm": None,
+         "apnea_count": None}]
+
+
+def test_upload_batch_driver(room_store):
+    from server import upload_batch_driver, MAX_UPLOAD_BATCH
+    from CPAP_measurement import encode_waveform
+    waveform = encode_waveform([0, 1, 2, 3], [0.1, 0.2, 0.3, 0.4])
+    record = {"room_number": 1, "patient_name": "John Doe",
+              "patient_mrn": 100, "cpap_pressure": 15,
+              "cpap_calculations": ["2023-11-29T12:00:00", 17, 3, None],
+              "flow_waveform": waveform}
+    with patch('server.room_events') as events:
+        result, status_code = upload_batch_driver([
+            record, dict(record, cpap_pressure=30), "record",
+            dict(record, cpap_pressure=16, room_number=2)])
+    assert status_code == 200
+    assert [(r["status"], r["room_number"]) for r in result["results"]] == \
+        [(200, 1), (400, None), (400, None), (200, 1)]
+    assert result["results"][1]["message"] == \
+        "Pressure must be an integer between 4 and 25, inclusive."
+    assert room_store.get_pressure(1) == 16
+    # The calculation sent twice in the batch is stored once.
+    assert len(room_store.get_room(1)["cpap_calculations"]) == 2
+    assert room_store.get_waveform(1, "2023-11-29T12:00:00") == waveform
+    assert events.publish.call_count == 3
+    assert upload_batch_driver(record) == \
+        ("Data sent must be a list of patient records.", 400)
+    assert upload_batch_driver([record] * (MAX_UPLOAD_BATCH + 1))[1] == 400
+
+
+def test_upload_patient_write_behind(room_store, tmp_path):
+    from server import (upload_patient_driver, upload_image_driver,
+                        commit_journaled_uploads)
+    from write_behind import WriteBehindQueue
+    queue = WriteBehindQueue(str(tmp_path / "uploads.journal"), 3600, 500)
+    record = {"room_number": 1, "patient_name": "John Doe",
+              "patient_mrn": 100, "cpap_pressure": 20,
+              "cpap_calculations": ["2023-11-29T12:00:00", 17, 3, None]}
+    with patch('server.write_behind', queue), \
+            patch('server.room_events'):
+        queue.start(commit_journaled_uploads)
+        assert upload_patient_driver(record) == \
+            ("Patient upload queued.", 202)
+        assert upload_patient_driver(dict(record, patient_name=5))[1] == 400
+        assert room_store.get_pressure(1) == 15
+        assert upload_image_driver(1, "2023-11-29T12:00:00", "image/png",
+                                   3, io.BytesIO(b"png"))[1] == 200
+        assert upload_image_driver(3, "2023-11-29T12:00:00", "image/png",
+                                   3, io.BytesIO(b"png"))[1] == 400
+        queue.stop()
+    assert room_store.get_pressure(1) == 20
+    assert room_store.get_room(1)["patient_mrn"] == 100
+    assert room_store.get_image(1, "2023-11-29T12:00:00") == \
+        ("image/png", b"png")
+
+
+def test_lab_update_cpap_pressures_driver(room_store):
+    from server import lab_update_cpap_pressures_driver
+    with patch('server.room_events') as events:
+        result, status_code = lab_update_cpap_pressures_driver([
+            {"room_number": 1, "cpap_pressure": 12},
+            {"room_number": 2, "cpap_pressure": 11},
+            {"room_number": 2, "cpap_pressure": 30},
+            {"room_number": 3, "cpap_pressure": 12},
+            {"room_number": "2", "cpap_pressure": 12},
+            {"room_number": 1, "cpap_pressure": 13}])
+    assert status_code == 200
+    assert [(r["status"], r["room_number"]) for r in result["results"]] == \
+        [(409, None), (200, 2), (400, None), (400, None), (400, None),
+         (200, 1)]
+    assert result["results"][0]["message"] == \
+        "Superseded by a later entry for room 1."
+    assert result["results"][3]["message"] == \
+        "Patient not associated with room number entry."
+    assert room_store.get_pressures() == {1: 13, 2: 11}
+    assert events.publish.call_count == 2
+    assert lab_update_cpap_pressures_driver({})[1] == 400
+
+
+def test_fetch_pressures(room_store):
+    from server import app
+    client = app.test_client()
+    response = client.get('/patient/fetch_pressures?rooms=2,3')
+    assert response.get_json() == {"rooms": [
+        {"room_number": 2, "cpap_pressure": 10},
+        {"room_number": 3, "cpap_pressure": None}]}
+    tag = response.headers["ETag"]
+    response = client.get('/patient/fetch_pressures?rooms=2,3',
+                          headers={"If-None-Match": tag})
+    assert response.status_code == 304
+    response = client.get('/patient/fetch_pressures')
+    assert [room["room_number"] for room in
+            response.get_json()["rooms"]] == [1, 2]
+    assert "ETag" not in response.headers
+    response = client.get('/patient/fetch_pressures?rooms=a')
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("in_data, has_file, expected", [
+    ({"room_number": "1", "patient_name": "John Doe", "patient_mrn": "100",
+      "cpap_pressure": "10"}, False,
+     ("cpap_file is not found in the input", 400)),
+    ({"room_number": "1", "patient_mrn": "100", "cpap_pressure": "10"}, True,
+     ("patient_name key is not found in the input", 400)),
+    ({"room_number": "a", "patient_name": "John Doe", "patient_mrn": "100",
+      "cpap_pressure": "10"}, True,
+     ("room_number key should be an integer.", 400)),
+    ({"room_number": "1", "patient_name": "John Doe", "patient_mrn": "100",
+      "cpap_pressure": "30"}, True,
+     ("Pressure must be an integer between 4 and 25, inclusive.", 400)),
+    ({"room_number": "1", "patient_name": "John Doe", "patient_mrn": "100",
+      "cpap_pressure": "10"}, True,
+     ("Analysis queue is full, try again later.", 503)),
+])
+def test_analyze_cpap_file_driver(in_data, has_file, expected):
+    from server import analyze_cpap_file_driver
+    cpap_file = MagicMock() if has_file else None
+    with patch('server.analysis_jobs') as mock_jobs:
+        mock_jobs.submit.return_value = None
+        assert analyze_cpap_file_driver(in_data, cpap_file) == expected
+
+
+def test_analyze_cpap_file_driver_stores_result(room_store):
+    from server import analyze_cpap_file_driver
+    in_data = {"room_number": "3", "patient_name": "John Doe",
+               "patient_mrn": "100", "cpap_pressure": "10"}
+    result = {"breath_rate_bpm": 16.5, "apnea_count": 1,
+              "flow_waveform": None, "image": "cG5n"}
+    with patch('server.analysis_jobs') as mock_jobs, \
+            patch('server.tempfile.mkdtemp', return_value="/tmp"):
+        mock_jobs.submit.return_value = "job"
+        assert analyze_cpap_file_driver(in_data, MagicMock()) == \
+            ({"job_id": "job"}, 202)
+        store_result = mock_jobs.submit.call_args[0][3]
+        store_result(result)
+        with pytest.raises(ValueError):
+            store_result(dict(result, apnea_count="1"))
+        with patch.object(room_store, 'save_uploads', return_value=[None]):
+            with pytest.raises(RuntimeError):
+                store_result(result)
+    # The known patient stays in room 1, and so does the plot.
+    assert room_store.get_room(3) is None
+    assert room_store.get_pressure(1) == 10
+    timestamp = room_store.get_room(1)["cpap_calculations"][-1][0]
+    assert room_store.get_image(1, timestamp) == ("image/png", b"png")
+
+
+@pytest.mark.parametrize("in_data, expected", [
+    ({"room_number": 1, "samples": []},
+     ("session_id key is not found in the input", 400)),
+    ({"room_number": 1, "session_id": "n1", "samples": [[0]] * 6001},
+     ("A batch may hold at most 6000 samples.", 400)),
+])
+def test_ingest_samples_driver_validation(in_data, expected):
+    from server import ingest_samples_driver
+    assert ingest_samples_driver(in_data) == expected
+
+
+def test_ingest_samples_driver_sequence(room_store):
+    from server import ingest_samples_driver
+    batch = {"room_number": 1, "session_id": "sequence-test", "sequence": 7,
+             "samples": [[0.0, 1, 2, 3, 4, 5, 6], [0.01, 1, 2, 3, 4, 5, 6]]}
+    with patch('server.validate_room_number', return_value=True), \
+            patch('server.room_events') as events:
+        first, status = ingest_samples_driver(batch)
+        assert (status, first["accepted"], first["duplicate"]) == \
+            (200, 2, False)
+        again, status = ingest_samples_driver(batch)
+        assert (status, again["accepted"], again["duplicate"]) == \
+            (200, 0, True)
+        assert again["live_metrics"] == first["live_metrics"]
+        assert events.publish.call_count == 1
+        assert ingest_samples_driver(dict(batch, sequence="7")) == \
+            ("sequence must be an integer.", 400)
+    assert len(room_store._samples[(1, "sequence-test")]) == 2
+
+
+@pytest.mark.parametrize("args, expected_status", [
+    ({"t0": "a"}, 400),
+    ({"points": "1.5"}, 400),
+    ({"points": "0"}, 400),
+    ({"t0": "5", "t1": "2"}, 400),
+    ({}, 200),
+    ({"t0": "1", "t1": "2", "points": "10"}, 200),
+])
+def test_fetch_waveform_driver(args, expected_status):
+    import numpy as np
+    from server import fetch_waveform_driver
+    from CPAP_measurement import encode_waveform
+    time = np.linspace(0, 10, 1001)
+    waveform = encode_waveform(time, np.sin(time), max_buckets=128)
+    with patch('server.store') as mock_store:
+        mock_store.get_waveform.return_value = waveform
+        answer, status = fetch_waveform_driver(1, "2024-01-01", args)
+    assert status == expected_status
+    if status == 200:
+        assert len(answer["min"]) == len(answer["max"])
+
+
+def test_fetch_waveform_driver_missing():
+    from server import fetch_waveform_driver
+    with patch('server.store') as mock_store:
+        mock_store.get_waveform.return_value = None
+        assert fetch_waveform_driver(1, "2024-01-01", {})[1] == 400
+
+
+@pytest.mark.parametrize("args", [
+    {"start": "yesterday"},
+    {"rooms": "1,a"},
+    {"points": "0"},
+    {"points": "2000"},
+    {"start": "2024-01-02 00:00:00", "end": "2024-01-01 00:00:00"},
+])
+def test_trend_driver_validation(args):
+    from server import trend_driver
+    assert trend_driver(args)[1] == 400
+
+
+def test_trend_driver():
+    from server import trend_driver
+    calculations = [{"_id": {"room": 2, "bucket": 3}, "count": 2,
+                     "breath_rate_sum": 34.5, "breath_rate_count": 2,
+                     "breath_rate_max": 18.5, "apnea_count_sum": 3,
+                     "apnea_count_count": 2, "apnea_count_max": 2}]
+    summaries = [{"_id": {"room": 2, "bucket": 3}, "count": 1,
+                  "breath_rate_sum": 0.0, "breath_rate_count": 0,
+                  "breath_rate_max": None, "apnea_count_sum": 6,
+                  "apnea_count_count": 1, "apnea_count_max": 6},
+                 {"_id": {"room": 2, "bucket": 0}, "count": 1,
+                  "breath_rate_sum": 15.0, "breath_rate_count": 1,
+                  "breath_rate_max": 15.0, "apnea_count_sum": 0,
+                  "apnea_count_count": 1, "apnea_count_max": 0}]
+    with patch('server.store') as mock_store:
+        mock_store.trend_totals.return_value = calculations + summaries
+        answer, status = trend_driver({"rooms": "2,4",
+                                       "start": "2024-01-01T00:00:00",
+                                       "end": "2024-01-11 00:00:00",
+                                       "points": "10"})
+        arguments = mock_store.trend_totals.call_args[0]
+    assert status == 200
+    assert arguments == ([2, 4], datetime(2024, 1, 1),
+                         datetime(2024, 1, 11), 86400)
+    assert answer == {"start": "2024-01-01 00:00:00",
+                      "end": "2024-01-11 00:00:00",
+                      "bucket_seconds": 86400,
+                      "rooms": [{"room_number": 2, "buckets": [
+                          {"start": "2024-01-01 00:00:00", "count": 1,
+                           "breath_rate_mean": 15.0,
+                           "breath_rate_max": 15.0,
+                           "apnea_count_mean": 0.0,
+                           "apnea_count_max": 0},
+                          {"start": "2024-01-04 00:00:00", "count": 3,
+                           "breath_rate_mean": 17.25,
+                           "breath_rate_max": 18.5,
+                           "apnea_count_mean": 3.0,
+                           "apnea_count_max": 6}]}]}
+
+
+@pytest.mark.parametrize("args, start, end", [
+    ({"start": "2024-01-01T00:00:00+02:00", "end": "2024-01-11 00:00:00"},
+     datetime(2023, 12, 31, 22), datetime(2024, 1, 11)),
+    ({"start": "2024-01-01 00:00:00", "end": "2024-01-11T00:00:00-05:00"},
+     datetime(2024, 1, 1), datetime(2024, 1, 11, 5)),
+    ({"start": "2024-01-01T00:00:00+00:00"}, datetime(2024, 1, 1), None),
+    ({"end": "2024-01-11T00:00:00Z"}, datetime(2023, 12, 12),
+     datetime(2024, 1, 11)),
+])
+def test_trend_driver_utc_offset(mock_store, args, start, end):
+    from server import trend_driver
+    mock_store.trend_totals.return_value = []
+    answer, status = trend_driver(args)
+    assert status == 200
+    arguments = mock_store.trend_totals.call_args[0]
+    assert arguments[1] == start
+    assert arguments[1].tzinfo is None and arguments[2].tzinfo is None
+    if end is not None:
+        assert arguments[2] == end
+
+
+@pytest.mark.parametrize("content_type, room_number, length, body, expected", [
+    ("application/json", 1, None, b"png", 400),
+    ("image/png", 5, None, b"png", 400),
+    ("image/png", 1, 2 ** 30, b"png", 413),
+    ("image/png", 1, None, b"x" * 100, 413),
+    ("image/png", 1, None, b"", 400),
+    ("image/png", 1, None, b"png", 200),
+])
+def test_upload_image_driver(content_type, room_number, length, body,
+                             expected):
+    import io
+    from server import upload_image_driver
+    with patch('server.store') as mock_store, \
+            patch('server.MAX_IMAGE_BYTES', 50), \
+            patch('server.IMAGE_READ_CHUNK', 16):
+        mock_store.list_rooms.return_value = [1, 2, 3, 4]
+        answer = upload_image_driver(room_number, "2023-11-29 10:00:00",
+                                     content_type, length, io.BytesIO(body))
+    assert answer[1] == expected
+    assert mock_store.put_image.called == (expected == 200)
+
+
+def test_image_routes():
+    from server import app
+    from storage import MemoryRoomStore
+    store = MemoryRoomStore()
+    store.save_upload(1, 100, "John Doe", 10,
+                      ["2023-11-29 10:00:00", 18.0, 2, None])
+    store.save_upload(1, 100, "John Doe", 10,
+                      ["2023-11-29 12:00:00", 17.0, 3, "iVBORw=="])
+    client = app.test_client()
+    with patch('server.store', store):
+        r = client.put('/patient/image/1/2023-11-29%2010:00:00',
+                       data=b"\x89PNG data", content_type="image/png")
+        assert r.status_code == 200
+        r = client.get('/lab/image/1/2023-11-29%2010:00:00')
+        assert r.status_code == 200
+        assert r.mimetype == "image/png"
+        assert r.get_data() == b"\x89PNG data"
+        r = client.get('/lab/image/1/2023-11-29%2012:00:00')
+        assert r.get_data() == b"\x89PNG"
+        r = client.get('/lab/image/1/2023-11-30%2012:00:00')
+        assert r.status_code == 400
+
+
+def test_thumbnail_route():
+    pytest.importorskip("PIL")
+    import io
+    from PIL import Image
+    from server import app
+    from storage import MemoryRoomStore
+    store = MemoryRoomStore()
+    store.save_upload(1, 100, "John Doe", 10,
+                      ["2023-11-29 10:00:00", 18.0, 2, None])
+    plot = io.BytesIO()
+    Image.new("RGB", (640, 480), "white").save(plot, format="PNG")
+    store.put_image(1, "2023-11-29 10:00:00", "image/png", plot.getvalue())
+    client = app.test_client()
+    with patch('server.store', store):
+        r = client.get('/lab/image/1/2023-11-29%2010:00:00/150')
+        assert r.status_code == 200
+        assert Image.open(io.BytesIO(r.get_data())).size == (150, 150)
+        assert r.cache_control.max_age == 86400
+        assert store.get_thumbnail(1, "2023-11-29 10:00:00", 150) == \
+            r.get_data()
+        r = client.get('/lab/image/1/2023-11-29%2010:00:00/150',
+                       headers={"If-None-Match": r.headers["ETag"]})
+        assert r.status_code == 304
+        r = client.get('/lab/image/1/2023-11-29%2010:00:00/151')
+        assert r.status_code == 400
+        r = client.get('/lab/image/1/2023-11-30%2010:00:00/150')
+        assert r.status_code == 400
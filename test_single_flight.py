@@ -0,0 +1,58 @@
+import threading
+import time
+import pytest
+
+
+def test_single_flight_shares_concurrent_calls():
+    from single_flight import SingleFlight
+    flights = SingleFlight(0)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def read():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return [1, 2]
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(
+        flights.do("rooms", read)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(
+        flights.do("rooms", read))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while flights.stats()["shared"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert results == [[1, 2]] * 4
+    assert len(calls) == 1
+    assert flights.stats() == {"calls": 1, "shared": 3}
+    assert flights.do("rooms", lambda: [3]) == [3]
+
+
+def test_single_flight_window():
+    from single_flight import SingleFlight
+    flights = SingleFlight(60)
+    assert flights.do(("room", 1), lambda: 10) == 10
+    assert flights.do(("room", 1), lambda: 11) == 10
+    assert flights.do(("room", 2), lambda: 12) == 12
+    flights.window = 0
+    assert flights.do(("room", 1), lambda: 13) == 13
+
+
+def test_single_flight_errors_not_kept():
+    from single_flight import SingleFlight
+    flights = SingleFlight(60)
+
+    def fail():
+        raise ValueError("down")
+
+    with pytest.raises(ValueError):
+        flights.do("rooms", fail)
+    assert flights.do("rooms", lambda: [1]) == [1]
@@ -0,0 +1,474 @@
+import pytest
+from datetime import datetime
+from DB_init import SleepLabRooms as db
+from unittest.mock import patch
+
+
+patient_dict1 = {"room_number": 1,
+                 "patient_name": "John Doe",
+                 "patient_mrn": 100,
+                 "cpap_pressure": 15,
+                 "cpap_calculations": [
+                     ["2023-11-29T10:00:00", 18, 2, "image1.png"],
+                     ["2023-11-29T12:00:00", 17, 3, "image2.png"]]}
+
+
+@pytest.mark.mongo
+def test_SleepLabRooms_to_dict():
+    from storage import SleepLabRooms_to_dict as func
+    patient1 = db.objects.raw({"_id": 1}).first()
+    msg1 = "Input must be SleepLabRooms instance."
+    assert func(patient1) == (True, patient_dict1)
+    assert func(patient_dict1) == (False, msg1)
+
+
+@pytest.mark.parametrize("calculation, expected", [
+    (["2023-11-29 10:00:00", 18.0, 2, "img"],
+     {"timestamp": "2023-11-29 10:00:00", "breath_rate_bpm": 18.0,
+      "apnea_count": 2}),
+    (["2023-11-29 10:00:00"], None),
+    ("calc1", None),
+])
+def test_calculation_summary(calculation, expected):
+    from storage import calculation_summary
+    assert calculation_summary(calculation) == expected
+
+
+@pytest.mark.mongo
+def test_store_sample_buckets():
+    from storage import store_sample_buckets
+    with patch('storage.SampleBuckets') as mock_buckets:
+        store_sample_buckets(1, "n1", [[59.9, 1, 2, 3, 4, 5, 6],
+                                       [60.0, 1, 2, 3, 4, 5, 6],
+                                       [61.0, 1, 2, 3, 4, 5, 6]])
+        collection = mock_buckets._mongometa.collection
+        operations = collection.bulk_write.call_args[0][0]
+        assert [op._filter["minute"] for op in operations] == [0, 1]
+        assert [op._doc["$inc"]["count"] for op in operations] == [1, 2]
+
+
+@pytest.mark.mongo
+def test_migrate_calculations():
+    from storage import migrate_calculations
+    batch = [{"_id": 1, "cpap_calculations": [
+                 ["2023-11-29T10:00:00", 18, 2, "image1.png"]]},
+             {"_id": 2, "cpap_calculations": [["bad"]]}]
+    with patch('storage.SleepLabRooms') as mock_db:
+        collection = mock_db._mongometa.collection
+        collection.find.return_value.sort.return_value.limit.side_effect = \
+            [batch, []]
+        collection.bulk_write.return_value.modified_count = 1
+        assert migrate_calculations(batch_size=2) == 1
+        operations = collection.bulk_write.call_args[0][0]
+        assert collection.find.call_args_list[1][0][0]["_id"] == {"$gt": 2}
+    assert len(operations) == 1
+    assert operations[0]._filter == batch[0]
+    assert operations[0]._doc["$set"]["cpap_calculations"] == [
+        {"timestamp": "2023-11-29T10:00:00",
+         "recorded_at": datetime(2023, 11, 29, 10, 0),
+         "breath_rate_bpm": 18.0, "apnea_count": 2, "image": "image1.png"}]
+
+
+def test_trend_pipeline():
+    from storage import trend_pipeline
+    pipeline = trend_pipeline([2, 4], datetime(2024, 1, 1),
+                              datetime(2024, 1, 11), 86400)
+    assert pipeline[0]["$match"]["_id"] == {"$in": [2, 4]}
+
+
+@pytest.fixture(params=["memory", "sqlite",
+                        pytest.param("mongo", marks=pytest.mark.mongo)])
+def store(request):
+    from storage import MemoryRoomStore, SqliteRoomStore, MongoRoomStore
+    if request.param == "memory":
+        yield MemoryRoomStore()
+    elif request.param == "sqlite":
+        yield SqliteRoomStore(":memory:")
+    else:
+        from DB_init import (seed_db, get_collection, create_mrn_index,
+                             ROOM_DATA_MODELS)
+        for model in (db,) + ROOM_DATA_MODELS:
+            get_collection(model).delete_many({})
+        create_mrn_index()
+        yield MongoRoomStore()
+        for model in ROOM_DATA_MODELS:
+            get_collection(model).delete_many({})
+        seed_db()
+
+
+def test_store_rooms(store):
+    calculation = ["2023-11-29 10:00:00", 18.0, 2, "image1.png"]
+    assert store.save_upload(3, 100, "John Doe", 10, calculation) == \
+        (3, True)
+    assert store.save_upload(5, 100, "John Doe", 12,
+                             ["2023-11-29 12:00:00", 17.0, 3, "image2.png"]) \
+        == (3, False)
+    assert store.list_rooms() == [3]
+    assert store.get_pressure(3) == 12
+    assert store.get_pressure(5) is None
+    assert store.get_room(3)["cpap_calculations"] == [
+        calculation, ["2023-11-29 12:00:00", 17.0, 3, "image2.png"]]
+    assert store.room_summaries() == [
+        {"room_number": 3, "patient_name": "John Doe", "patient_mrn": 100,
+         "cpap_pressure": 12, "timestamp": "2023-11-29 12:00:00",
+         "breath_rate_bpm": 17.0, "apnea_count": 3}]
+    assert store.update_pressure(3, 14) is True
+    assert store.update_pressure(4, 14) is False
+    assert store.get_live_metrics(3) == {}
+    store.set_live_metrics(3, {"session_id": "n1", "breath_count": 4})
+    assert store.get_live_metrics(3)["breath_count"] == 4
+    assert store.get_live_metrics(4) is None
+    store.put_waveform(3, calculation[0], {"t0": 0.0})
+    assert store.get_waveform(3, calculation[0]) == {"t0": 0.0}
+    store.put_thumbnail(3, calculation[0], 150, b"\x89PNG small")
+    assert store.get_thumbnail(3, calculation[0], 150) == b"\x89PNG small"
+    assert store.get_thumbnail(3, calculation[0], 75) is None
+    store.put_image(3, calculation[0], "image/png", b"\x89PNG")
+    assert store.get_thumbnail(3, calculation[0], 150) is None
+    store.put_thumbnail(3, calculation[0], 150, b"\x89PNG small")
+    assert store.get_image(3, calculation[0]) == ("image/png", b"\x89PNG")
+    assert store.delete_patient(100) == 3
+    assert store.delete_patient(100) is None
+    assert store.get_room(3) is None
+    assert store.get_waveform(3, calculation[0]) is None
+    assert store.get_image(3, calculation[0]) is None
+    assert store.get_thumbnail(3, calculation[0], 150) is None
+
+
+def test_store_sample_batches(store):
+    def stored_samples():
+        if store.name == "mongo":
+            from DB_init import get_collection, SampleBuckets
+            return sum(bucket["count"] for bucket in
+                       get_collection(SampleBuckets).find(
+                           {"room_number": 1, "session_id": "night-1"}))
+        if store.name == "memory":
+            return len(store._samples.get((1, "night-1"), []))
+        return store._query("SELECT COUNT(*) FROM samples WHERE "
+                            "room_number = 1 AND session_id = 'night-1'")[0][0]
+
+    if store.name == "mongo":
+        from DB_init import get_collection, SampleBuckets
+        get_collection(SampleBuckets).delete_many({})
+    samples = [[59.5, 1, 2, 3, 4, 5, 6], [60.5, 1, 2, 3, 4, 5, 6]]
+    assert store.append_samples(1, "night-1", samples, 1) is True
+    assert store.append_samples(1, "night-1", samples, 1) is False
+    assert store.append_samples(1, "night-1", samples[1:], 2) is True
+    assert store.append_samples(1, "night-2", samples[1:], 2) is True
+    assert store.append_samples(1, "night-1", samples[1:]) is True
+    assert stored_samples() == 4
+
+
+@pytest.mark.parametrize("t0, t1, points", [
+    (None, None, 800), (100.0, 130.0, 800), (3000.0, None, 50),
+    (10.0, 20.0, 1)])
+def test_store_waveform_window(store, t0, t1, points):
+    import numpy as np
+    from CPAP_measurement import encode_waveform, query_waveform
+    time = np.linspace(0, 3600, 100000)
+    waveform = encode_waveform(time, np.sin(time))
+    store.put_waveform(1, "2023-11-29 10:00:00", waveform)
+    window = store.get_waveform(1, "2023-11-29 10:00:00", t0, t1, points)
+    assert query_waveform(window, t0, t1, points) == \
+        query_waveform(waveform, t0, t1, points)
+    if store.name == "mongo":
+        # Only the chunks of one level are fetched.
+        assert sum(level is not None for level in window["levels"]) == 1
+        assert len([chunk for level in window["levels"] if level
+                    for chunk in level["min"] if chunk is not None]) <= 2
+    assert store.get_waveform(2, "2023-11-29 10:00:00", t0, t1,
+                              points) is None
+
+
+def test_store_new_patient_replaces_room(store):
+    timestamp = "2023-11-29 10:00:00"
+
+    def add_room_data(room_number):
+        store.put_waveform(room_number, timestamp, {"t0": 0.0})
+        store.put_image(room_number, timestamp, "image/png", b"\x89PNG")
+        store.put_thumbnail(room_number, timestamp, 150, b"\x89PNG small")
+        store.append_samples(room_number, "night-1",
+                             [[0.0, 1, 2, 3, 4, 5, 6]])
+        if store.name == "mongo":
+            from DB_init import get_collection, DailySummaries
+            get_collection(DailySummaries).insert_one({
+                "room_number": room_number, "day": datetime(2023, 11, 20),
+                "count": 1, "breath_rate_sum": 16.0, "breath_rate_count": 1,
+                "breath_rate_max": 16.0, "apnea_count_sum": 1,
+                "apnea_count_count": 1, "apnea_count_max": 1,
+                "timestamps": ["2023-11-20 10:00:00"]})
+
+    def room_data(room_number):
+        return (store.get_waveform(room_number, timestamp),
+                store.get_image(room_number, timestamp),
+                store.get_thumbnail(room_number, timestamp, 150),
+                store.trend_totals([room_number], datetime(2023, 11, 1),
+                                   datetime(2023, 12, 1), 86400))
+
+    store.save_upload(3, 100, "John Doe", 10,
+                      [timestamp, 18.0, 2, "image1.png"])
+    add_room_data(3)
+    store.save_upload(3, 101, "Jane Smith", 8,
+                      ["2023-11-30 10:00:00", 15.0, 0, "image2.png"])
+    room = store.get_room(3)
+    assert room["patient_mrn"] == 101
+    assert len(room["cpap_calculations"]) == 1
+    assert room_data(3)[:3] == (None, None, None)
+    assert [bucket["count"] for bucket in room_data(3)[3]] == [1]
+    add_room_data(3)
+    store.save_uploads([(3, 102, "Bob Brown", 12,
+                         ["2023-12-01 10:00:00", 14.0, 1, None])])
+    assert room_data(3)[:3] == (None, None, None)
+    assert [bucket["count"] for bucket in room_data(3)[3]] == []
+
+
+def test_store_save_uploads(store):
+    store.save_upload(3, 100, "John Doe", 10,
+                      ["2023-11-29 10:00:00", 18.0, 2, "image1.png"])
+    assert store.save_uploads([
+        (5, 100, "John Doe", 12, ["2023-11-30 10:00:00", 17.0, 1, None]),
+        (4, 101, "Jane Smith", 8, ["2023-11-30 10:00:00", 15.0, 0, None]),
+        (4, 101, "Jane Smith", 9, ["2023-11-30 11:00:00", 14.0, 3, None])]) \
+        == [(3, False), (4, True), (4, False)]
+    assert store.get_pressure(3) == 12
+    room = store.get_room(4)
+    assert room["cpap_pressure"] == 9
+    assert [calculation[0] for calculation in room["cpap_calculations"]] == \
+        ["2023-11-30 10:00:00", "2023-11-30 11:00:00"]
+    assert store.room_summaries()[1]["apnea_count"] == 3
+
+
+def test_store_save_uploads_in_order(store):
+    store.save_upload(90, 900, "John Doe", 10,
+                      ["2023-11-29 10:00:00", 18.0, 2, None])
+    assert store.save_uploads([
+        (90, 900, "John Doe", 11, ["2023-11-30 09:00:00", 17.0, 1, None]),
+        (90, 901, "Jane Smith", 12, ["2023-11-30 10:00:00", 15.0, 0, None]),
+        (90, 900, "John Doe", 13, ["2023-11-30 11:00:00", 16.0, 2, None]),
+        (91, 902, "Bob Brown", 14, ["2023-11-30 12:00:00", 14.0, 1, None]),
+        (91, 902, "Bob Brown", 15, ["2023-11-30 13:00:00", 13.0, 4, None])
+    ]) == [(90, False), (90, True), (90, True), (91, True), (91, False)]
+    room = store.get_room(90)
+    assert (room["patient_mrn"], room["cpap_pressure"]) == (900, 13)
+    assert [calculation[0] for calculation in room["cpap_calculations"]] == \
+        ["2023-11-30 11:00:00"]
+    room = store.get_room(91)
+    assert (room["patient_mrn"], room["cpap_pressure"]) == (902, 15)
+    assert len(room["cpap_calculations"]) == 2
+    assert store.save_uploads([]) == []
+
+
+def test_store_save_uploads_replayed(store, tmp_path):
+    # A crash between a group commit and its commit marker makes the next
+    # start replay the group, which must not store its calculations twice.
+    import json
+    from server import commit_journaled_uploads
+    from write_behind import WriteBehindQueue
+    journal = tmp_path / "uploads.journal"
+    records = [{"room_number": 3, "patient_name": "John Doe",
+                "patient_mrn": 100, "cpap_pressure": 12,
+                "cpap_calculations": ["2024-01-01 10:00:00", 17.0, 1, None]},
+               {"room_number": 3, "patient_name": "John Doe",
+                "patient_mrn": 100, "cpap_pressure": 13,
+                "cpap_calculations": ["2024-01-01 11:00:00", 16.0, 2, None]}]
+    with patch('server.store', store), patch('server.room_events'):
+        for attempt in range(2):
+            journal.write_text("".join(
+                json.dumps({"seq": seq, "record": record}) + "\n"
+                for seq, record in enumerate(records, 1)))
+            queue = WriteBehindQueue(str(journal), 3600, 500)
+            assert queue.start(commit_journaled_uploads) is True
+            queue.stop()
+    room = store.get_room(3)
+    assert room["cpap_pressure"] == 13
+    assert [calculation[0] for calculation in room["cpap_calculations"]] == \
+        ["2024-01-01 10:00:00", "2024-01-01 11:00:00"]
+    totals = store.trend_totals([3], datetime(2024, 1, 1),
+                                datetime(2024, 1, 2), 86400)
+    assert [entry["count"] for entry in totals] == [2]
+    assert store.room_summaries()[0]["apnea_count"] == 2
+
+
+@pytest.mark.mongo
+@pytest.mark.parametrize("store", ["mongo"], indirect=True)
+def test_mongo_save_uploads_refused(store):
+    from pymongo.errors import BulkWriteError
+    from DB_init import get_collection
+    from storage import MongoRoomStore
+    store.save_upload(1, 100, "John Doe", 10,
+                      ["2023-11-29 10:00:00", 18.0, 2, None])
+    store.save_upload(2, 101, "Jane Smith", 8,
+                      ["2023-11-29 10:00:00", 15.0, 0, None])
+    uploads = [
+        (1, 100, "John Doe", 11, ["2023-11-30 10:00:00", 17.0, 1, None]),
+        (5, 101, "Jane Smith", 9, ["2023-11-30 10:00:00", 14.0, 0, None]),
+        (6, 600, "Bob Brown", 12, ["2023-11-30 10:00:00", 16.0, 3, None])]
+    # Jane Smith's room is hidden from the lookup, as if another writer
+    # stored her after it, so her upload breaks the unique MRN index.
+    with patch.object(MongoRoomStore, "_patient_rooms",
+                      return_value={100: 1}):
+        assert store.save_uploads(uploads) == [(1, False), None, (6, True)]
+    assert store.get_room(5) is None
+    assert store.get_pressures() == {1: 11, 2: 8, 6: 12}
+    assert store.save_uploads(uploads[:1] + uploads[2:]) == \
+        [(1, False), (6, False)]
+    assert len(store.get_room(1)["cpap_calculations"]) == 2
+    assert len(store.get_room(6)["cpap_calculations"]) == 1
+    error = BulkWriteError({"writeErrors": [], "writeConcernErrors": [
+        {"code": 64, "errmsg": "waiting for replication timed out"}]})
+    with patch.object(type(get_collection(db)), "bulk_write",
+                      side_effect=error):
+        with pytest.raises(BulkWriteError):
+            store.save_uploads(uploads[:1])
+
+
+def test_store_pressures(store):
+    calculation = ["2023-11-29 10:00:00", None, None, None]
+    store.save_upload(3, 100, "John Doe", 10, calculation)
+    store.save_upload(5, 101, "Jane Smith", 8, calculation)
+    assert store.get_pressures([3, 4, 5]) == {3: 10, 5: 8}
+    assert store.get_pressures() == {3: 10, 5: 8}
+    assert sorted(store.update_pressures({3: 12, 4: 9, 5: 14})) == [3, 5]
+    assert store.get_pressures([5, 3]) == {3: 12, 5: 14}
+
+
+@pytest.mark.mongo
+def test_mongo_pressures():
+    from DB_init import seed_db
+    from storage import MongoRoomStore
+    store = MongoRoomStore()
+    seed_db()
+    try:
+        assert store.get_pressures([1, 2, 99]) == {1: 15, 2: 10}
+        assert sorted(store.update_pressures({1: 20, 2: 21})) == [1, 2]
+        assert store.update_pressures({1: 22, 99: 9}) == [1]
+        assert store.get_pressures([1, 2]) == {1: 22, 2: 21}
+    finally:
+        seed_db()
+
+
+@pytest.mark.mongo
+def test_dedupe_mrns():
+    from pymongo.errors import OperationFailure
+    from DB_init import (seed_db, get_collection, create_mrn_index,
+                         dedupe_mrns)
+    from storage import MongoRoomStore
+    store = MongoRoomStore()
+    collection = get_collection(db)
+    try:
+        collection.drop_index("patient_mrn_1")
+    except OperationFailure:
+        pass
+    try:
+        collection.insert_one({"_id": 9, "patient_name": "John Doe",
+                               "patient_mrn": 100, "cpap_pressure": 15,
+                               "cpap_calculations": [],
+                               "latest_calculation": {
+                                   "timestamp": "2023-11-30T10:00:00"}})
+        store.put_waveform(1, "2023-11-29T10:00:00", {"t0": 0.0})
+        assert create_mrn_index() is False
+        assert "patient_mrn_lookup" in collection.index_information()
+        assert dedupe_mrns() == [1]
+        assert store.list_rooms() == [2, 3, 4, 9]
+        assert store.get_waveform(1, "2023-11-29T10:00:00") is None
+        indexes = collection.index_information()
+        assert indexes["patient_mrn_1"]["unique"] is True
+        assert "patient_mrn_lookup" not in indexes
+    finally:
+        seed_db()
+
+
+@pytest.mark.mongo
+def test_mongo_save_uploads():
+    from DB_init import seed_db
+    from storage import MongoRoomStore
+    store = MongoRoomStore()
+    rooms = store.list_rooms()
+    patient = store.get_room(rooms[0])
+    calculations = len(patient["cpap_calculations"])
+    try:
+        assert store.save_uploads([
+            (rooms[0], patient["patient_mrn"], patient["patient_name"], 12,
+             ["2023-12-01T10:00:00", 17.0, 1, None]),
+            (90, 900, "Jane Smith", 8,
+             ["2023-12-01T10:00:00", 15.0, 0, None]),
+            (90, 900, "Jane Smith", 9,
+             ["2023-12-01T11:00:00", 14.0, 3, None])]) == \
+            [(rooms[0], False), (90, True), (90, False)]
+        room = store.get_room(rooms[0])
+        assert room["cpap_pressure"] == 12
+        assert len(room["cpap_calculations"]) == calculations + 1
+        room = store.get_room(90)
+        assert room["cpap_pressure"] == 9
+        assert len(room["cpap_calculations"]) == 2
+        assert store.room_summaries()[-1]["apnea_count"] == 3
+    finally:
+        seed_db()
+
+
+def test_store_trend_totals(store):
+    for hour, breath_rate, apnea_count in [(0, 18.0, 2), (1, 16.0, 4),
+                                           (25, 15.0, 0)]:
+        store.save_upload(2, 101, "Jane Smith", 10, [
+            "2024-01-{:02d} {:02d}:30:00".format(1 + hour // 24, hour % 24),
+            breath_rate, apnea_count, "image.png"])
+    store.save_upload(4, 102, "Alex Brown", 10,
+                      ["2024-01-01 00:30:00", 20.0, 1, "image.png"])
+    totals = store.trend_totals([2], datetime(2024, 1, 1),
+                                datetime(2024, 1, 11), 86400)
+    assert sorted(totals, key=lambda entry: entry["_id"]["bucket"]) == [
+        {"_id": {"room": 2, "bucket": 0}, "count": 2,
+         "breath_rate_sum": 34.0, "breath_rate_count": 2,
+         "breath_rate_max": 18.0, "apnea_count_sum": 6,
+         "apnea_count_count": 2, "apnea_count_max": 4},
+        {"_id": {"room": 2, "bucket": 1}, "count": 1,
+         "breath_rate_sum": 15.0, "breath_rate_count": 1,
+         "breath_rate_max": 15.0, "apnea_count_sum": 0,
+         "apnea_count_count": 1, "apnea_count_max": 0}]
+
+
+def test_store_trend_totals_utc_offset(store):
+    # Naive timestamps and timestamps with a UTC offset share the same
+    # buckets once the latter are converted to UTC.
+    for timestamp in ["2024-01-01 00:30:00", "2024-01-02T01:30:00+02:00",
+                      "2024-01-01T23:30:00-01:00"]:
+        store.save_upload(2, 101, "Jane Smith", 10,
+                          [timestamp, 16.0, 1, None])
+    totals = store.trend_totals([2], datetime(2024, 1, 1),
+                                datetime(2024, 1, 3), 86400)
+    assert sorted((entry["_id"]["bucket"], entry["count"])
+                  for entry in totals) == [(0, 2), (1, 1)]
+
+
+@pytest.mark.mongo
+@pytest.mark.parametrize("store", ["mongo"], indirect=True)
+def test_mongo_trend_totals_summaries(store):
+    from DB_init import get_collection, DailySummaries
+    get_collection(DailySummaries).insert_many([{
+        "room_number": 2, "day": datetime(2024, 1, day), "count": 1,
+        "breath_rate_sum": 16.0, "breath_rate_count": 1,
+        "breath_rate_max": 16.0, "apnea_count_sum": day,
+        "apnea_count_count": 1, "apnea_count_max": day,
+        "timestamps": ["2024-01-{:02d} 10:00:00".format(day)]}
+        for day in (1, 2, 4)])
+    # The range starts in the middle of January 2nd, which still counts.
+    totals = store.trend_totals([2], datetime(2024, 1, 2, 12),
+                                datetime(2024, 1, 11), 86400)
+    assert sorted((entry["_id"]["bucket"], entry["apnea_count_sum"])
+                  for entry in totals) == [(0, 2), (1, 4)]
+
+
+@pytest.mark.parametrize("spec, name", [
+    ("memory", "memory"),
+    ("sqlite::memory:", "sqlite"),
+    ("mongo", "mongo"),
+])
+def test_make_store(spec, name):
+    from storage import make_store
+    assert make_store(spec).name == name
+
+
+def test_make_store_unknown():
+    from storage import make_store
+    with pytest.raises(ValueError):
+        make_store("postgres")
@@ -0,0 +1,25 @@
+import io
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.mark.parametrize("mode, format", [
+    ("RGBA", "PNG"),
+    ("RGB", "JPEG"),
+    ("P", "PNG"),
+])
+def test_make_thumbnail(mode, format):
+    from thumbnails import make_thumbnail
+    original = io.BytesIO()
+    Image.new(mode, (640, 480)).save(original, format=format)
+    thumbnail = Image.open(io.BytesIO(make_thumbnail(original.getvalue(),
+                                                     75)))
+    assert thumbnail.format == "PNG"
+    assert thumbnail.size == (75, 75)
+
+
+def test_make_thumbnail_invalid():
+    from thumbnails import make_thumbnail
+    with pytest.raises(OSError):
+        make_thumbnail(b"not an image", 75)
@@ -0,0 +1,53 @@
+import gzip
+import pytest
+from werkzeug.datastructures import MIMEAccept, Accept
+from werkzeug.http import parse_accept_header
+
+
+def accepts(accept, accept_encoding):
+    return (parse_accept_header(accept, MIMEAccept),
+            parse_accept_header(accept_encoding, Accept))
+
+
+@pytest.mark.parametrize("accept, accept_encoding, expected", [
+    ("", "", ("application/json", None)),
+    ("*/*", "gzip, deflate", ("application/json", "gzip")),
+    ("application/json", "identity", ("application/json", None)),
+    ("text/html", "gzip;q=0", ("application/json", None)),
+])
+def test_negotiate(accept, accept_encoding, expected):
+    from wire import negotiate
+    assert negotiate(*accepts(accept, accept_encoding)) == expected
+
+
+def test_negotiate_compact_formats():
+    pytest.importorskip("msgpack")
+    pytest.importorskip("brotli")
+    from wire import negotiate, accept_header
+    assert negotiate(*accepts(accept_header(), "gzip, br")) == \
+        ("application/msgpack", "br")
+
+
+@pytest.mark.parametrize("size, min_size, expected", [
+    (10, 1024, None),
+    (2000, 1024, "gzip"),
+    (10, 0, "gzip"),
+])
+def test_encode_body(size, min_size, expected):
+    from wire import encode_body, decode_body
+    data = {"image": "a" * size}
+    body, encoding = encode_body(data, "application/json", "gzip", min_size)
+    assert encoding == expected
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    assert decode_body(body, "application/json") == data
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip("msgpack")
+    from wire import encode_body, decode_body
+    data = [{"room_number": 1, "cpap_calculations": [
+        ["2023-11-29 10:00:00", 18.5, 2, None]]}]
+    body, encoding = encode_body(data, "application/msgpack", None)
+    assert encoding is None
+    assert decode_body(body, "application/msgpack") == data
@@ -0,0 +1,73 @@
+import json
+
+
+def make_queue(tmp_path, batch_size=500):
+    from write_behind import WriteBehindQueue
+    return WriteBehindQueue(str(tmp_path / "uploads.journal"), 3600,
+                            batch_size)
+
+
+def test_write_behind_group_commit(tmp_path):
+    queue = make_queue(tmp_path, batch_size=2)
+    groups = []
+    assert queue.start(groups.append) is True
+    queue.append({"room_number": 1})
+    assert queue.pending_records() == [{"room_number": 1}]
+    assert queue.stats()["pending"] == 1
+    assert queue.stats()["journal_bytes"] > 0
+    queue.append({"room_number": 2})
+    queue.append({"room_number": 3})
+    queue.stop()
+    assert groups == [[{"room_number": 1}, {"room_number": 2}],
+                      [{"room_number": 3}]]
+    stats = queue.stats()
+    assert stats["pending"] == 0
+    assert stats["flushed"] == 3
+    assert (tmp_path / "uploads.journal").read_text() == ""
+
+
+def test_write_behind_replay(tmp_path):
+    journal = tmp_path / "uploads.journal"
+    journal.write_text("\n".join(json.dumps(entry) for entry in [
+        {"seq": 1, "record": {"room_number": 1}},
+        {"seq": 2, "record": {"room_number": 2}},
+        {"committed": 1},
+        {"seq": 3, "record": {"room_number": 3}}]) +
+        '\n{"seq": 4, "rec')
+    groups = []
+    queue = make_queue(tmp_path)
+    queue.start(groups.append)
+    assert queue.pending_records() == [{"room_number": 2},
+                                       {"room_number": 3}]
+    assert queue.append({"room_number": 4}) == 4
+    queue.stop()
+    assert groups == [[{"room_number": 2}, {"room_number": 3},
+                       {"room_number": 4}]]
+
+
+def test_write_behind_failed_flush_stays_journaled(tmp_path):
+    queue = make_queue(tmp_path)
+
+    def fail(records):
+        raise ConnectionError("database unreachable")
+
+    queue.start(fail)
+    queue.append({"room_number": 1})
+    queue.stop()
+    assert queue.stats()["failed_flushes"] == 1
+    groups = []
+    queue = make_queue(tmp_path)
+    queue.start(groups.append)
+    queue.stop()
+    assert groups == [[{"room_number": 1}]]
+
+
+def test_write_behind_single_process(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.start(lambda records: None) is True
+    other = make_queue(tmp_path)
+    assert other.start(lambda records: None) is False
+    assert other.running() is False
+    queue.stop()
+    assert other.start(lambda records: None) is True
+    other.stop()
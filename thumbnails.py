@@ -0,0 +1,49 @@
+import io
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Square edge lengths in pixels of the thumbnails served by the server. 150
+# is the size shown by the lab GUI.
+THUMBNAIL_SIZES = (75, 150, 300)
+THUMBNAIL_TYPE = "image/png"
+
+
+def thumbnails_available():
+    """Returns whether thumbnails can be generated.
+
+    Returns
+    -------
+    bool
+        True if Pillow is installed
+    """
+    return Image is not None
+
+
+def make_thumbnail(data, size):
+    """Scales an image file down to a square PNG thumbnail.
+
+    The image is resized to `size` by `size` pixels, as the lab GUI used to
+    do on its own copy of the full image, and converted to PNG, which keeps
+    the thin lines of the flow rate plots sharp.
+
+    Parameters
+    ----------
+    data : bytes
+        PNG or JPEG file
+    size : int
+        edge length of the thumbnail in pixels
+
+    Returns
+    -------
+    bytes
+        PNG file of the thumbnail
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        thumbnail = image.resize((size, size), Image.LANCZOS)
+    out = io.BytesIO()
+    thumbnail.save(out, format="PNG", optimize=True)
+    return out.getvalue()
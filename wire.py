@@ -0,0 +1,197 @@
+import gzip
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+# Bodies smaller than this are sent uncompressed by default.
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def encode_json(data):
+    """Encodes a JSON serializable value as compact UTF-8 JSON.
+
+    orjson is used when it is installed, the standard library otherwise.
+
+    Parameters
+    ----------
+    data : object
+        value to encode
+
+    Returns
+    -------
+    bytes
+        JSON document
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def media_types():
+    """Returns the media types this server can encode, preferred first.
+
+    Returns
+    -------
+    list of str
+        JSON, followed by MessagePack if msgpack is installed
+    """
+    return [JSON_TYPE, MSGPACK_TYPE] if msgpack is not None else [JSON_TYPE]
+
+
+def content_encodings():
+    """Returns the content codings this server can apply, preferred first.
+
+    Returns
+    -------
+    list of str
+        "br" if brotli is installed, then "gzip"
+    """
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def accept_header():
+    """Returns the `Accept` header sent by the GUI clients.
+
+    Returns
+    -------
+    str
+        MessagePack preferred over JSON if msgpack is installed, JSON only
+        otherwise
+    """
+    if msgpack is None:
+        return JSON_TYPE
+    return "{}, {};q=0.9".format(MSGPACK_TYPE, JSON_TYPE)
+
+
+def negotiate(accept, accept_encoding):
+    """Chooses the representation of a response.
+
+    JSON is chosen unless the client prefers MessagePack, so clients that
+    send no `Accept` header keep receiving JSON. The preferred content coding
+    is the first one the client accepts, brotli before gzip.
+
+    Parameters
+    ----------
+    accept : werkzeug MIMEAccept
+        parsed `Accept` header of the request
+    accept_encoding : werkzeug Accept
+        parsed `Accept-Encoding` header of the request
+
+    Returns
+    -------
+    str
+        media type
+    str or None
+        content coding, or None if the client accepts none
+    """
+    media_type = accept.best_match(media_types(), default=JSON_TYPE)
+    return media_type, accept_encoding.best_match(content_encodings())
+
+
+def serialize(data, media_type):
+    """Encodes a value in a media type.
+
+    Parameters
+    ----------
+    data : object
+        JSON serializable value
+    media_type : str
+        JSON_TYPE or MSGPACK_TYPE
+
+    Returns
+    -------
+    bytes
+        uncompressed body
+    """
+    if media_type == MSGPACK_TYPE:
+        return msgpack.packb(data)
+    return encode_json(data)
+
+
+def encode_body(data, media_type, encoding, min_size=COMPRESS_MIN_BYTES):
+    """Encodes a value in a negotiated representation.
+
+    The body is only compressed if it is at least `min_size` bytes long,
+    since for small bodies the work of compressing outweighs the saving.
+
+    Parameters
+    ----------
+    data : object
+        JSON serializable value
+    media_type : str
+        JSON_TYPE or MSGPACK_TYPE
+    encoding : str or None
+        "br", "gzip" or None
+    min_size : int
+        smallest body that is compressed
+
+    Returns
+    -------
+    bytes
+        response body
+    str or None
+        content coding applied to the body
+    """
+    body = serialize(data, media_type)
+    if encoding is None or len(body) < min_size:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+def compress(body, encoding):
+    """Applies a content coding to a body.
+
+    Parameters
+    ----------
+    body : bytes
+        uncompressed body
+    encoding : str or None
+        "br", "gzip" or None
+
+    Returns
+    -------
+    bytes
+        coded body
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+def decode_body(body, media_type):
+    """Decodes a response body received by a client.
+
+    The content coding is undone by `requests` before the body is read, so
+    only the media type needs to be handled here.
+
+    Parameters
+    ----------
+    body : bytes
+        uncompressed response body
+    media_type : str
+        value of the `Content-Type` header
+
+    Returns
+    -------
+    object
+        decoded value
+    """
+    if media_type.split(";")[0].strip() == MSGPACK_TYPE:
+        return msgpack.unpackb(body)
+    return json.loads(body)
@@ -0,0 +1,290 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """Durable queue of uploads committed to the room storage in groups.
+
+    Each record appended is written to a journal file and synced to disk
+    before `append` returns, so an acknowledged upload survives a crash.
+    A background thread hands the pending records to a commit function in
+    groups of at most `batch_size`, every `flush_interval` seconds or as soon
+    as a full group is waiting. A commit marker is then appended to the
+    journal, and the journal is emptied once nothing is pending. On start,
+    records without a marker are replayed. A crash between a commit and its
+    marker replays that group again, so records are committed at least once.
+
+    The journal is locked while the queue runs, so only one process can use
+    it; `start` returns False in any other process sharing the path.
+
+    Parameters
+    ----------
+    path : str
+        path of the journal file
+    flush_interval : float
+        seconds between group commits
+    batch_size : int
+        largest number of records in one group commit
+    """
+
+    def __init__(self, path, flush_interval, batch_size):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = max(int(batch_size), 1)
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._next_seq = 1
+        self._file = None
+        self._commit = None
+        self._stop = False
+        self._thread = None
+        self._flushed = 0
+        self._failed_flushes = 0
+        self._last_flush_seconds = None
+
+    def start(self, commit):
+        """Replays the journal and starts the background thread.
+
+        Parameters
+        ----------
+        commit : callable
+            function storing a list of records; it must raise if the group
+            could not be stored, so the group is retried later
+
+        Returns
+        -------
+        bool
+            False if another process holds the journal
+        """
+        if self._thread is not None:
+            return True
+        journal = open(self.path, "a+")
+        try:
+            fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            journal.close()
+            return False
+        journal.seek(0)
+        pending, next_seq = read_journal(journal)
+        self._file = rewrite_journal(journal, self.path, pending)
+        self._pending = pending
+        self._next_seq = next_seq
+        if pending:
+            logging.info("Replaying %d journaled uploads", len(pending))
+        self._commit = commit
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def running(self):
+        """Returns whether the queue accepts records.
+
+        Returns
+        -------
+        bool
+            True between `start` and `stop`
+        """
+        return self._thread is not None
+
+    def append(self, record):
+        """Journals a record for the next group commit.
+
+        Parameters
+        ----------
+        record : dict
+            JSON serializable record
+
+        Returns
+        -------
+        int
+            sequence number of the record
+        """
+        with self._lock:
+            seq = self._next_seq
+            self._file.write(json.dumps({"seq": seq, "record": record}) +
+                             "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._next_seq += 1
+            self._pending.append((seq, record, time.monotonic()))
+            if len(self._pending) >= self.batch_size:
+                self._wake.notify()
+        return seq
+
+    def pending_records(self):
+        """Returns the records waiting for a commit.
+
+        Returns
+        -------
+        list of dict
+            records in journal order
+        """
+        with self._lock:
+            return [record for _seq, record, _time in self._pending]
+
+    def flush(self):
+        """Commits every pending record, one group at a time.
+
+        Returns
+        -------
+        int
+            number of records committed
+        """
+        committed = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    group = self._pending[:self.batch_size]
+                if not group:
+                    return committed
+                started = time.perf_counter()
+                self._commit([record for _seq, record, _time in group])
+                with self._lock:
+                    del self._pending[:len(group)]
+                    if self._pending:
+                        self._file.write(json.dumps(
+                            {"committed": group[-1][0]}) + "\n")
+                    else:
+                        self._file.seek(0)
+                        self._file.truncate()
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._flushed += len(group)
+                    self._last_flush_seconds = time.perf_counter() - started
+                committed += len(group)
+
+    def _run(self):
+        failed = False
+        while True:
+            with self._lock:
+                if not self._stop and (
+                        failed or len(self._pending) < self.batch_size):
+                    self._wake.wait(self.flush_interval)
+                stop = self._stop
+            try:
+                self.flush()
+                failed = False
+            except Exception:
+                failed = True
+                with self._lock:
+                    self._failed_flushes += 1
+                logging.exception("Write-behind flush failed")
+            if stop:
+                return
+
+    def stop(self):
+        """Commits the pending records and stops the background thread.
+
+        Records that cannot be committed stay in the journal and are
+        replayed by the next `start`.
+
+        Returns
+        -------
+        None
+        """
+        if self._thread is None:
+            return
+        with self._lock:
+            self._stop = True
+            self._wake.notify()
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._file = None
+
+    def stats(self):
+        """Returns the state of the queue.
+
+        Returns
+        -------
+        dict
+            number of pending records, age in seconds of the oldest one
+            (None if none is pending), journal size in bytes, records
+            committed, failed group commits and duration of the last group
+            commit in seconds
+        """
+        with self._lock:
+            oldest = self._pending[0][2] if self._pending else None
+            return {"pending": len(self._pending),
+                    "oldest_pending_seconds": None if oldest is None
+                    else round(time.monotonic() - oldest, 3),
+                    "journal_bytes": self._file.tell() if self._file
+                    else 0,
+                    "flushed": self._flushed,
+                    "failed_flushes": self._failed_flushes,
+                    "last_flush_seconds": self._last_flush_seconds}
+
+
+def read_journal(journal):
+    """Reads the records of a journal that were never committed.
+
+    A torn last line, left by a crash in the middle of a write, is skipped.
+
+    Parameters
+    ----------
+    journal : file object
+        journal opened for reading, positioned at its start
+
+    Returns
+    -------
+    list of tuple
+        (sequence number, record, time read) of each pending record
+    int
+        next sequence number
+    """
+    records = []
+    committed = 0
+    for line in journal:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if "committed" in entry:
+            committed = max(committed, entry["committed"])
+        else:
+            records.append((entry["seq"], entry["record"]))
+    now = time.monotonic()
+    pending = [(seq, record, now) for seq, record in records
+               if seq > committed]
+    next_seq = max([committed] + [seq for seq, _record in records]) + 1
+    return pending, next_seq
+
+
+def rewrite_journal(journal, path, pending):
+    """Compacts a journal down to its pending records.
+
+    The records are written to a new file that replaces the journal, so a
+    crash leaves either the old or the new journal in place. The lock held
+    on the old file is taken on the new one before the swap.
+
+    Parameters
+    ----------
+    journal : file object
+        locked journal
+    path : str
+        path of the journal
+    pending : list of tuple
+        pending records, as returned by `read_journal`
+
+    Returns
+    -------
+    file object
+        new journal, locked and opened for appending
+    """
+    new_path = path + ".tmp"
+    new_journal = open(new_path, "w")
+    fcntl.flock(new_journal, fcntl.LOCK_EX)
+    for seq, record, _time in pending:
+        new_journal.write(json.dumps({"seq": seq, "record": record}) + "\n")
+    new_journal.flush()
+    os.fsync(new_journal.fileno())
+    os.replace(new_path, path)
+    journal.close()
+    return new_journal